@@ -24,6 +24,7 @@ parser.add_argument('--debug_input', action='store_true')
 parser.add_argument('--mouse_input', type=str)
 parser.add_argument('--perf', type=str)
 parser.add_argument('--skip_model', action='store_true')
+parser.add_argument('--startup_report', action='store_true')
 parser.add_argument('--ifm', type=str)
 parser.add_argument('--osf', type=str)
 parser.add_argument('--anime4k', action='store_true')
@@ -32,15 +33,28 @@ parser.add_argument('--bongo', action='store_true')
 parser.add_argument('--cache', type=str, default='256mb')
 parser.add_argument('--gpu_cache', type=str, default='512mb')
 parser.add_argument('--simplify', type=int, default=1)
+parser.add_argument('--disk_cache', type=str)
+parser.add_argument('--disk_cache_dir', type=str, default='data/cache')
+parser.add_argument('--cache_policy', type=str, default='lru', choices=['lru', 'lfu', 'arc'])
+parser.add_argument('--cache_compress', action='store_true')
+parser.add_argument('--cache_match', type=str, default='exact', choices=['exact', 'nearest'])
+parser.add_argument('--image_cache_dir', type=str, default='data/image_cache')
+parser.add_argument('--pipeline', action='store_true')
+parser.add_argument('--prewarm', type=int, default=0)
+parser.add_argument('--prewarm_range', type=float, default=0.6)
 args = parser.parse_args()
 args.output_w = int(args.output_size.split('x')[0])
 args.output_h = int(args.output_size.split('x')[1])
 if args.cache is not None:
-    args.max_cache_len=int(convert_to_byte(args.cache)/262144/4)
+    args.max_cache_bytes=int(convert_to_byte(args.cache))
 else:
-    args.max_cache_len=0
+    args.max_cache_bytes=0
 if args.gpu_cache is not None:
-    args.max_gpu_cache_len=int(convert_to_byte(args.gpu_cache)/589824/4)
+    args.max_gpu_cache_bytes=int(convert_to_byte(args.gpu_cache))
 else:
-    args.max_gpu_cache_len=0
+    args.max_gpu_cache_bytes=0
+if args.disk_cache is not None:
+    args.max_disk_cache_bytes=int(convert_to_byte(args.disk_cache))
+else:
+    args.max_disk_cache_bytes=0
 if args.output_webcam is None and args.output_dir is None: args.debug = True
\ No newline at end of file
@@ -0,0 +1,388 @@
+import itertools
+import math
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PoseIndex:
+    """
+    spatial index over cached pose vectors for approximate cache lookups
+
+    poses are bucketed on a uniform grid over a few coarse dimensions, with a cell width of twice the
+    tolerance of that dimension, so every pose within tolerance of a query lies in one of the 3^k cells
+    around it. a query scans only those cells and returns the nearest pose that is within tolerance on
+    every dimension. a tolerance of 0 means the dimension has to match exactly.
+    """
+
+    def __init__(self, tolerance, grid_dims):
+        self.tolerance = np.asarray(tolerance, dtype=np.float64)
+        self.exact = self.tolerance <= 0
+        self.scale = np.where(self.exact, 0.0, 1.0 / np.where(self.exact, 1.0, self.tolerance))
+        self.grid_dims = [d for d in grid_dims if not self.exact[d]]
+        self.offsets = list(itertools.product((-1, 0, 1), repeat=len(self.grid_dims)))
+        self.cells = {}
+        self.key_cells = {}
+
+    def __len__(self):
+        return len(self.key_cells)
+
+    def cell_of(self, vector):
+        return tuple(math.floor(vector[d] * self.scale[d] / 2) for d in self.grid_dims)
+
+    def add(self, key, vector):
+        if key in self.key_cells:
+            return
+        cell = self.cell_of(vector)
+        self.cells.setdefault(cell, {})[key] = np.asarray(vector, dtype=np.float64)
+        self.key_cells[key] = cell
+
+    def remove(self, key):
+        cell = self.key_cells.pop(key, None)
+        if cell is None:
+            return
+        bucket = self.cells[cell]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.key_cells.clear()
+
+    def query(self, vector):
+        """
+        find the nearest indexed pose within tolerance
+        Args:
+            vector (list of float): pose to look up
+        Returns:
+            (key, distance) where distance is the largest per-dimension difference in units of the
+            tolerance (0 for an exact match, at most 1), or None if no pose is within tolerance
+        """
+        vector = np.asarray(vector, dtype=np.float64)
+        center = self.cell_of(vector)
+        keys = []
+        candidates = []
+        for offset in self.offsets:
+            bucket = self.cells.get(tuple(c + o for c, o in zip(center, offset)))
+            if bucket is not None:
+                keys.extend(bucket.keys())
+                candidates.extend(bucket.values())
+        if len(keys) == 0:
+            return None
+        diff = np.abs(np.stack(candidates) - vector)
+        distance = np.where(self.exact, np.where(diff > 0, np.inf, 0.0), diff * self.scale).max(axis=1)
+        nearest = int(np.argmin(distance))
+        if distance[nearest] > 1.0:
+            return None
+        return keys[nearest], float(distance[nearest])
+
+
+def entry_nbytes(value):
+    """
+    real memory footprint of a cache entry
+    Args:
+        value: numpy array, torch tensor, bytes or any object with an nbytes attribute
+    Returns:
+        size in bytes (int)
+    """
+    if hasattr(value, 'element_size'):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return int(value.nbytes)
+
+
+class LRUPolicy:
+    def __init__(self, max_bytes):
+        self.order = OrderedDict()
+
+    def insert(self, key, nbytes):
+        self.order[key] = nbytes
+
+    def touch(self, key, nbytes=None):
+        self.order.move_to_end(key)
+        if nbytes is not None:
+            self.order[key] = nbytes
+
+    def remove(self, key):
+        del self.order[key]
+
+    def victim(self, exclude=None):
+        return next(key for key in self.order if key != exclude)
+
+
+class LFUPolicy:
+    """
+    O(1) least-frequently-used eviction, ties are broken by least recent use
+    """
+
+    def __init__(self, max_bytes):
+        self.freq = {}
+        self.buckets = {}
+        self.min_freq = 0
+
+    def insert(self, key, nbytes):
+        self.freq[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_freq = 1
+
+    def touch(self, key, nbytes=None):
+        freq = self.freq[key]
+        self._unlink(key, freq)
+        self.freq[key] = freq + 1
+        self.buckets.setdefault(freq + 1, OrderedDict())[key] = None
+        if self.min_freq not in self.buckets:
+            self.min_freq = freq + 1
+
+    def remove(self, key):
+        freq = self.freq.pop(key)
+        self._unlink(key, freq)
+        if self.min_freq not in self.buckets:
+            self.min_freq = min(self.buckets) if len(self.buckets) > 0 else 0
+
+    def _unlink(self, key, freq):
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.buckets[freq]
+
+    def victim(self, exclude=None):
+        for key in self.buckets[self.min_freq]:
+            if key != exclude:
+                return key
+        # the least frequent bucket holds only the excluded key
+        freq = min(freq for freq in self.buckets if freq != self.min_freq)
+        return next(iter(self.buckets[freq]))
+
+
+class ARCPolicy:
+    """
+    adaptive replacement cache with all list sizes measured in bytes
+
+    t1 holds entries seen once, t2 entries seen at least twice, b1 and b2 remember the keys recently evicted
+    from t1 and t2. a re-inserted ghost key shifts the target size of t1 towards recency or frequency.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.target = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.t1_bytes = 0
+        self.t2_bytes = 0
+        self.b1_bytes = 0
+        self.b2_bytes = 0
+
+    def insert(self, key, nbytes):
+        if key in self.b1:
+            self.target = min(self.max_bytes, self.target + max(self.b2_bytes / max(self.b1_bytes, 1), 1) * nbytes)
+            self.b1_bytes -= self.b1.pop(key)
+            self.t2[key] = nbytes
+            self.t2_bytes += nbytes
+        elif key in self.b2:
+            self.target = max(0, self.target - max(self.b1_bytes / max(self.b2_bytes, 1), 1) * nbytes)
+            self.b2_bytes -= self.b2.pop(key)
+            self.t2[key] = nbytes
+            self.t2_bytes += nbytes
+        else:
+            self.t1[key] = nbytes
+            self.t1_bytes += nbytes
+
+    def touch(self, key, nbytes=None):
+        if key in self.t1:
+            old_nbytes = self.t1.pop(key)
+            self.t1_bytes -= old_nbytes
+        else:
+            old_nbytes = self.t2.pop(key)
+            self.t2_bytes -= old_nbytes
+        if nbytes is None:
+            nbytes = old_nbytes
+        self.t2[key] = nbytes
+        self.t2_bytes += nbytes
+
+    def remove(self, key):
+        # called for every eviction, the key is remembered in the matching ghost list
+        if key in self.t1:
+            nbytes = self.t1.pop(key)
+            self.t1_bytes -= nbytes
+            self.b1[key] = nbytes
+            self.b1_bytes += nbytes
+        else:
+            nbytes = self.t2.pop(key)
+            self.t2_bytes -= nbytes
+            self.b2[key] = nbytes
+            self.b2_bytes += nbytes
+        while len(self.b1) > 0 and self.t1_bytes + self.b1_bytes > self.max_bytes:
+            self.b1_bytes -= self.b1.popitem(last=False)[1]
+        while len(self.b2) > 0 and self.t1_bytes + self.t2_bytes + self.b1_bytes + self.b2_bytes > 2 * self.max_bytes:
+            self.b2_bytes -= self.b2.popitem(last=False)[1]
+
+    def victim(self, exclude=None):
+        # the key being put is never its own victim, it is left out of the list sizes it would otherwise tip over
+        t1_victim = next((key for key in self.t1 if key != exclude), None)
+        t2_victim = next((key for key in self.t2 if key != exclude), None)
+        t1_bytes = self.t1_bytes - self.t1.get(exclude, 0)
+        if t1_victim is not None and (t1_bytes > self.target or t2_victim is None):
+            return t1_victim
+        return t2_victim
+
+
+CACHE_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'arc': ARCPolicy,
+}
+
+
+class FrameCache:
+    """
+    byte-bounded cache with pluggable eviction
+
+    every entry is accounted with its real nbytes, entries are evicted by the selected policy until the
+    resident bytes fit the budget again. on_evict is called with the key of every evicted entry.
+    """
+
+    def __init__(self, max_bytes, policy='lru', on_evict=None):
+        self.max_bytes = int(max_bytes)
+        self.policy = CACHE_POLICIES[policy](self.max_bytes)
+        self.on_evict = on_evict
+        self.entries = {}
+        self.sizes = {}
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.policy.touch(key)
+        return value
+
+    def put(self, key, value):
+        nbytes = entry_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.resident_bytes -= self.sizes[key]
+            self.policy.touch(key, nbytes)
+        else:
+            self.policy.insert(key, nbytes)
+        self.entries[key] = value
+        self.sizes[key] = nbytes
+        self.resident_bytes += nbytes
+        while self.resident_bytes > self.max_bytes:
+            self.evict(self.policy.victim(exclude=key))
+
+    def evict(self, key):
+        self.policy.remove(key)
+        del self.entries[key]
+        self.resident_bytes -= self.sizes.pop(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'resident_bytes': self.resident_bytes,
+        }
+
+
+class CompressedFrame:
+    """
+    lossless compressed copy of an (h, w, c) frame
+
+    everything outside the bounding box of the non-zero pixels is dropped (for a character frame that is
+    most of the transparent background), the remaining crop is deflated with a fast zlib level.
+    """
+
+    def __init__(self, frame, level=1):
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.raw_nbytes = frame.nbytes
+        mask = np.any(frame != 0, axis=2)
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            self.bbox = (0, 0, 0, 0)
+            self.payload = b''
+        else:
+            self.bbox = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+            top, bottom, left, right = self.bbox
+            self.payload = zlib.compress(np.ascontiguousarray(frame[top:bottom, left:right]), level)
+        self.nbytes = len(self.payload) + 64
+
+    def decompress_into(self, buffer):
+        top, bottom, left, right = self.bbox
+        buffer.fill(0)
+        if bottom > top:
+            buffer[top:bottom, left:right] = np.frombuffer(zlib.decompress(self.payload), dtype=self.dtype) \
+                .reshape(bottom - top, right - left, self.shape[2])
+        return buffer
+
+
+class CompressedFrameCache(FrameCache):
+    """
+    FrameCache tier that keeps frames as CompressedFrame entries, so the same byte budget holds several
+    times more poses. a hit is decompressed into one reusable buffer, which is only valid until the next get().
+    """
+
+    def __init__(self, max_bytes, policy='lru', on_evict=None, level=1):
+        super().__init__(max_bytes, policy, on_evict)
+        self.level = level
+        self.buffer = None
+        self.raw_bytes = 0
+        self.decompressions = 0
+        self.decompress_seconds = 0.0
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            return None
+        tic = time.perf_counter()
+        if self.buffer is None or self.buffer.shape != entry.shape or self.buffer.dtype != entry.dtype:
+            self.buffer = np.empty(entry.shape, dtype=entry.dtype)
+        frame = entry.decompress_into(self.buffer)
+        self.decompress_seconds += time.perf_counter() - tic
+        self.decompressions += 1
+        return frame
+
+    def put(self, key, value):
+        entry = CompressedFrame(value, self.level)
+        if entry.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.raw_bytes -= self.entries[key].raw_nbytes
+        self.raw_bytes += entry.raw_nbytes
+        super().put(key, entry)
+
+    def evict(self, key):
+        self.raw_bytes -= self.entries[key].raw_nbytes
+        super().evict(key)
+
+    def stats(self):
+        stats = super().stats()
+        resident_mb = self.resident_bytes / 1048576
+        stats['raw_bytes'] = self.raw_bytes
+        stats['entries_per_mb'] = len(self.entries) / resident_mb if resident_mb > 0 else 0.0
+        stats['decompress_ms'] = self.decompress_seconds * 1000 / self.decompressions \
+            if self.decompressions > 0 else 0.0
+        return stats
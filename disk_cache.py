@@ -0,0 +1,195 @@
+import json
+import os
+import shutil
+import time
+import zlib
+
+import numpy as np
+
+
+class DiskFrameCache:
+    """
+    persistent frame cache for one character, model and simplify level
+
+    frames live in a memory-mapped slab file of fixed-size slots, a compact index stores the pose key and a
+    crc32 of every used slot. slots are reused round-robin once the size budget is full. a directory written
+    with another size budget keeps its newest frames, a directory whose metadata does not match otherwise, or
+    whose files cannot be read, is wiped and recreated, a slot whose crc does not match its frame is dropped
+    on read.
+    """
+    VERSION = 1
+
+    def __init__(self, directory, frame_shape, max_bytes, pose_size=45, index=None, flush_every=16,
+                 flush_seconds=5.0):
+        self.directory = directory
+        self.frame_shape = tuple(frame_shape)
+        self.frame_nbytes = int(np.prod(self.frame_shape))
+        self.slot_count = max(1, int(max_bytes) // self.frame_nbytes)
+        self.pose_size = pose_size
+        self.index = index
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.perf_counter()
+        self.index_dtype = np.dtype([('pose', np.float64, (pose_size,)), ('crc', np.uint32), ('used', np.uint8)])
+        self.meta = {
+            'version': self.VERSION,
+            'frame_shape': list(self.frame_shape),
+            'slot_count': self.slot_count,
+            'pose_size': pose_size,
+        }
+        self.slots = {}
+        self.next_slot = 0
+        self.dirty = 0
+        self.hits = 0
+        self.misses = 0
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError, TypeError, EOFError, AttributeError):
+            self.reset()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        with open(self.path('meta.json')) as f:
+            meta = json.load(f)
+        if not isinstance(meta, dict):
+            raise ValueError("Corrupted frame cache metadata: " + self.directory)
+        next_slot = int(meta.pop('next_slot'))
+        slot_count = int(meta.pop('slot_count'))
+        if meta != {name: value for name, value in self.meta.items() if name != 'slot_count'}:
+            raise ValueError("Stale frame cache: " + self.directory)
+        if os.path.getsize(self.path('slab.bin')) != slot_count * self.frame_nbytes:
+            raise ValueError("Truncated frame cache: " + self.directory)
+        entries = np.load(self.path('index.npy'), allow_pickle=False)
+        if entries.dtype != self.index_dtype or entries.shape != (slot_count,):
+            raise ValueError("Corrupted frame cache index: " + self.directory)
+        migrated = slot_count != self.slot_count
+        if migrated:
+            entries, next_slot = self.migrate(entries, slot_count, next_slot)
+        self.entries = entries
+        self.slab = np.memmap(self.path('slab.bin'), dtype=np.uint8, mode='r+',
+                              shape=(self.slot_count,) + self.frame_shape)
+        self.next_slot = next_slot % self.slot_count
+        for slot in np.flatnonzero(self.entries['used']):
+            self.link(tuple(self.entries['pose'][slot].tolist()), int(slot))
+        if migrated:
+            self.flush()
+
+    def migrate(self, entries, slot_count, next_slot):
+        """
+        move the newest frames of a slab written with another size budget into a slab of the current size
+        Args:
+            entries: index of the old slab
+            slot_count: slot count of the old slab
+            next_slot: slot the old cache would have written next
+        Returns:
+            (index of the new slab, slot the new cache writes next)
+        """
+        # the slots written last come right before next_slot, a smaller budget keeps the newest of them
+        order = [(next_slot - 1 - i) % slot_count for i in range(slot_count)]
+        kept = [slot for slot in order if entries['used'][slot]][:self.slot_count][::-1]
+        old_slab = np.memmap(self.path('slab.bin'), dtype=np.uint8, mode='r',
+                             shape=(slot_count,) + self.frame_shape)
+        new_slab = np.memmap(self.path('slab.tmp.bin'), dtype=np.uint8, mode='w+',
+                             shape=(self.slot_count,) + self.frame_shape)
+        new_entries = np.zeros(self.slot_count, dtype=self.index_dtype)
+        for new_slot, old_slot in enumerate(kept):
+            new_slab[new_slot] = old_slab[old_slot]
+            new_entries[new_slot] = entries[old_slot]
+        new_slab.flush()
+        # both maps have to be closed before the old slab can be replaced on windows
+        del old_slab, new_slab
+        os.replace(self.path('slab.tmp.bin'), self.path('slab.bin'))
+        return new_entries, len(kept)
+
+    def reset(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.slots.clear()
+        if self.index is not None:
+            self.index.clear()
+        self.next_slot = 0
+        self.entries = np.zeros(self.slot_count, dtype=self.index_dtype)
+        self.slab = np.memmap(self.path('slab.bin'), dtype=np.uint8, mode='w+',
+                              shape=(self.slot_count,) + self.frame_shape)
+        self.flush()
+
+    def link(self, key, slot):
+        self.slots[key] = slot
+        if self.index is not None:
+            self.index.add(key, key)
+
+    def unlink(self, key):
+        del self.slots[key]
+        if self.index is not None:
+            self.index.remove(key)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def get(self, key):
+        """
+        Args:
+            key (tuple of float): pose the frame was rendered for
+        Returns:
+            a copy of the frame (numpy array), or None
+        """
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return None
+        frame = np.array(self.slab[slot])
+        if zlib.crc32(frame) != int(self.entries['crc'][slot]):
+            # the slab was written after the last index flush, drop the slot instead of serving a wrong frame
+            self.unlink(key)
+            self.entries['used'][slot] = 0
+            self.misses += 1
+            return None
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        if key in self.slots:
+            return
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.slot_count
+        if self.entries['used'][slot]:
+            old_key = tuple(self.entries['pose'][slot].tolist())
+            if self.slots.get(old_key) == slot:
+                self.unlink(old_key)
+        self.slab[slot] = frame
+        self.entries['pose'][slot] = key
+        self.entries['crc'][slot] = zlib.crc32(np.ascontiguousarray(frame))
+        self.entries['used'][slot] = 1
+        self.link(key, slot)
+        self.dirty += 1
+        if self.dirty >= self.flush_every:
+            self.flush()
+
+    def flush_stale(self):
+        """
+        flush the frames put since the last flush once they have waited flush_seconds, so the last few frames
+        of a session are not lost when fewer than flush_every follow them
+        """
+        if self.dirty > 0 and time.perf_counter() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def close(self):
+        """
+        persist the index of the frames put since the last flush
+        """
+        if self.dirty > 0:
+            self.flush()
+
+    def flush(self):
+        self.slab.flush()
+        with open(self.path('index.tmp.npy'), 'wb') as f:
+            np.save(f, self.entries)
+        os.replace(self.path('index.tmp.npy'), self.path('index.npy'))
+        meta = dict(self.meta, next_slot=self.next_slot)
+        with open(self.path('meta.tmp.json'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.path('meta.tmp.json'), self.path('meta.json'))
+        self.dirty = 0
+        self.last_flush = time.perf_counter()
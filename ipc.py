@@ -0,0 +1,198 @@
+import atexit
+from multiprocessing import Event, shared_memory
+
+import numpy as np
+
+
+def attach_shared_memory(name):
+    """
+    attach to a segment created by another process without taking over its cleanup, the creator unlinks it
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before python 3.13 attaching always registers the segment, with the resource tracker a child process
+        # shares with the parent that created it, which tracks the name already. unregistering it here would
+        # drop the parent's registration too, so nothing is undone
+        return shared_memory.SharedMemory(name)
+
+
+class FrameRing:
+    """
+    ring buffer of preallocated frame slots living in shared memory
+
+    the writer fills the next slot in place and then publishes it as the latest frame, readers get the
+    latest slot as a numpy view, so no frame is ever pickled or pushed through a pipe.
+    header layout (int64): [latest slot index, latest sequence number, per-slot sequence numbers...]
+    a slot sequence number of -1 marks a slot that is being written.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, slot_count=4):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_count = slot_count
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.header_nbytes = (2 + slot_count) * 8
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=self.header_nbytes + self.frame_nbytes * slot_count)
+        self._attach()
+        self.header[0] = -1
+        self.header[1] = 0
+        self.slot_seq[:] = 0
+        atexit.register(self.release)
+
+    def _attach(self):
+        self.header = np.ndarray((2 + self.slot_count,), dtype=np.int64, buffer=self.shm.buf)
+        self.slot_seq = self.header[2:]
+        self.slots = np.ndarray((self.slot_count,) + self.shape, dtype=self.dtype, buffer=self.shm.buf,
+                                offset=self.header_nbytes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['header'], state['slot_seq'], state['slots']
+        state['shm'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = attach_shared_memory(state['shm'])
+        self._attach()
+
+    def slot_of(self, seq):
+        return (seq - 1) % self.slot_count
+
+    def write(self, frame):
+        """
+        copy a frame into the next slot and publish it as the latest one
+        Args:
+            frame (numpy array): frame with the ring's shape and dtype
+        Returns:
+            sequence number of the published frame
+        """
+        seq = int(self.header[1]) + 1
+        slot = self.slot_of(seq)
+        self.slot_seq[slot] = -1
+        self.slots[slot][...] = frame
+        self.slot_seq[slot] = seq
+        self.header[0] = slot
+        self.header[1] = seq
+        return seq
+
+    def latest(self):
+        """
+        get the latest published frame without copying it
+        Returns:
+            (sequence number, numpy view of the slot), or None if nothing was published yet
+        """
+        slot = int(self.header[0])
+        if slot < 0:
+            return None
+        seq = int(self.slot_seq[slot])
+        if seq <= 0:
+            return None
+        return seq, self.slots[slot]
+
+    def is_intact(self, seq):
+        """
+        check that the slot of a frame returned by latest() was not overwritten while it was being read
+        """
+        return int(self.slot_seq[self.slot_of(seq)]) == seq
+
+    def close(self):
+        """
+        detach from the shared memory without freeing it, for the process that did not create the ring
+        """
+        del self.header, self.slot_seq, self.slots
+        self.shm.close()
+
+    def release(self):
+        self.close()
+        self.shm.unlink()
+        atexit.unregister(self.release)
+
+
+class PoseMailbox:
+    """
+    single-slot latest-pose mailbox in shared memory guarded by a seqlock
+
+    the writer overwrites the slot in place and never blocks, the reader waits on an event until the
+    sequence number advances and always sees only the newest pose, older unread poses are simply overwritten.
+    an odd sequence number marks a write in progress.
+    """
+
+    def __init__(self, size=45):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=8 + size * 4)
+        self.updated = Event()
+        self._attach()
+        self.seq[0] = 0
+        atexit.register(self.release)
+
+    def _attach(self):
+        self.seq = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.values = np.ndarray((self.size,), dtype=np.float32, buffer=self.shm.buf, offset=8)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['seq'], state['values']
+        state['shm'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = attach_shared_memory(state['shm'])
+        self._attach()
+
+    def put(self, pose):
+        """
+        publish a new pose, overwriting whatever the reader has not picked up yet
+        Args:
+            pose (list of float): pose vector of the mailbox size
+        """
+        seq = int(self.seq[0])
+        self.seq[0] = seq + 1
+        self.values[:] = pose
+        self.seq[0] = seq + 2
+        self.updated.set()
+
+    def get(self, last_seq, timeout=None):
+        """
+        wait for a pose newer than last_seq
+        Args:
+            last_seq (int): sequence number of the last pose the caller has seen, 0 for none
+            timeout (float): seconds to wait, None to wait forever
+        Returns:
+            (sequence number, pose as a list of float), or None if the timeout expired or wake() was called
+        """
+        seq = int(self.seq[0])
+        if seq == last_seq or seq % 2 == 1:
+            if not self.updated.wait(timeout):
+                return None
+            self.updated.clear()
+        while True:
+            seq = int(self.seq[0])
+            if seq == last_seq:
+                return None
+            if seq % 2 == 1:
+                continue
+            values = self.values.tolist()
+            if int(self.seq[0]) == seq:
+                return seq, values
+
+    def wake(self):
+        """
+        make a pending get() return without a new pose
+        """
+        self.updated.set()
+
+    def close(self):
+        """
+        detach from the shared memory without freeing it, for the process that did not create the mailbox
+        """
+        del self.seq, self.values
+        self.shm.close()
+
+    def release(self):
+        self.close()
+        self.shm.unlink()
+        atexit.unregister(self.release)
@@ -1,37 +1,45 @@
 import struct
+import time
+
+from startup_report import startup_report
 
-import cv2
-import torch
-import pyvirtualcam
-import numpy as np
-import mediapipe as mp
-from PIL import Image
+# cv2, mediapipe, pyvirtualcam, pyanime4k and pynput are imported where the chosen input and output mode needs
+# them, a spawned child process re-imports this module and should not pay for them
+with startup_report.step('import torch'):
+    import torch
+with startup_report.step('import numpy, PIL'):
+    import numpy as np
+    from PIL import Image
 
-import tha2.poser.modes.mode_20_wx
-from models import TalkingAnimeLight, TalkingAnime3
-from pose import get_pose
+with startup_report.step('import tha2 pose converter'):
+    import tha2.poser.modes.mode_20_wx
+with startup_report.step('import models'):
+    from models import TalkingAnimeLight, TalkingAnime3, PipelinedTalkingAnime3
 from utils import preprocessing_image, postprocessing_image
+from ipc import FrameRing, PoseMailbox
+from cache import PoseIndex, FrameCache, CompressedFrameCache
+from disk_cache import DiskFrameCache
+from tha3.image_cache import PreprocessedImageCache
 
 import errno
+import hashlib
+import itertools
 import json
 import os
 import queue
 import socket
-import time
 import math
-from pynput.mouse import Button, Controller
 import re
-from collections import OrderedDict
+import signal
+import sys
 from multiprocessing import Value, Process, Queue
 
-from pyanime4k import ac
-
 from tha2.mocap.ifacialmocap_constants import *
 
 from args import args
 
 from tha3.util import torch_linear_to_srgb, resize_PIL_image, extract_PIL_image_from_filelike, \
-    extract_pytorch_image_from_PIL_image
+    extract_pytorch_image_from_PIL_image, clear_transparent_pixels
 
 import collections
 
@@ -186,7 +194,8 @@ class OSFClientProcess(Process):
         self.socket.close()
 
 
-ifm_converter = tha2.poser.modes.mode_20_wx.IFacialMocapPoseConverter20()
+with startup_report.step('init pose converter'):
+    ifm_converter = tha2.poser.modes.mode_20_wx.IFacialMocapPoseConverter20()
 
 
 class IFMClientProcess(Process):
@@ -276,6 +285,7 @@ class MouseClientProcess(Process):
         self.queue = Queue()
 
     def run(self):
+        from pynput.mouse import Controller
         mouse = Controller()
         posLimit = [int(x) for x in args.mouse_input.split(',')]
         prev = {
@@ -316,6 +326,165 @@ class MouseClientProcess(Process):
             time.sleep(1 / 60)
 
 
+def create_simplify_arr():
+    # quantization steps of every pose parameter, higher --simplify levels use coarser steps
+    simplify_arr = [1000] * ifm_converter.pose_size
+    if args.simplify >= 1:
+        simplify_arr = [200] * ifm_converter.pose_size
+        simplify_arr[ifm_converter.eye_wink_left_index] = 50
+        simplify_arr[ifm_converter.eye_wink_right_index] = 50
+        simplify_arr[ifm_converter.eye_happy_wink_left_index] = 50
+        simplify_arr[ifm_converter.eye_happy_wink_right_index] = 50
+        simplify_arr[ifm_converter.eye_surprised_left_index] = 30
+        simplify_arr[ifm_converter.eye_surprised_right_index] = 30
+        simplify_arr[ifm_converter.iris_rotation_x_index] = 25
+        simplify_arr[ifm_converter.iris_rotation_y_index] = 25
+        simplify_arr[ifm_converter.eye_raised_lower_eyelid_left_index] = 10
+        simplify_arr[ifm_converter.eye_raised_lower_eyelid_right_index] = 10
+        simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 5
+        simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 5
+        simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 5
+        simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 5
+    if args.simplify >= 2:
+        simplify_arr[ifm_converter.head_x_index] = 100
+        simplify_arr[ifm_converter.head_y_index] = 100
+        simplify_arr[ifm_converter.eye_surprised_left_index] = 10
+        simplify_arr[ifm_converter.eye_surprised_right_index] = 10
+        simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 0
+        simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 0
+        simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 0
+        simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 0
+    if args.simplify >= 3:
+        simplify_arr[ifm_converter.iris_rotation_x_index] = 20
+        simplify_arr[ifm_converter.iris_rotation_y_index] = 20
+        simplify_arr[ifm_converter.eye_wink_left_index] = 32
+        simplify_arr[ifm_converter.eye_wink_right_index] = 32
+        simplify_arr[ifm_converter.eye_happy_wink_left_index] = 32
+        simplify_arr[ifm_converter.eye_happy_wink_right_index] = 32
+    if args.simplify >= 4:
+        simplify_arr[ifm_converter.head_x_index] = 50
+        simplify_arr[ifm_converter.head_y_index] = 50
+        simplify_arr[ifm_converter.neck_z_index] = 100
+        simplify_arr[ifm_converter.iris_rotation_x_index] = 10
+        simplify_arr[ifm_converter.iris_rotation_y_index] = 10
+        simplify_arr[ifm_converter.eye_wink_left_index] = 24
+        simplify_arr[ifm_converter.eye_wink_right_index] = 24
+        simplify_arr[ifm_converter.eye_happy_wink_left_index] = 24
+        simplify_arr[ifm_converter.eye_happy_wink_right_index] = 24
+        simplify_arr[ifm_converter.eye_surprised_left_index] = 8
+        simplify_arr[ifm_converter.eye_surprised_right_index] = 8
+    for i in range(4, args.simplify):
+        simplify_arr = [max(math.ceil(x * 0.8), 5) for x in simplify_arr]
+    return simplify_arr
+
+
+def simplify_model_input(model_input):
+    # merge the pose parameters that higher --simplify levels treat as one, in place
+    if args.simplify >= 2:
+        model_input[ifm_converter.eye_wink_left_index] += model_input[
+            ifm_converter.eye_happy_wink_left_index]
+        model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
+                                                                   ifm_converter.eye_wink_left_index] / 2
+        model_input[ifm_converter.eye_wink_left_index] = model_input[
+                                                             ifm_converter.eye_wink_left_index] / 2
+        model_input[ifm_converter.eye_wink_right_index] += model_input[
+            ifm_converter.eye_happy_wink_right_index]
+        model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
+                                                                    ifm_converter.eye_wink_right_index] / 2
+        model_input[ifm_converter.eye_wink_right_index] = model_input[
+                                                              ifm_converter.eye_wink_right_index] / 2
+        uosum = model_input[ifm_converter.mouth_uuu_index] + \
+                model_input[ifm_converter.mouth_ooo_index]
+        model_input[ifm_converter.mouth_ooo_index] = uosum
+        model_input[ifm_converter.mouth_uuu_index] = 0
+        is_open = (model_input[ifm_converter.mouth_aaa_index] + model_input[
+            ifm_converter.mouth_iii_index] + uosum) > 0
+        model_input[ifm_converter.mouth_lowered_corner_left_index] = 0
+        model_input[ifm_converter.mouth_lowered_corner_right_index] = 0
+        model_input[ifm_converter.mouth_raised_corner_left_index] = 0.5 if is_open else 0
+        model_input[ifm_converter.mouth_raised_corner_right_index] = 0.5 if is_open else 0
+    if args.simplify >= 4:
+        model_input[ifm_converter.eye_raised_lower_eyelid_left_index] = 0
+        model_input[ifm_converter.eye_raised_lower_eyelid_right_index] = 0
+        model_input[ifm_converter.eye_wink_left_index] += model_input[
+            ifm_converter.eye_wink_right_index]
+        model_input[ifm_converter.eye_wink_right_index] = model_input[
+                                                              ifm_converter.eye_wink_left_index] / 2
+        model_input[ifm_converter.eye_wink_left_index] = model_input[
+                                                             ifm_converter.eye_wink_left_index] / 2
+        model_input[ifm_converter.eye_surprised_left_index] += model_input[
+            ifm_converter.eye_surprised_right_index]
+        model_input[ifm_converter.eye_surprised_right_index] = model_input[
+                                                                   ifm_converter.eye_surprised_left_index] / 2
+        model_input[ifm_converter.eye_surprised_left_index] = model_input[
+                                                                  ifm_converter.eye_surprised_left_index] / 2
+        model_input[ifm_converter.eye_happy_wink_left_index] += model_input[
+            ifm_converter.eye_happy_wink_right_index]
+        model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
+                                                                    ifm_converter.eye_happy_wink_left_index] / 2
+        model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
+                                                                   ifm_converter.eye_happy_wink_left_index] / 2
+        model_input[ifm_converter.mouth_aaa_index] = min(
+            model_input[ifm_converter.mouth_aaa_index] +
+            model_input[ifm_converter.mouth_ooo_index] / 2 +
+            model_input[ifm_converter.mouth_iii_index] / 2 +
+            model_input[ifm_converter.mouth_uuu_index] / 2, 1
+        )
+        model_input[ifm_converter.mouth_ooo_index] = 0
+        model_input[ifm_converter.mouth_iii_index] = 0
+        model_input[ifm_converter.mouth_uuu_index] = 0
+    return model_input
+
+
+def create_pose_index(simplify_arr):
+    return PoseIndex([0.5 / x if x > 0 else 0.0 for x in simplify_arr],
+                     [ifm_converter.head_x_index, ifm_converter.head_y_index, ifm_converter.neck_z_index])
+
+
+def quantize_model_input(model_input, simplify_arr):
+    # snap every pose parameter to its simplify step, in place
+    for i in range(0, len(simplify_arr)):
+        if simplify_arr[i] > 0:
+            model_input[i] = round(model_input[i] * simplify_arr[i]) / simplify_arr[i]
+    return model_input
+
+
+def create_prewarm_poses(simplify_arr):
+    """
+    grid of likely idle poses to render into the cache while there is no live input
+    Args:
+        simplify_arr (list of int): quantization steps from create_simplify_arr()
+    Returns:
+        list of model inputs (list of float), nearest to the neutral pose first, without duplicates
+    """
+    # the converter only knows the tha2 parameters, the model input appends body_y, body_z and breathing
+    body_y_index = ifm_converter.neck_z_index + 1
+    angles = [args.prewarm_range * i / args.prewarm for i in range(-args.prewarm, args.prewarm + 1)]
+    grid = []
+    for head_x, head_y, blink, mouth in itertools.product(angles, angles, (0.0, 1.0), (0.0, 0.5, 1.0)):
+        model_input = [0.0] * ifm_converter.pose_size
+        model_input[ifm_converter.head_x_index] = head_x
+        model_input[ifm_converter.head_y_index] = head_y
+        model_input[body_y_index] = head_y
+        # blinking reaches the model through the happy wink parameters, see main()
+        model_input[ifm_converter.eye_happy_wink_left_index] = blink
+        model_input[ifm_converter.eye_happy_wink_right_index] = blink
+        model_input[ifm_converter.mouth_aaa_index] = mouth
+        grid.append((abs(head_x) + abs(head_y) + blink + mouth, model_input))
+    grid.sort(key=lambda item: item[0])
+    poses = []
+    seen = set()
+    for _, model_input in grid:
+        simplify_model_input(model_input)
+        if args.cache_match != 'nearest':
+            quantize_model_input(model_input, simplify_arr)
+        input_key = tuple(model_input)
+        if input_key not in seen:
+            seen.add(input_key)
+            poses.append(model_input)
+    return poses
+
+
 class ModelClientProcess(Process):
     def __init__(self, input_image):
         super().__init__()
@@ -323,20 +492,33 @@ class ModelClientProcess(Process):
         self.updated = Value('b', False)
         self.data = None
         self.input_image = input_image
-        self.output_queue = Queue()
-        self.input_queue = Queue()
+        _, c, h, w = input_image.shape
+        self.frame_ring = FrameRing((h, w, c))
+        image_hash = hashlib.sha1(input_image.numpy().tobytes()).hexdigest()[:16]
+        self.disk_cache_name = '%s_%s_s%d%s' % (image_hash, args.model, args.simplify,
+                                               '_eyebrow' if args.eyebrow else '')
+        self.pose_mailbox = PoseMailbox(ifm_converter.pose_size)
         self.model_fps_number = Value('f', 0.0)
         self.gpu_fps_number = Value('f', 0.0)
         self.cache_hit_ratio = Value('f', 0.0)
+        self.cache_hit_distance = Value('f', 0.0)
+        self.cache_resident_mb = Value('f', 0.0)
+        self.cache_entries_per_mb = Value('f', 0.0)
+        self.cache_decompress_ms = Value('f', 0.0)
         self.gpu_cache_hit_ratio = Value('f', 0.0)
+        self.prewarm_progress = Value('f', 0.0)
+        self.prewarm_coverage = Value('f', 0.0)
 
     def run(self):
         model = None
         if not args.skip_model:
-            model = TalkingAnime3().to(device)
-            model = model.eval()
-            model = model
+            with startup_report.step('load model'):
+                model = TalkingAnime3().to(device)
+                model = model.eval()
+                model = model
             print("Pretrained Model Loaded")
+            if args.startup_report:
+                print(startup_report.format("Model process startup"))
 
         eyebrow_vector = torch.empty(1, 12, dtype=torch.half if args.model.endswith('half') else torch.float)
         mouth_eye_vector = torch.empty(1, 27, dtype=torch.half if args.model.endswith('half') else torch.float)
@@ -346,244 +528,324 @@ class ModelClientProcess(Process):
         eyebrow_vector = eyebrow_vector.to(device)
         mouth_eye_vector = mouth_eye_vector.to(device)
         pose_vector = pose_vector.to(device)
-
-        model_cache = OrderedDict()
+        if model is not None:
+            model.set_character(input_image)
+
+        simplify_arr = create_simplify_arr()
+        pose_index = None
+        disk_index = None
+        if args.cache_match == 'nearest':
+            pose_index = create_pose_index(simplify_arr)
+            disk_index = create_pose_index(simplify_arr)
+        disk_cache = None
+        if args.max_disk_cache_bytes > 0:
+            disk_cache = DiskFrameCache(os.path.join(args.disk_cache_dir, self.disk_cache_name),
+                                        self.frame_ring.shape, args.max_disk_cache_bytes, ifm_converter.pose_size,
+                                        index=disk_index)
+            print("Disk Cache Loaded:", len(disk_cache.slots), "frames")
+
+        def evict(input_key):
+            if pose_index is not None:
+                pose_index.remove(input_key)
+
+        if args.cache_compress:
+            model_cache = CompressedFrameCache(args.max_cache_bytes, args.cache_policy, on_evict=evict)
+        else:
+            model_cache = FrameCache(args.max_cache_bytes, args.cache_policy, on_evict=evict)
         tot = 0
         hit = 0
+        hit_distance = 0.0
         hit_in_a_row = 0
         model_fps = FPS()
         gpu_fps = FPS()
-        while True:
-            model_input = None
-            try:
-                while not self.input_queue.empty():
-                    model_input = self.input_queue.get_nowait()
-            except queue.Empty:
-                continue
-            if model_input is None: continue
-            simplify_arr = [1000] * ifm_converter.pose_size
-            if args.simplify >= 1:
-                simplify_arr = [200] * ifm_converter.pose_size
-                simplify_arr[ifm_converter.eye_wink_left_index] = 50
-                simplify_arr[ifm_converter.eye_wink_right_index] = 50
-                simplify_arr[ifm_converter.eye_happy_wink_left_index] = 50
-                simplify_arr[ifm_converter.eye_happy_wink_right_index] = 50
-                simplify_arr[ifm_converter.eye_surprised_left_index] = 30
-                simplify_arr[ifm_converter.eye_surprised_right_index] = 30
-                simplify_arr[ifm_converter.iris_rotation_x_index] = 25
-                simplify_arr[ifm_converter.iris_rotation_y_index] = 25
-                simplify_arr[ifm_converter.eye_raised_lower_eyelid_left_index] = 10
-                simplify_arr[ifm_converter.eye_raised_lower_eyelid_right_index] = 10
-                simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 5
-                simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 5
-                simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 5
-                simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 5
-            if args.simplify >= 2:
-                simplify_arr[ifm_converter.head_x_index] = 100
-                simplify_arr[ifm_converter.head_y_index] = 100
-                simplify_arr[ifm_converter.eye_surprised_left_index] = 10
-                simplify_arr[ifm_converter.eye_surprised_right_index] = 10
-                model_input[ifm_converter.eye_wink_left_index] += model_input[
-                    ifm_converter.eye_happy_wink_left_index]
-                model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
-                                                                           ifm_converter.eye_wink_left_index] / 2
-                model_input[ifm_converter.eye_wink_left_index] = model_input[
-                                                                     ifm_converter.eye_wink_left_index] / 2
-                model_input[ifm_converter.eye_wink_right_index] += model_input[
-                    ifm_converter.eye_happy_wink_right_index]
-                model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
-                                                                            ifm_converter.eye_wink_right_index] / 2
-                model_input[ifm_converter.eye_wink_right_index] = model_input[
-                                                                      ifm_converter.eye_wink_right_index] / 2
-
-                uosum = model_input[ifm_converter.mouth_uuu_index] + \
-                        model_input[ifm_converter.mouth_ooo_index]
-                model_input[ifm_converter.mouth_ooo_index] = uosum
-                model_input[ifm_converter.mouth_uuu_index] = 0
-                is_open = (model_input[ifm_converter.mouth_aaa_index] + model_input[
-                    ifm_converter.mouth_iii_index] + uosum) > 0
-                model_input[ifm_converter.mouth_lowered_corner_left_index] = 0
-                model_input[ifm_converter.mouth_lowered_corner_right_index] = 0
-                model_input[ifm_converter.mouth_raised_corner_left_index] = 0.5 if is_open else 0
-                model_input[ifm_converter.mouth_raised_corner_right_index] = 0.5 if is_open else 0
-                simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 0
-                simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 0
-                simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 0
-                simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 0
-            if args.simplify >= 3:
-                simplify_arr[ifm_converter.iris_rotation_x_index] = 20
-                simplify_arr[ifm_converter.iris_rotation_y_index] = 20
-                simplify_arr[ifm_converter.eye_wink_left_index] = 32
-                simplify_arr[ifm_converter.eye_wink_right_index] = 32
-                simplify_arr[ifm_converter.eye_happy_wink_left_index] = 32
-                simplify_arr[ifm_converter.eye_happy_wink_right_index] = 32
-            if args.simplify >= 4:
-                simplify_arr[ifm_converter.head_x_index] = 50
-                simplify_arr[ifm_converter.head_y_index] = 50
-                simplify_arr[ifm_converter.neck_z_index] = 100
-                model_input[ifm_converter.eye_raised_lower_eyelid_left_index] = 0
-                model_input[ifm_converter.eye_raised_lower_eyelid_right_index] = 0
-                simplify_arr[ifm_converter.iris_rotation_x_index] = 10
-                simplify_arr[ifm_converter.iris_rotation_y_index] = 10
-                simplify_arr[ifm_converter.eye_wink_left_index] = 24
-                simplify_arr[ifm_converter.eye_wink_right_index] = 24
-                simplify_arr[ifm_converter.eye_happy_wink_left_index] = 24
-                simplify_arr[ifm_converter.eye_happy_wink_right_index] = 24
-                simplify_arr[ifm_converter.eye_surprised_left_index] = 8
-                simplify_arr[ifm_converter.eye_surprised_right_index] = 8
-                model_input[ifm_converter.eye_wink_left_index] += model_input[
-                    ifm_converter.eye_wink_right_index]
-                model_input[ifm_converter.eye_wink_right_index] = model_input[
-                                                                      ifm_converter.eye_wink_left_index] / 2
-                model_input[ifm_converter.eye_wink_left_index] = model_input[
-                                                                     ifm_converter.eye_wink_left_index] / 2
-
-                model_input[ifm_converter.eye_surprised_left_index] += model_input[
-                    ifm_converter.eye_surprised_right_index]
-                model_input[ifm_converter.eye_surprised_right_index] = model_input[
-                                                                           ifm_converter.eye_surprised_left_index] / 2
-                model_input[ifm_converter.eye_surprised_left_index] = model_input[
-                                                                          ifm_converter.eye_surprised_left_index] / 2
-
-                model_input[ifm_converter.eye_happy_wink_left_index] += model_input[
-                    ifm_converter.eye_happy_wink_right_index]
-                model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
-                                                                            ifm_converter.eye_happy_wink_left_index] / 2
-                model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
-                                                                           ifm_converter.eye_happy_wink_left_index] / 2
-                model_input[ifm_converter.mouth_aaa_index] = min(
-                    model_input[ifm_converter.mouth_aaa_index] +
-                    model_input[ifm_converter.mouth_ooo_index] / 2 +
-                    model_input[ifm_converter.mouth_iii_index] / 2 +
-                    model_input[ifm_converter.mouth_uuu_index] / 2, 1
-                )
-                model_input[ifm_converter.mouth_ooo_index] = 0
-                model_input[ifm_converter.mouth_iii_index] = 0
-                model_input[ifm_converter.mouth_uuu_index] = 0
-            for i in range(4, args.simplify):
-                simplify_arr = [max(math.ceil(x * 0.8), 5) for x in simplify_arr]
-            for i in range(0, len(simplify_arr)):
-                if simplify_arr[i] > 0:
-                    model_input[i] = round(model_input[i] * simplify_arr[i]) / simplify_arr[i]
-            input_hash = hash(tuple(model_input))
-            cached = model_cache.get(input_hash)
-            tot += 1
+        pipeline = None
+        if args.pipeline and model is not None:
+            pipeline = PipelinedTalkingAnime3(model, on_output=self.pose_mailbox.wake)
+            print("Pipelined Inference Enabled")
+
+        # sequence number of the newest pose whose frame is in the ring, a frame finished by the pipeline after a
+        # newer pose was already published is only cached, so the ring never goes back in time
+        last_published_seq = -1
+
+        def output(input_key, output_image, seq=None):
+            # seq is the mailbox sequence number of a live pose, None for a pose that is only cached
+            nonlocal last_published_seq
+            if args.perf == 'model':
+                tic = time.perf_counter()
+            postprocessed_image = output_image[0].float()
+            if args.perf == 'model':
+                print("cpu()", (time.perf_counter() - tic) * 1000)
+                tic = time.perf_counter()
+            postprocessed_image = convert_linear_to_srgb((postprocessed_image + 1.0) / 2.0)
+            c, h, w = postprocessed_image.shape
+            postprocessed_image = 255.0 * torch.transpose(postprocessed_image.reshape(c, h * w), 0, 1).reshape(h, w,
+                                                                                                               c)
+            postprocessed_image = postprocessed_image.byte().detach().cpu().numpy()
+            if args.perf == 'model':
+                print("postprocess", (time.perf_counter() - tic) * 1000)
+                tic = time.perf_counter()
+
+            if seq is not None and seq > last_published_seq:
+                last_published_seq = seq
+                self.frame_ring.write(postprocessed_image)
+                if args.debug:
+                    self.gpu_fps_number.value = gpu_fps()
+            if disk_cache is not None:
+                disk_cache.put(input_key, postprocessed_image)
+            if args.max_cache_bytes > 0:
+                model_cache.put(input_key, postprocessed_image)
+                if pose_index is not None and input_key in model_cache:
+                    pose_index.add(input_key, input_key)
+
+        def render(input_key, model_input, seq=None):
             eyebrow_vector_c = [0.0] * 12
             mouth_eye_vector_c = [0.0] * 27
-            if cached is not None and hit_in_a_row < self.model_fps_number.value:
-                self.output_queue.put_nowait(cached)
-                model_cache.move_to_end(input_hash)
-                hit += 1
-                hit_in_a_row += 1
+            if args.perf == 'model':
+                tic = time.perf_counter()
+            if args.eyebrow:
+                for i in range(12):
+                    eyebrow_vector[0, i] = model_input[i]
+                    eyebrow_vector_c[i] = model_input[i]
+            for i in range(27):
+                mouth_eye_vector[0, i] = model_input[i + 12]
+                mouth_eye_vector_c[i] = model_input[i + 12]
+            for i in range(6):
+                pose_vector[0, i] = model_input[i + 27 + 12]
+            if model is None:
+                output(input_key, input_image, seq)
+            elif pipeline is not None:
+                # the stage workers hold on to the vectors, so they get their own copies
+                pipeline.submit((input_key, seq), input_image, mouth_eye_vector.clone(), pose_vector.clone(),
+                                eyebrow_vector.clone(), mouth_eye_vector_c, eyebrow_vector_c,
+                                self.gpu_cache_hit_ratio)
             else:
-                hit_in_a_row = 0
-                if args.perf == 'model':
-                    tic = time.perf_counter()
-                if args.eyebrow:
-                    for i in range(12):
-                        eyebrow_vector[0, i] = model_input[i]
-                        eyebrow_vector_c[i] = model_input[i]
-                for i in range(27):
-                    mouth_eye_vector[0, i] = model_input[i + 12]
-                    mouth_eye_vector_c[i] = model_input[i + 12]
-                for i in range(6):
-                    pose_vector[0, i] = model_input[i + 27 + 12]
-                if model is None:
-                    output_image = input_image
-                else:
-                    output_image = model(input_image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c,
-                                         eyebrow_vector_c,
-                                         self.gpu_cache_hit_ratio)
+                output_image = model(input_image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c,
+                                     eyebrow_vector_c,
+                                     self.gpu_cache_hit_ratio)
                 if args.perf == 'model':
                     torch.cuda.synchronize()
                     print("model", (time.perf_counter() - tic) * 1000)
-                    tic = time.perf_counter()
-                postprocessed_image = output_image[0].float()
-                if args.perf == 'model':
-                    print("cpu()", (time.perf_counter() - tic) * 1000)
-                    tic = time.perf_counter()
-                postprocessed_image = convert_linear_to_srgb((postprocessed_image + 1.0) / 2.0)
-                c, h, w = postprocessed_image.shape
-                postprocessed_image = 255.0 * torch.transpose(postprocessed_image.reshape(c, h * w), 0, 1).reshape(h, w,
-                                                                                                                   c)
-                postprocessed_image = postprocessed_image.byte().detach().cpu().numpy()
-                if args.perf == 'model':
-                    print("postprocess", (time.perf_counter() - tic) * 1000)
-                    tic = time.perf_counter()
-
-                self.output_queue.put_nowait(postprocessed_image)
+                output(input_key, output_image, seq)
+
+        def is_cached(model_input):
+            input_key = tuple(model_input)
+            if input_key in model_cache or (disk_cache is not None and input_key in disk_cache):
+                return True
+            if pose_index is not None and pose_index.query(model_input) is not None:
+                return True
+            return disk_index is not None and disk_index.query(model_input) is not None
+
+        prewarm_poses = []
+        if args.prewarm > 0 and model is not None and (args.max_cache_bytes > 0 or disk_cache is not None):
+            prewarm_poses = create_prewarm_poses(simplify_arr)
+            print("Cache Pre-warm Grid:", len(prewarm_poses), "poses")
+        prewarm_cursor = 0
+        prewarm_covered = 0
+        # the running coverage misses evictions, it is recounted over the whole grid every this many poses
+        prewarm_recount_every = 256
+        # the main loop publishes a pose every frame, so idle means the pose stopped changing for a while
+        prewarm_idle_seconds = 0.5
+        last_raw_pose = None
+        last_live_time = time.perf_counter()
+
+        def prewarm():
+            # render the next uncached grid pose without publishing it, one frame per call so live input
+            # never waits for more than a single render
+            nonlocal prewarm_cursor, prewarm_covered
+            rendered_key = None
+            while prewarm_cursor < len(prewarm_poses):
+                model_input = prewarm_poses[prewarm_cursor]
+                prewarm_cursor += 1
+                # a submitted pose is stored once the pipeline finishes it, it counts as covered right away
+                prewarm_covered += 1
+                if not is_cached(model_input):
+                    rendered_key = tuple(model_input)
+                    render(rendered_key, model_input)
+                    break
+            if prewarm_cursor % prewarm_recount_every == 0 or prewarm_cursor == len(prewarm_poses):
+                prewarm_covered = sum(1 for model_input in prewarm_poses[:prewarm_cursor]
+                                      if is_cached(model_input) or tuple(model_input) == rendered_key)
+            self.prewarm_progress.value = prewarm_cursor / len(prewarm_poses)
+            self.prewarm_coverage.value = prewarm_covered / len(prewarm_poses)
+            if prewarm_cursor == len(prewarm_poses):
+                print("Cache Pre-warm Finished: %.1f%% coverage" % (self.prewarm_coverage.value * 100))
+
+        pose_seq = 0
+        # the parent terminates this daemon process, the handler turns that into an exit that runs the finally
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                prewarm_pending = prewarm_cursor < len(prewarm_poses)
+                timeout = prewarm_idle_seconds / 10 if prewarm_pending else None
+                if timeout is None and disk_cache is not None and disk_cache.dirty > 0:
+                    timeout = disk_cache.flush_seconds
+                # the pipeline's editor stage wakes the mailbox whenever a frame is finished
+                pose = self.pose_mailbox.get(pose_seq, timeout=timeout)
+                if disk_cache is not None:
+                    disk_cache.flush_stale()
+                if pipeline is not None:
+                    completed = pipeline.completed()
+                    for (input_key, seq), output_image in completed:
+                        output(input_key, output_image, seq)
+                    if args.perf == 'model' and len(completed) > 0:
+                        print("occupancy", pipeline.occupancy(), "dropped", pipeline.dropped)
+                if pose is not None and prewarm_pending:
+                    if pose[1] == last_raw_pose:
+                        # the frame for this pose is already published
+                        pose_seq = pose[0]
+                        pose = None
+                    else:
+                        last_raw_pose = list(pose[1])
+                        last_live_time = time.perf_counter()
+                if pose is None:
+                    if prewarm_pending and time.perf_counter() - last_live_time >= prewarm_idle_seconds \
+                            and (pipeline is None or pipeline.pending() == 0):
+                        prewarm()
+                    continue
+                pose_seq, model_input = pose
+                simplify_model_input(model_input)
+                if args.cache_match == 'nearest':
+                    # reuse any cached pose within half a simplify step instead of snapping the pose to the step grid
+                    input_key = None
+                    match = pose_index.query(model_input)
+                    if match is not None:
+                        input_key, distance = match
+                    else:
+                        distance = 0.0
+                else:
+                    quantize_model_input(model_input, simplify_arr)
+                    input_key = tuple(model_input)
+                    distance = 0.0
+                cached = model_cache.get(input_key)
+                if cached is None and disk_cache is not None:
+                    disk_key = tuple(model_input)
+                    if disk_index is not None:
+                        match = disk_index.query(model_input)
+                        disk_key = None
+                        if match is not None:
+                            disk_key, distance = match
+                    cached = disk_cache.get(disk_key)
+                    if cached is not None:
+                        input_key = disk_key
+                        if args.max_cache_bytes > 0:
+                            model_cache.put(input_key, cached)
+                            if pose_index is not None and input_key in model_cache:
+                                pose_index.add(input_key, input_key)
+                tot += 1
+                if cached is not None and hit_in_a_row < self.model_fps_number.value:
+                    if pose_seq > last_published_seq:
+                        last_published_seq = pose_seq
+                        self.frame_ring.write(cached)
+                    hit += 1
+                    hit_distance += distance
+                    hit_in_a_row += 1
+                else:
+                    hit_in_a_row = 0
+                    render(tuple(model_input), model_input, pose_seq)
                 if args.debug:
-                    self.gpu_fps_number.value = gpu_fps()
-                if args.max_cache_len > 0:
-                    model_cache[input_hash] = postprocessed_image
-                    if len(model_cache) > args.max_cache_len:
-                        model_cache.popitem(last=False)
-            if args.debug:
-                self.model_fps_number.value = model_fps()
-                self.cache_hit_ratio.value = hit / tot
+                    self.model_fps_number.value = model_fps()
+                    self.cache_hit_ratio.value = hit / tot
+                    if hit > 0:
+                        self.cache_hit_distance.value = hit_distance / hit
+                    self.cache_resident_mb.value = model_cache.resident_bytes / 1048576
+                    if args.cache_compress:
+                        cache_stats = model_cache.stats()
+                        self.cache_entries_per_mb.value = cache_stats['entries_per_mb']
+                        self.cache_decompress_ms.value = cache_stats['decompress_ms']
+        finally:
+            if disk_cache is not None:
+                disk_cache.close()
+            # the parent owns the shared memory and unlinks it, this process only detaches
+            self.frame_ring.close()
+            self.pose_mailbox.close()
 
 
 @torch.no_grad()
 def main():
-    img = Image.open(f"data/images/{args.character}.png")
-    img = img.convert('RGBA')
-    IMG_WIDTH = 512
-    wRatio = img.size[0] / IMG_WIDTH
-    img = img.resize((IMG_WIDTH, int(img.size[1] / wRatio)))
-    for i, px in enumerate(img.getdata()):
-        if px[3] <= 0:
-            y = i // IMG_WIDTH
-            x = i % IMG_WIDTH
-            img.putpixel((x, y), (0, 0, 0, 0))
-    input_image = preprocessing_image(img.crop((0, 0, IMG_WIDTH, IMG_WIDTH)))
-    if args.model.endswith('half'):
-        input_image = torch.from_numpy(input_image).half() * 2.0 - 1
-    else:
-        input_image = torch.from_numpy(input_image).float() * 2.0 - 1
-    input_image = input_image.unsqueeze(0)
-    extra_image = None
-    if img.size[1] > IMG_WIDTH:
-        extra_image = np.array(img.crop((0, IMG_WIDTH, img.size[0], img.size[1])))
+    with startup_report.step('import cv2'):
+        import cv2
+
+    with startup_report.step('load character image'):
+        image_file_name = f"data/images/{args.character}.png"
+        IMG_WIDTH = 512
+        image_cache = None
+        cached_images = None
+        if args.image_cache_dir:
+            image_cache = PreprocessedImageCache(args.image_cache_dir)
+            # 'main2': the first version also stored an empty 'extra' array, which cannot be memory mapped
+            image_cache_key = image_cache.key(image_file_name, (IMG_WIDTH, 0),
+                                              np.float16 if args.model.endswith('half') else np.float32, 'main2')
+            cached_images = image_cache.get(image_cache_key, ['input'])
+        if cached_images is not None:
+            input_image = torch.from_numpy(cached_images['input'])
+            # 'extra' is only stored for images taller than they are wide, and always before 'input'
+            cached_extra = image_cache.get(image_cache_key, ['extra'])
+            extra_image = cached_extra['extra'] if cached_extra is not None else None
+        else:
+            img = Image.open(image_file_name)
+            img = img.convert('RGBA')
+            wRatio = img.size[0] / IMG_WIDTH
+            img = img.resize((IMG_WIDTH, int(img.size[1] / wRatio)))
+            img = Image.fromarray(clear_transparent_pixels(np.asarray(img)), 'RGBA')
+            input_image = preprocessing_image(img.crop((0, 0, IMG_WIDTH, IMG_WIDTH)))
+            if args.model.endswith('half'):
+                input_image = torch.from_numpy(input_image).half() * 2.0 - 1
+            else:
+                input_image = torch.from_numpy(input_image).float() * 2.0 - 1
+            input_image = input_image.unsqueeze(0)
+            extra_image = None
+            if img.size[1] > IMG_WIDTH:
+                extra_image = np.array(img.crop((0, IMG_WIDTH, img.size[0], img.size[1])))
+            if image_cache is not None:
+                # 'input' is written last, a hit on it means 'extra' is complete if the image has one
+                cached_images = {} if extra_image is None else {'extra': extra_image}
+                cached_images['input'] = input_image.numpy()
+                image_cache.put(image_cache_key, cached_images)
 
     print("Character Image Loaded:", args.character)
     cap = None
 
     output_fps = FPS()
 
-    if not args.debug_input:
-
-        if args.ifm is not None:
-            client_process = IFMClientProcess()
-            client_process.daemon = True
-            client_process.start()
-            print("iFacialMocap Service Running:", args.ifm)
+    with startup_report.step('start input'):
+        if not args.debug_input:
 
-        elif args.osf is not None:
-            client_process = OSFClientProcess()
-            client_process.daemon = True
-            client_process.start()
-            print("OpenSeeFace Service Running:", args.osf)
-
-        elif args.mouse_input is not None:
-            client_process = MouseClientProcess()
-            client_process.daemon = True
-            client_process.start()
-            print("Mouse Input Running")
-
-        else:
+            if args.ifm is not None:
+                client_process = IFMClientProcess()
+                client_process.daemon = True
+                client_process.start()
+                print("iFacialMocap Service Running:", args.ifm)
+
+            elif args.osf is not None:
+                client_process = OSFClientProcess()
+                client_process.daemon = True
+                client_process.start()
+                print("OpenSeeFace Service Running:", args.osf)
+
+            elif args.mouse_input is not None:
+                client_process = MouseClientProcess()
+                client_process.daemon = True
+                client_process.start()
+                print("Mouse Input Running")
 
-            if args.input == 'cam':
-                cap = cv2.VideoCapture(0)
-                ret, frame = cap.read()
-                if ret is None:
-                    raise Exception("Can't find Camera")
             else:
-                cap = cv2.VideoCapture(args.input)
-                frame_count = 0
-                os.makedirs(os.path.join('dst', args.character, args.output_dir), exist_ok=True)
-                print("Webcam Input Running")
 
-    facemesh = mp.solutions.face_mesh.FaceMesh(refine_landmarks=True)
+                with startup_report.step('import mediapipe'):
+                    import mediapipe as mp
+                    from pose import get_pose
+                with startup_report.step('init face mesh'):
+                    facemesh = mp.solutions.face_mesh.FaceMesh(refine_landmarks=True)
+
+                if args.input == 'cam':
+                    cap = cv2.VideoCapture(0)
+                    ret, frame = cap.read()
+                    if ret is None:
+                        raise Exception("Can't find Camera")
+                else:
+                    cap = cv2.VideoCapture(args.input)
+                    frame_count = 0
+                    os.makedirs(os.path.join('dst', args.character, args.output_dir), exist_ok=True)
+                    print("Webcam Input Running")
 
     if args.output_webcam:
         cam_scale = 1
@@ -592,31 +854,37 @@ def main():
             cam_scale = 2
         if args.alpha_split:
             cam_width_scale = 2
-        cam = pyvirtualcam.Camera(width=args.output_w * cam_scale * cam_width_scale, height=args.output_h * cam_scale,
-                                  fps=60,
-                                  backend=args.output_webcam,
-                                  fmt=
-                                  {'unitycapture': pyvirtualcam.PixelFormat.RGBA, 'obs': pyvirtualcam.PixelFormat.RGB}[
-                                      args.output_webcam])
+        with startup_report.step('init virtual camera'):
+            import pyvirtualcam
+            cam = pyvirtualcam.Camera(width=args.output_w * cam_scale * cam_width_scale,
+                                      height=args.output_h * cam_scale,
+                                      fps=60,
+                                      backend=args.output_webcam,
+                                      fmt=
+                                      {'unitycapture': pyvirtualcam.PixelFormat.RGBA,
+                                       'obs': pyvirtualcam.PixelFormat.RGB}[
+                                          args.output_webcam])
         print(f'Using virtual camera: {cam.device}')
 
     a = None
 
     if args.anime4k:
-        parameters = ac.Parameters()
-        # enable HDN for ACNet
-        parameters.HDN = True
-
-        # a = ac.AC(
-        #     managerList=ac.ManagerList([ac.CUDAManager(dID=0)]),
-        #     type=ac.ProcessorType.Cuda_ACNet,
-        # )
-
-        a = ac.AC(
-            managerList=ac.ManagerList([ac.OpenCLACNetManager(pID=0, dID=0)]),
-            type=ac.ProcessorType.OpenCL_ACNet,
-        )
-        a.set_arguments(parameters)
+        with startup_report.step('init anime4k'):
+            from pyanime4k import ac
+            parameters = ac.Parameters()
+            # enable HDN for ACNet
+            parameters.HDN = True
+
+            # a = ac.AC(
+            #     managerList=ac.ManagerList([ac.CUDAManager(dID=0)]),
+            #     type=ac.ProcessorType.Cuda_ACNet,
+            # )
+
+            a = ac.AC(
+                managerList=ac.ManagerList([ac.OpenCLACNetManager(pID=0, dID=0)]),
+                type=ac.ProcessorType.OpenCL_ACNet,
+            )
+            a.set_arguments(parameters)
         print("Anime4K Loaded")
 
     position_vector = [0, 0, 0, 1]
@@ -638,12 +906,14 @@ def main():
         'z_angle': 0,
     }
 
-    model_output = None
-    model_process = ModelClientProcess(input_image)
-    model_process.daemon = True
-    model_process.start()
+    with startup_report.step('start model process'):
+        model_process = ModelClientProcess(input_image)
+        model_process.daemon = True
+        model_process.start()
 
     print("Ready. Close this console to exit.")
+    if args.startup_report:
+        print(startup_report.format())
 
     while True:
         # ret, frame = cap.read()
@@ -855,24 +1125,14 @@ def main():
         model_input_arr.extend(mouth_eye_vector_c)
         model_input_arr.extend(pose_vector_c)
 
-        model_process.input_queue.put_nowait(model_input_arr)
+        model_process.pose_mailbox.put(model_input_arr)
 
-        has_model_output = 0
-        try:
-            new_model_output = model_output
-            while not model_process.output_queue.empty():
-                has_model_output += 1
-                new_model_output = model_process.output_queue.get_nowait()
-            model_output = new_model_output
-        except queue.Empty:
-            pass
-        if model_output is None:
+        latest_frame = model_process.frame_ring.latest()
+        if latest_frame is None:
             time.sleep(1)
             continue
-        # print(has_model_output)
-        # should_output=should_output or has_model_output
-        # if not should_output:
-        #     continue
+        # zero-copy view into the shared frame ring, only valid until the model process wraps around to its slot
+        frame_seq, model_output = latest_frame
 
         postprocessed_image = model_output
 
@@ -903,6 +1163,8 @@ def main():
             postprocessed_image,
             rm,
             (args.output_w, args.output_h))
+        if not model_process.frame_ring.is_intact(frame_seq):
+            continue
 
         if args.perf == 'main':
             print("extendmovement", (time.perf_counter() - tic) * 1000)
@@ -938,7 +1200,7 @@ def main():
             # output_frame = np.concatenate([debug_image, resized_frame], axis=1)
             cv2.putText(output_frame, str('OUT_FPS:%.1f' % output_fps_number), (0, 16), cv2.FONT_HERSHEY_PLAIN, 1,
                         (0, 255, 0), 1)
-            if args.max_cache_len > 0:
+            if args.max_cache_bytes > 0:
                 cv2.putText(output_frame, str(
                     'GPU_FPS:%.1f / %.1f' % (model_process.model_fps_number.value, model_process.gpu_fps_number.value)),
                             (0, 32),
@@ -951,14 +1213,26 @@ def main():
             if args.ifm is not None:
                 cv2.putText(output_frame, str('IFM_FPS:%.1f' % client_process.ifm_fps_number.value), (0, 48),
                             cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
-            if args.max_cache_len > 0:
-                cv2.putText(output_frame, str('MEMCACHED:%.1f%%' % (model_process.cache_hit_ratio.value * 100)),
+            if args.max_cache_bytes > 0:
+                cv2.putText(output_frame, str('MEMCACHED:%.1f%% D:%.2f %.0fMB' % (
+                    model_process.cache_hit_ratio.value * 100, model_process.cache_hit_distance.value,
+                    model_process.cache_resident_mb.value)),
                             (0, 64),
                             cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
-            if args.max_gpu_cache_len > 0:
+            if args.max_gpu_cache_bytes > 0:
                 cv2.putText(output_frame, str('GPUCACHED:%.1f%%' % (model_process.gpu_cache_hit_ratio.value * 100)),
                             (0, 80),
                             cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
+            if args.max_cache_bytes > 0 and args.cache_compress:
+                cv2.putText(output_frame, str('ZCACHE:%.1f/MB %.2fms' % (model_process.cache_entries_per_mb.value,
+                                                                        model_process.cache_decompress_ms.value)),
+                            (0, 96),
+                            cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
+            if args.prewarm > 0:
+                cv2.putText(output_frame, str('PREWARM:%.1f%% COVERED:%.1f%%' % (
+                    model_process.prewarm_progress.value * 100, model_process.prewarm_coverage.value * 100)),
+                            (0, 112),
+                            cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
             cv2.imshow("frame", output_frame)
             # cv2.imshow("camera", debug_image)
             cv2.waitKey(1)
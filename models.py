@@ -1,5 +1,8 @@
+import queue
+import threading
 import time
 
+import torch
 import torch.nn as nn
 
 import tha2.poser.modes.mode_20
@@ -8,10 +11,11 @@ import tha3.poser.modes.separable_float
 import tha3.poser.modes.standard_half
 import tha3.poser.modes.separable_half
 from torch.nn.functional import interpolate
+from tha3.poser.module_loader import load_modules
 
 from args import args
 
-from collections import OrderedDict
+from cache import FrameCache
 
 
 class TalkingAnimeLight(nn.Module):
@@ -20,7 +24,7 @@ class TalkingAnimeLight(nn.Module):
         self.face_morpher = tha2.poser.modes.mode_20.load_face_morpher('pretrained/face_morpher.pt')
         self.two_algo_face_rotator = tha2.poser.modes.mode_20.load_face_rotater('pretrained/two_algo_face_rotator.pt')
         self.combiner = tha2.poser.modes.mode_20.load_combiner('pretrained/combiner.pt')
-        self.face_cache = OrderedDict()
+        self.face_cache = FrameCache(args.max_gpu_cache_bytes, args.cache_policy)
         self.tot = 0
         self.hit = 0
 
@@ -33,13 +37,10 @@ class TalkingAnimeLight(nn.Module):
         self.tot += 1
         if cached is None:
             mouth_eye_morp_image = self.face_morpher(image[:, :, 32:224, 32:224], mouth_eye_vector)
-            self.face_cache[input_hash] = mouth_eye_morp_image.detach()
-            if len(self.face_cache) > args.max_gpu_cache_len:
-                self.face_cache.popitem(last=False)
+            self.face_cache.put(input_hash, mouth_eye_morp_image.detach())
         else:
             self.hit += 1
             mouth_eye_morp_image = cached
-            self.face_cache.move_to_end(input_hash)
         if args.debug and ratio is not None:
             ratio.value = self.hit / self.tot
         if args.perf == 'model':
@@ -60,63 +61,57 @@ class TalkingAnimeLight(nn.Module):
 class TalkingAnime3(nn.Module):
     def __init__(self):
         super(TalkingAnime3, self).__init__()
-        if args.model == "standard_float":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_float.load_eyebrow_decomposer(
-                    'data/models/standard_float/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_float.load_eyebrow_morphing_combiner(
-                    'data/models/standard_float/eyebrow_morphing_combiner.pt')
-            self.face_morpher = tha3.poser.modes.standard_float.load_face_morpher(
-                'data/models/standard_float/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_float.load_two_algo_generator(
-                'data/models/standard_float/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.standard_float.load_editor('data/models/standard_float/editor.pt')
-        elif args.model == "standard_half":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_half.load_eyebrow_decomposer(
-                    'data/models/standard_half/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_half.load_eyebrow_morphing_combiner(
-                    'data/models/standard_half/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.standard_half.load_face_morpher(
-                'data/models/standard_half/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_half.load_two_algo_generator(
-                'data/models/standard_half/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.standard_half.load_editor('data/models/standard_half/editor.pt')
-        elif args.model == "separable_float":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.separable_float.load_eyebrow_decomposer(
-                    'data/models/separable_float/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.separable_float.load_eyebrow_morphing_combiner(
-                    'data/models/separable_float/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.separable_float.load_face_morpher(
-                'data/models/separable_float/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.separable_float.load_two_algo_generator(
-                'data/models/separable_float/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.separable_float.load_editor('data/models/separable_float/editor.pt')
-        elif args.model == "separable_half":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.separable_half.load_eyebrow_decomposer(
-                    'data/models/separable_half/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.separable_half.load_eyebrow_morphing_combiner(
-                    'data/models/separable_half/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.separable_half.load_face_morpher(
-                'data/models/separable_half/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.separable_half.load_two_algo_generator(
-                'data/models/separable_half/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.separable_half.load_editor('data/models/separable_half/editor.pt')
-        else:
+        modes = {
+            "standard_float": tha3.poser.modes.standard_float,
+            "standard_half": tha3.poser.modes.standard_half,
+            "separable_float": tha3.poser.modes.separable_float,
+            "separable_half": tha3.poser.modes.separable_half,
+        }
+        if args.model not in modes:
             raise RuntimeError("Invalid model: '%s'" % args.model)
-        self.face_cache = OrderedDict()
+        mode = modes[args.model]
+        dir = 'data/models/' + args.model
+        loaders = {
+            'face_morpher': lambda: mode.load_face_morpher(dir + '/face_morpher.pt'),
+            'two_algo_face_body_rotator': lambda: mode.load_two_algo_generator(dir + '/two_algo_face_body_rotator.pt'),
+            'editor': lambda: mode.load_editor(dir + '/editor.pt'),
+        }
+        if args.eyebrow:
+            loaders['eyebrow_decomposer'] = lambda: mode.load_eyebrow_decomposer(dir + '/eyebrow_decomposer.pt')
+            loaders['eyebrow_morphing_combiner'] = lambda: mode.load_eyebrow_morphing_combiner(
+                dir + '/eyebrow_morphing_combiner.pt')
+        # the networks load concurrently without weight init, see load_modules
+        modules, self.load_times = load_modules(loaders)
+        for name, module in modules.items():
+            setattr(self, name, module)
+        self.face_cache = FrameCache(args.max_gpu_cache_bytes, args.cache_policy)
         self.tot = 0
         self.hit = 0
+        self.character_image = None
+        self.face_image = None
+        self.eyebrow_layers = None
 
-    def forward(self, image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
-                ratio=None):
-        if args.perf == 'model':
-            tic = time.perf_counter()
+    def set_character(self, image):
+        """
+        precompute the pose independent intermediates of a character image, they are reused by every frame
+        until a different image tensor is passed in
+        Args:
+            image (torch.Tensor): character image of shape (1, 4, 512, 512)
+        """
+        self.character_image = image
+        self.face_image = image[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+        self.eyebrow_layers = None
+        if args.eyebrow:
+            with torch.no_grad():
+                eyebrow_layers = self.eyebrow_decomposer(image[:, :, 64:192, 64 + 128:192 + 128].clone())
+            # only the background layer and the eyebrow layer feed the morphing combiner
+            self.eyebrow_layers = (eyebrow_layers[3].detach(), eyebrow_layers[0].detach())
+        # morphed faces of the previous character are stale
+        self.face_cache = FrameCache(args.max_gpu_cache_bytes, args.cache_policy)
+
+    def morph_face(self, image, mouth_eye_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c, ratio=None):
+        if image is not self.character_image:
+            self.set_character(image)
         x = image.clone()
         if args.eyebrow:
             input_hash = hash(tuple(eyebrow_vector_c + mouth_eye_vector_c))
@@ -125,41 +120,155 @@ class TalkingAnime3(nn.Module):
         cached = self.face_cache.get(input_hash)
         self.tot += 1
         if cached is None:
-            face_image = x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+            face_image = self.face_image
             if args.eyebrow:
-                eyebrow_morp_image = self.eyebrow_decomposer(x[:, :, 64:192, 64 + 128:192 + 128].clone())
-                eyebrow_morp_image = \
-                self.eyebrow_morphing_combiner(eyebrow_morp_image[3], eyebrow_morp_image[0], eyebrow_vector)[2]
+                eyebrow_morp_image = self.eyebrow_morphing_combiner(self.eyebrow_layers[0], self.eyebrow_layers[1],
+                                                                    eyebrow_vector)[2]
+                face_image = face_image.clone()
                 face_image[:, :, 32:32 + 128, 32:32 + 128] = eyebrow_morp_image
             mouth_eye_morp_image = self.face_morpher(face_image, mouth_eye_vector)[0]
-            self.face_cache[input_hash] = mouth_eye_morp_image.detach()
-            if len(self.face_cache) > args.max_gpu_cache_len:
-                self.face_cache.popitem(last=False)
+            self.face_cache.put(input_hash, mouth_eye_morp_image.detach())
         else:
             self.hit += 1
             mouth_eye_morp_image = cached
-            self.face_cache.move_to_end(input_hash)
         if args.debug and ratio is not None:
             ratio.value = self.hit / self.tot
+        x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)] = mouth_eye_morp_image
+        return x
+
+    def rotate(self, x, pose_vector):
+        x_half = interpolate(x, size=(256, 256), mode='bilinear', align_corners=False)
+        return self.two_algo_face_body_rotator(x_half, pose_vector)
+
+    def edit(self, x, rotate_image, pose_vector):
+        return self.editor(x,
+                           interpolate(rotate_image[1], size=(512, 512), mode='bilinear', align_corners=False),
+                           interpolate(rotate_image[2], size=(512, 512), mode='bilinear', align_corners=False),
+                           pose_vector)[0]
+
+    def forward(self, image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
+                ratio=None):
+        if args.perf == 'model':
+            tic = time.perf_counter()
+        x = self.morph_face(image, mouth_eye_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c, ratio)
         if args.perf == 'model':
             print(" - face_morpher", (time.perf_counter() - tic) * 1000)
             tic = time.perf_counter()
-        x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)] = mouth_eye_morp_image
-        x_half = interpolate(x, size=(256, 256), mode='bilinear', align_corners=False)
-        rotate_image = self.two_algo_face_body_rotator(x_half, pose_vector)
+        rotate_image = self.rotate(x, pose_vector)
         if args.perf == 'model':
             print(" - rotator", (time.perf_counter() - tic) * 1000)
             tic = time.perf_counter()
-        output_image = self.editor(x,
-                                   interpolate(rotate_image[1], size=(512, 512), mode='bilinear', align_corners=False),
-                                   interpolate(rotate_image[2], size=(512, 512), mode='bilinear', align_corners=False),
-                                   pose_vector)[0]
+        output_image = self.edit(x, rotate_image, pose_vector)
         if args.perf == 'model':
             print(" - editor", (time.perf_counter() - tic) * 1000)
             tic = time.perf_counter()
         return output_image
 
 
+class PipelinedTalkingAnime3:
+    """
+    runs the face morpher, rotator and editor stages of a TalkingAnime3 in their own worker threads
+
+    stages are connected by bounded hand-off queues, so frame N+1 can enter the face morpher while frame N
+    is still in the editor. every stage is a single FIFO worker, which keeps frames in submission order.
+    the entry slot holds one frame, a newer submit replaces a frame the face morpher has not picked up yet.
+    """
+    STAGE_NAMES = ['face_morpher', 'rotator', 'editor']
+
+    def __init__(self, model, handoff_size=1, on_output=None):
+        self.model = model
+        self.on_output = on_output
+        self.entry = queue.Queue(maxsize=1)
+        self.handoffs = [queue.Queue(maxsize=handoff_size), queue.Queue(maxsize=handoff_size)]
+        self.results = queue.Queue()
+        self.busy_time = [0.0] * len(self.STAGE_NAMES)
+        self.start_time = time.perf_counter()
+        self.submitted = 0
+        self.collected = 0
+        self.dropped = 0
+        stages = [
+            (self.stage_face_morpher, self.entry, self.handoffs[0]),
+            (self.stage_rotator, self.handoffs[0], self.handoffs[1]),
+            (self.stage_editor, self.handoffs[1], self.results),
+        ]
+        for index, (work, source, sink) in enumerate(stages):
+            thread = threading.Thread(target=self.run_stage, args=(index, work, source, sink),
+                                      name=self.STAGE_NAMES[index], daemon=True)
+            thread.start()
+
+    def run_stage(self, index, work, source, sink):
+        # grad mode is thread local, the caller's torch.no_grad() does not reach the workers
+        with torch.no_grad():
+            while True:
+                tag, payload = source.get()
+                tic = time.perf_counter()
+                payload = work(*payload)
+                self.busy_time[index] += time.perf_counter() - tic
+                sink.put((tag, payload))
+                if sink is self.results and self.on_output is not None:
+                    self.on_output()
+
+    def stage_face_morpher(self, image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c,
+                           eyebrow_vector_c, ratio):
+        x = self.model.morph_face(image, mouth_eye_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
+                                  ratio)
+        return x, pose_vector
+
+    def stage_rotator(self, x, pose_vector):
+        return x, self.model.rotate(x, pose_vector), pose_vector
+
+    def stage_editor(self, x, rotate_image, pose_vector):
+        return self.model.edit(x, rotate_image, pose_vector)
+
+    def submit(self, tag, image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
+               ratio=None):
+        """
+        queue a frame at the pipeline entry, tensors must not be modified by the caller afterwards
+        the tag is handed back together with the output image by completed()
+        """
+        item = (tag, (image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
+                      ratio))
+        self.submitted += 1
+        while True:
+            try:
+                self.entry.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.entry.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def completed(self):
+        """
+        collect the frames that left the editor since the last call, in submission order
+        Returns:
+            list of (tag, output image)
+        """
+        outputs = []
+        try:
+            while True:
+                outputs.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+        self.collected += len(outputs)
+        return outputs
+
+    def pending(self):
+        """
+        number of submitted frames that were neither dropped nor collected yet
+        """
+        return self.submitted - self.dropped - self.collected
+
+    def occupancy(self):
+        """
+        fraction of wall time each stage spent working since the pipeline started
+        """
+        elapsed = time.perf_counter() - self.start_time
+        return {name: busy / elapsed for name, busy in zip(self.STAGE_NAMES, self.busy_time)}
+
+
 class TalkingAnime(nn.Module):
     def __init__(self):
         super(TalkingAnime, self).__init__()
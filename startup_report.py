@@ -0,0 +1,38 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """
+    wall time of every import and init step of a process start
+
+    steps are timed with `with report.step(name):` and listed in the order they ran. a nested step is
+    indented under its parent and its time is included in the parent's.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = []
+        self.depth = 0
+
+    @contextmanager
+    def step(self, name):
+        index = len(self.steps)
+        self.steps.append([name, self.depth, 0.0])
+        self.depth += 1
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[index][2] = time.perf_counter() - tic
+            self.depth -= 1
+
+    def format(self, title="Startup"):
+        total = time.perf_counter() - self.start
+        lines = ["%s time %.0f ms" % (title, total * 1000)]
+        for name, depth, seconds in self.steps:
+            lines.append("  %s%-*s %8.1f ms" % ('  ' * depth, 36 - 2 * depth, name, seconds * 1000))
+        return "\n".join(lines)
+
+
+startup_report = StartupReport()
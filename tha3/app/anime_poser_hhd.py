@@ -15,11 +15,17 @@ import math
 import time
 import json
 import shutil
+import threading
 
+from cache import FrameCache
+from tha3.app.parameter_store import ParameterStore
+from tha3.app.render_timeline import MORPH_LABLE_CATEGORIES, evaluate_timeline_poses
+from tha3.app.render_worker import RenderWorker
+from tha3.image_cache import PreprocessedImageCache, load_character_image
 from tha3.poser.modes.load_poser import load_poser
 from tha3.poser.poser import Poser, PoseParameterCategory, PoseParameterGroup
 from tha3.util import extract_pytorch_image_from_filelike, rgba_to_numpy_image, grid_change_to_numpy_image, \
-    rgb_to_numpy_image, resize_PIL_image, extract_PIL_image_from_filelike, extract_pytorch_image_from_PIL_image
+    rgb_to_numpy_image
 
 # 多个slider的集合类
 class MorphCategoryControlPanel(wx.Panel):
@@ -73,6 +79,7 @@ class MorphCategoryControlPanel(wx.Panel):
         choice = self.choice
         self.data.set_morph_control_panel_parame(slider,choice)
         self.data.update_timeline_data_map()
+        main_frame.botton_timeline_panel.RefreshKeyColumn(self.data.get_now_key_value()) # 显示新的关键点
 
     def update_ui(self):
         param_group = self.param_groups[self.choice.GetSelection()]
@@ -154,6 +161,7 @@ class SimpleParamGroupsControlPanel(wx.Panel):
         slider = event.GetEventObject()
         self.data.set_non_morph_control_panel_parame(slider)
         self.data.update_timeline_data_map()
+        main_frame.botton_timeline_panel.RefreshKeyColumn(self.data.get_now_key_value()) # 显示新的关键点
 
     # 将slider中的param赋值到pose中
     def set_param_value(self, pose: List[float]):
@@ -222,6 +230,8 @@ class TimelnePanel(wx.Panel):
         self.point_selected_color = "green"
         self.data = data_map
         self.item_list = item_list
+        self.background_bitmap = None # 刻度和标签线的缓存图，只绘制一次
+        self.cursor_x = None # 上一次绘制的游标线位置
 
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.SetSizer(self.sizer)
@@ -250,12 +260,15 @@ class TimelnePanel(wx.Panel):
         self.sizer.Add(self.timeline_draw_panel,0)
         self.sizer.Fit(self)
 
-    # 时间轴面板绘制回调
-    def OnPaint(self, event):
-        self.timeline_draw_panel_dc = wx.PaintDC(self.timeline_draw_panel)
-        self.timeline_draw_panel_dc.SetPen(wx.Pen("black", 1))
-        self.timeline_draw_panel_dc.SetTextForeground("gray")
-        self.timeline_draw_panel_dc.SetFont(wx.Font(5, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
+    # 绘制时间轴的背景，刻度和标签线不随数据变化，绘制到缓存图中
+    def build_background(self):
+        self.background_bitmap = wx.Bitmap(self.timeline_width, self.timeline_height)
+        dc = wx.MemoryDC(self.background_bitmap)
+        dc.SetBackground(wx.Brush(self.timeline_draw_panel.GetBackgroundColour()))
+        dc.Clear()
+        dc.SetPen(wx.Pen("black", 1))
+        dc.SetTextForeground("gray")
+        dc.SetFont(wx.Font(5, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
         tick_interval = math.ceil((self.timeline_width-self.timeline_gap*2)/self.frame_num)
         count = 9
         num = 10
@@ -267,21 +280,36 @@ class TimelnePanel(wx.Panel):
             if count-num==0:
                 count=0
                 height = line_height*2
-                self.timeline_draw_panel_dc.DrawText(str(i),x-2,height+1)
-            self.timeline_draw_panel_dc.DrawLine(x,0,x,height)
+                dc.DrawText(str(i),x-2,height+1)
+            dc.DrawLine(x,0,x,height)
         
         first_lable_line_y = self.lable_gap+self.line_gap
-        self.timeline_draw_panel_dc.SetPen(wx.Pen("blue",1))
-        self.timeline_draw_panel_dc.DrawLine(0,first_lable_line_y,self.timeline_width,first_lable_line_y)
+        dc.SetPen(wx.Pen("blue",1))
+        dc.DrawLine(0,first_lable_line_y,self.timeline_width,first_lable_line_y)
         for i in range(self.lable_len-1):
             y = first_lable_line_y+self.min_line_gap*(i+1)*2+i+self.line_gap_delta
-            self.timeline_draw_panel_dc.DrawLine(0,y,self.timeline_width,y)
+            dc.DrawLine(0,y,self.timeline_width,y)
+        dc.SelectObject(wx.NullBitmap)
+
+    # 时间轴面板绘制回调
+    def OnPaint(self, event):
+        self.timeline_draw_panel_dc = wx.PaintDC(self.timeline_draw_panel)
+        if self.background_bitmap is None:
+            self.build_background()
+        self.timeline_draw_panel_dc.DrawBitmap(self.background_bitmap, 0, 0)
         
-        # 绘制标记点
+        # 绘制标记点，只绘制需要重绘区域内的帧
         if bool(self.data.parameter_map):
+            box = self.timeline_draw_panel.GetUpdateRegion().GetBox()
+            width = self.timeline_width-self.timeline_gap*2
+            begin_key = math.floor((box.GetLeft()-self.timeline_gap-self.point_selected_size)*self.data.frame_num/width)
+            end_key = math.ceil((box.GetRight()-self.timeline_gap+self.point_selected_size)*self.data.frame_num/width)
             
             for key,value in self.data.parameter_map.items():
-                for k in self.data.parameter_map[key]:
+                if key < begin_key or key > end_key:
+                    continue
+                x = self.timeline_slider_num2x(int(key))
+                for k in value:
                     if (key,k) in self.data.selected_pointes:
                         self.timeline_draw_panel_dc.SetPen(wx.Pen(self.point_selected_color, self.point_selected_size))
                         self.timeline_draw_panel_dc.SetBrush(wx.Brush(self.point_selected_color))
@@ -289,7 +317,6 @@ class TimelnePanel(wx.Panel):
                         self.timeline_draw_panel_dc.SetPen(wx.Pen(self.point_nomal_color, self.point_nomal_size))
                         self.timeline_draw_panel_dc.SetBrush(wx.Brush(self.point_nomal_color))
 
-                    x = self.timeline_slider_num2x(int(key))
                     y = self.data.find_lable_y(k)
                     self.DrawMarkPoint(x,y)
 
@@ -298,6 +325,24 @@ class TimelnePanel(wx.Panel):
         self.timeline_draw_panel_dc.SetPen(wx.Pen("red",1))
         self.DrawCursorLine(slider_num)
 
+    # 只重绘某一帧关键点所在的一列
+    def RefreshKeyColumn(self,key):
+        x = self.timeline_slider_num2x(key)
+        margin = self.point_selected_size+1
+        self.timeline_draw_panel.RefreshRect(wx.Rect(x-margin, 0, margin*2+1, self.timeline_height))
+
+    # 只重绘游标线所在的区域
+    def RefreshCursorLine(self):
+        x = self.timeline_slider_num2x(self.timeline_slider.GetValue())
+        if x == self.cursor_x:
+            return
+        # 标记点会压到游标线上，重绘区域包含标记点的半径
+        margin = self.point_selected_size+1
+        if self.cursor_x is not None:
+            self.timeline_draw_panel.RefreshRect(wx.Rect(self.cursor_x-margin, 0, margin*2+1, self.timeline_height))
+        self.timeline_draw_panel.RefreshRect(wx.Rect(x-margin, 0, margin*2+1, self.timeline_height))
+        self.cursor_x = x
+
     # slider值换算成坐标
     def timeline_slider_num2x(self,slider_num):
         position = slider_num/self.data.frame_num
@@ -306,6 +351,7 @@ class TimelnePanel(wx.Panel):
     # 绘制游标线函数
     def DrawCursorLine(self,slider_num):
         x = self.timeline_slider_num2x(slider_num)
+        self.cursor_x = x
         self.timeline_draw_panel_dc.DrawLine(x,0,x,self.timeline_height)
 
     # 绘制标记点函数
@@ -318,13 +364,16 @@ class TimelnePanel(wx.Panel):
 
     # 滑动滑块的回调函数
     def OnSlided(self, event):
-        key = self.GetTimelineValue()
+        self.MoveCursor(self.GetTimelineValue())
+        main_frame.slider_event_flage = True
+
+    # 把游标移动到某一帧，同步控制面板的slider和时间显示
+    def MoveCursor(self, key):
+        self.timeline_slider.SetValue(key)
         self.data.set_now_key_value(key)
         self.SetAllSliderValue()
         self.SetTimeText(key)
-        self.main_panel.Refresh() #刷新整个页面clear
-        main_frame.slider_event_flage = True
-        # self.timeline_draw_panel.Refresh()
+        self.RefreshCursorLine() # 只刷新游标线所在的区域
 
     # 鼠标左键点击画板事件回调
     def on_timeline_draw_left_down(self,event):
@@ -348,17 +397,15 @@ class TimelnePanel(wx.Panel):
 
     # 设置多选项的slider的值
     def SetMorphSliderValue(self,key,slider,choice):
-        dirlable = ["type","left","right"]
         (classname,dirname) = slider.GetName().split("-")
-        type = self.data.control_slider_morph_data_map[key][self.data.morph_lable.index(classname)][0]
-        value = self.data.control_slider_morph_data_map[key][self.data.morph_lable.index(classname)][dirlable.index(dirname)]
+        type, value = self.data.get_morph_data(key,classname,dirname)
         slider.SetValue(value)
         choice.SetSelection(type)
 
     # 设置单一slider的值
     def SetNonMorphSliderValue(self,key,slider):
         classname = slider.GetName()
-        value = self.data.control_slider_non_morph_data_map[key][self.data.non_morph_lable.index(classname)]
+        value = self.data.get_non_morph_data(key,classname)
         slider.SetValue(value)
     
     #设置指示器上的值
@@ -471,6 +518,7 @@ class CurvePlottingPanel(wx.Panel):
         self.points = [] # 用于记录各个点在曲线面板中的坐标
 
         self.change_falge = False
+        self.background_bitmap = None # 坐标轴的缓存图，只绘制一次
 
         super().__init__(parent,style=wx.NO_BORDER,size=(self.width,self.height))
         self.Bind(wx.EVT_PAINT,self.OnPaint)
@@ -602,8 +650,13 @@ class CurvePlottingPanel(wx.Panel):
                 self.parameter_points[5]=data_map["start_control"]
                 self.parameter_points[7]=data_map["end_control"]
         
-        self.update_parameter_points_2_parameter_map()
-        self.data.update_timeline_data_map_func(self.selected_key)
+        with self.data.lock:
+            self.update_parameter_points_2_parameter_map()
+            self.data.update_timeline_data_map_func(self.selected_key)
+            # 曲线段终点的控制柄也可能被修改了
+            for frame_index in self.point_frame_index:
+                if frame_index is not None:
+                    self.data.update_timeline_data_map_func(frame_index)
 
 
     # 绘制曲线
@@ -640,13 +693,7 @@ class CurvePlottingPanel(wx.Panel):
             self.selected_lable = self.data.get_selected_point_lable()
             lable = self.selected_lable
 
-            timeline_list = self.data.parameter_map.keys()
-            timeline_list = list(timeline_list)
-            timeline_keys = sorted(timeline_list) 
-
             if key in self.data.parameter_map and lable in self.data.parameter_map[key]:
-                key_index = timeline_keys.index(key)
-                
                 if lable in self.data.morph_lable:
                     left_param = []
                     right_param = []
@@ -657,11 +704,7 @@ class CurvePlottingPanel(wx.Panel):
 
                     if "left" in self.data.parameter_map[key][lable]:
                         lables = [lable,"left"]
-                        point_map = self.data.find_back_key(key_parameter_map=self.data.parameter_map,
-                                                        parameter_map=self.data.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys,
-                                                        lables=lables)
+                        point_map = self.data.find_back_segment(key,lables)
                         if bool(point_map):
                             left_end_frame_index = point_map["frame_index"]
                             left_param = [point_map["start"],point_map["start_control"],point_map["end"],point_map["end_control"]]
@@ -670,11 +713,7 @@ class CurvePlottingPanel(wx.Panel):
                     
                     if "right" in self.data.parameter_map[key][lable]:
                         lables = [lable,"right"]
-                        point_map = self.data.find_back_key(key_parameter_map=self.data.parameter_map,
-                                                        parameter_map=self.data.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys,
-                                                        lables=lables)
+                        point_map = self.data.find_back_segment(key,lables)
                         if bool(point_map):
                             right_end_frame_index = point_map["frame_index"]
                             right_param = [point_map["start"],point_map["start_control"],point_map["end"],point_map["end_control"]]
@@ -702,11 +741,7 @@ class CurvePlottingPanel(wx.Panel):
                 elif lable in self.data.non_morph_lable:
                     lables = [lable]
                     # 找到后面的关键点
-                    point_map = self.data.find_back_key(key_parameter_map=self.data.parameter_map,
-                                                        parameter_map=self.data.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys,
-                                                        lables=lables)
+                    point_map = self.data.find_back_segment(key,lables)
 
                     if bool(point_map):
                         self.point_frame_index = [point_map["frame_index"]]
@@ -751,21 +786,32 @@ class CurvePlottingPanel(wx.Panel):
                 self.start_control_dragpoint = DragPoint(self, self, 1)
                 self.end_control_dragpoint = DragPoint(self, self, 3)
 
+    # 绘制坐标轴到缓存图中
+    def build_background(self):
+        self.background_bitmap = wx.Bitmap(self.width, self.height)
+        dc = wx.MemoryDC(self.background_bitmap)
+        dc.SetBackground(wx.Brush(self.GetBackgroundColour()))
+        dc.Clear()
+        dc.SetPen(wx.Pen("black",self.line_size))
+        
+        # 绘制垂线
+        dc.DrawLine(self.left_gap, self.top_gap, self.left_gap, self.height-self.botton_gap)
+        
+        # 绘制横线
+        dc.DrawLine(self.left_gap, self.height-self.botton_gap, self.width, self.height-self.botton_gap)
+        dc.SelectObject(wx.NullBitmap)
+
     def OnPaint(self,event):
         
         self.dc = wx.PaintDC(self)
-        self.dc.SetPen(wx.Pen("black",self.line_size))
+        if self.background_bitmap is None:
+            self.build_background()
+        self.dc.DrawBitmap(self.background_bitmap, 0, 0)
         self.dc.SetTextForeground("gray")
         self.dc.SetFont(wx.Font(self.lable_text_size, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
         
         self.gc = wx.GraphicsContext.Create(self.dc) # 曲线绘制
         
-        # 绘制垂线
-        self.dc.DrawLine(self.left_gap, self.top_gap, self.left_gap, self.height-self.botton_gap)
-        
-        # 绘制横线
-        self.dc.DrawLine(self.left_gap, self.height-self.botton_gap, self.width, self.height-self.botton_gap)
-        
         if len(self.points)==4:
             if self.points[0] is not None:
                 self.draw_curve(self.points[0],self.points[1],self.points[2],self.points[3])
@@ -834,780 +880,8 @@ class CurvePlottingPanel(wx.Panel):
         self.dc.DrawText(self.lable_str,self.width-self.lable_right_gap,self.top_gap)
 
 # 参数类
-class ParameterStore:
-    def __init__(self):
-        self.now_key_value = 0
-        self.point_nomal_size = 2
-        self.frame_num = 300
-        self.morph_lable = ["eyebrow","eye","mouth","iris_morphs"]
-        self.non_morph_lable = ["iris_rotation_x","iris_rotation_y","head_x","head_y","neck_z","body_y","body_z","breathing"]
-        self.selected_pointes = [] # [(key_num,y_lable),(0,"eyebrow")]
-        self.temp_delete_parameter_map = {}
-        self.parameter_map = {}
-        self.timeline_lable_map = {}
-        self.init_data_map()
-
-    # 设置选中点
-    def set_selected_pointes(self,selected_point):
-        self.selected_pointes.clear()
-        self.selected_pointes = [selected_point]
-    
-    # 清空选中点列表
-    def clear_selected_pointes(self):
-        self.selected_pointes.clear()
-
-    # 获取选中的点的帧
-    def get_selected_point_frame(self):
-        return self.selected_pointes[0][0]
-    
-    # 获取选中的点的标签
-    def get_selected_point_lable(self):
-        return self.selected_pointes[0][1]
-
-    # 初始化时间轴的数据矩阵
-    def init_data_map(self):
-        self.render_flage_map = [0 for i in range(self.frame_num+1)] # 标记每一帧是否已经有临时渲染
-        self.control_slider_morph_data_map = [[[0,-1000,-1000] for j in range(len(self.morph_lable))] for k in range(self.frame_num+1)] # [[[type,left,right]]]
-        self.control_slider_non_morph_data_map = [[0 for i in range(len(self.non_morph_lable))] for j in range(self.frame_num+1)] # [[value]]
-
-    def set(self,num,map):
-        self.parameter_map[num] = map
-    
-    # 将标签转换为纵坐标的值
-    def find_lable_y(self, lable_name):
-        if lable_name in self.timeline_lable_map:
-            return self.timeline_lable_map[lable_name]
-        else:
-            return -1
-    
-    # 将坐标值转换为标签
-    def find_y_lable_str(self,lable_y):
-        if lable_y in self.timeline_lable_map:
-            return self.timeline_lable_map[lable_y]
-        else:
-            return None
-        
-    # 寻找被选中的标记点，传入的是鼠标点击事件获取的坐标值，时间轴slider长度，slider的前面的空隙
-    def find_selected_point(self,click_x,click_y,slider_width,slider_gap):
-        selected_point = None
-        x_key = None
-        y_lable = None
-
-        key_near = (click_x-slider_gap)*self.frame_num//slider_width
-        key_near_x = slider_gap+slider_width*(key_near/self.frame_num)
-        if abs(click_x-key_near_x)<=self.point_nomal_size:
-            x_key = key_near
-        else:
-            return selected_point
-
-        for i in [k for k in range(click_y-self.point_nomal_size,click_y+self.point_nomal_size+1)]:
-            lable_str = self.find_y_lable_str(i)
-            if lable_str is not None:
-                y_lable = lable_str
-                break
-
-        if x_key is not None and y_lable is not None:
-            selected_point = (x_key,y_lable)
-        
-        return selected_point
-        
-    def set_now_key_value(self,v):
-        self.now_key_value = v
-
-    def get_now_key_value(self):
-        return self.now_key_value
-    
-    # 清空时间轴游标指定的当前时间帧上的所有关键点数据
-    def clear_timeline_current_data(self):
-        if self.now_key_value in self.parameter_map:
-            self.temp_delete_parameter_map.clear()
-            self.temp_delete_parameter_map[self.now_key_value] = self.parameter_map[self.now_key_value]
-            del self.parameter_map[self.now_key_value]
-    
-    # 删除选中的关键点的数据
-    def delete_selected_key_data(self):
-        key = self.selected_pointes[0][0]
-        lable = self.selected_pointes[0][1]
-        if key in self.parameter_map and lable in self.parameter_map[key]:
-            self.temp_delete_parameter_map.clear()
-            self.temp_delete_parameter_map[key] = {lable:self.parameter_map[key][lable]}
-            self.get_selected_point_frame()
-            del self.parameter_map[key][lable]
-
-    # 三次贝塞尔缓动曲线函数求值
-    def cubic_bezier(self,in_x,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y):
-        x = in_x
-        if x < start_x:
-            x = 0
-        else:
-            x = x-start_x
-        x0 = 0
-        y0 = start_y
-        x1 = start_c_x + x0
-        y1 = start_c_y+ y0
-        x3 = end_x-start_x
-        y3 = end_y
-        x2 = end_c_x+x3
-        y2 = end_c_y+y3
-
-        P0 = (x0,y0)
-        P1 = (x1,y1)
-        P2 = (x2,y2)
-        P3 = (x3,y3)
-
-        # 定义三次方程的系数
-        a = P0[0] - 3 * P1[0] + 3 * P2[0] - P3[0]
-        b = 3 * P1[0] - 6 * P2[0] + 3 * P3[0]
-        c = 3 * P2[0] - 3 * P3[0]
-        d = P3[0] - x
-
-        roots = numpy.roots([a, b, c, d])
-        t = None
-        for root in roots:
-            if numpy.isreal(root) and 0 <= root <= 1:
-                t = root.real
-                break
-
-        y = None
-        # 如果找到了合适的t值，就代入y轴的方程，得到y值
-        if t is not None:
-            t = 1-t
-            y = (1 - t) ** 3 * P0[1] + 3 * (1 - t) ** 2 * t * P1[1] + 3 * (1 - t) * t ** 2 * P2[1] + t ** 3 * P3[1]
-            y = math.floor(y)
-        else:
-            # print("没有找到合适的t值")
-            if in_x == end_x:
-                y = self.cubic_bezier(in_x-1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
-            elif in_x == start_x:
-                y = self.cubic_bezier(in_x+1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
-            else:
-                y = self.cubic_bezier(in_x-1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)+self.cubic_bezier(in_x+1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
-                y = y/2
-        return y
-
-    # 向后寻找匹配的key返回的是一个map
-    def find_back_key(self,key_parameter_map,parameter_map,key_index,timeline_keys,lables):
-        ret_map = {}
-        current_key = timeline_keys[key_index]
-        if lables[0] in self.morph_lable:
-            for i in range(key_index+1,len(timeline_keys)):
-                key = timeline_keys[i]
-                if lables[0] in parameter_map[key] and lables[1] in parameter_map[key][lables[0]] and bool(parameter_map[key][lables[0]][lables[1]]):
-                    type = key_parameter_map[current_key][lables[0]]["type"]
-                    start = (current_key,key_parameter_map[current_key][lables[0]][lables[1]]["value"])
-                    start_control = (key_parameter_map[current_key][lables[0]][lables[1]]["control"]["start"][0],key_parameter_map[current_key][lables[0]][lables[1]]["control"]["start"][1])
-                    end = (key,parameter_map[key][lables[0]][lables[1]]["value"])
-                    end_control = (parameter_map[key][lables[0]][lables[1]]["control"]["end"][0],parameter_map[key][lables[0]][lables[1]]["control"]["end"][1])
-                    ret_map = {
-                        "type":type,
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":end[0]
-                    }
-                    break
-            if not bool(ret_map):
-                type = key_parameter_map[current_key][lables[0]]["type"]
-                end = (self.frame_num,key_parameter_map[current_key][lables[0]][lables[1]]["value"])
-                end_control = (0,0)
-                start = (current_key,key_parameter_map[current_key][lables[0]][lables[1]]["value"])
-                start_control = (0,0)
-                ret_map = {
-                        "type":type,
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":end[0]
-                    }
-        else:
-            for i in range(key_index+1,len(timeline_keys)):
-                key = timeline_keys[i]
-                if lables[0] in parameter_map[key] and bool(parameter_map[key][lables[0]]):
-                    start = (current_key,key_parameter_map[current_key][lables[0]]["value"])
-                    start_control = (key_parameter_map[current_key][lables[0]]["control"]["start"][0],key_parameter_map[current_key][lables[0]]["control"]["start"][1])
-                    end = (key,parameter_map[key][lables[0]]["value"])
-                    end_control = (parameter_map[key][lables[0]]["control"]["end"][0],parameter_map[key][lables[0]]["control"]["end"][1])
-                    ret_map = {
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":end[0]
-                    }
-                    break
-
-            if not bool(ret_map):
-                end = (self.frame_num,key_parameter_map[current_key][lables[0]]["value"])
-                end_control = (0,0)
-                start = (current_key,key_parameter_map[current_key][lables[0]]["value"])
-                start_control = (0,0)
-                ret_map = {
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":end[0]
-                    }
-
-        return ret_map
-
-    # 向前寻找匹配的key返回的是一个map
-    def find_front_key(self,key_parameter_map, parameter_map,key_index,timeline_keys,lables):
-        ret_map = {}
-        current_key = timeline_keys[key_index]
-        if lables[0] in self.morph_lable:
-            for i in range(key_index-1,-1,-1):
-                key = timeline_keys[i]
-                if lables[0] in parameter_map[key] and lables[1] in parameter_map[key][lables[0]] and bool(parameter_map[key][lables[0]][lables[1]]):
-                    type = parameter_map[key][lables[0]]["type"]
-                    start = (key,parameter_map[key][lables[0]][lables[1]]["value"])
-                    start_control = (parameter_map[key][lables[0]][lables[1]]["control"]["start"][0],parameter_map[key][lables[0]][lables[1]]["control"]["start"][1])
-                    end = (current_key,key_parameter_map[current_key][lables[0]][lables[1]]["value"])
-                    end_control = (key_parameter_map[current_key][lables[0]][lables[1]]["control"]["end"][0],key_parameter_map[current_key][lables[0]][lables[1]]["control"]["end"][1])
-                    ret_map = {
-                        "type":type,
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":start[0]
-                    }
-                    break
-            if not bool(ret_map):
-                type = key_parameter_map[current_key][lables[0]]["type"]
-                start = (0,key_parameter_map[current_key][lables[0]][lables[1]]["value"])
-                start_control = (0,0)
-                end = (current_key,key_parameter_map[current_key][lables[0]][lables[1]]["value"])
-                end_control = (0,0)
-                ret_map = {
-                        "type":type,
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":start[0]
-                    }
-        else:
-            for i in range(key_index-1,-1,-1):
-                key = timeline_keys[i]
-                if lables[0] in parameter_map[key] and bool(parameter_map[key][lables[0]]):
-                    start = (key,parameter_map[key][lables[0]]["value"])
-                    start_control = (parameter_map[key][lables[0]]["control"]["start"][0],parameter_map[key][lables[0]]["control"]["start"][1])
-                    end = (current_key,key_parameter_map[current_key][lables[0]]["value"])
-                    end_control = (key_parameter_map[current_key][lables[0]]["control"]["end"][0],key_parameter_map[current_key][lables[0]]["control"]["end"][1])
-                    ret_map = {
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":start[0]
-                    }
-                    break
-
-            if not bool(ret_map):
-                start = (0,key_parameter_map[current_key][lables[0]]["value"])
-                start_control = (0,0)
-                end = (current_key,key_parameter_map[current_key][lables[0]]["value"])
-                end_control = (0,0)
-                ret_map = {
-                        "start":start,
-                        "start_control":start_control,
-                        "end":end,
-                        "end_control":end_control,
-                        "frame_index":start[0]
-                    }
-
-        return ret_map
-
-    # 找到比当前游标小但最邻近的点
-    def find_nearest_key(self,key,timeline_keys):
-        count = 0
-        for i in timeline_keys:
-            if key > i:
-                count += 1
-        return count
-    
-    # 找到时间轴上邻接的两个点，返回一个point map，都将被放到function map的start字段下
-    def find_nearest_point_key(self,key,timeline_keys):
-        key_index = self.find_nearest_key(key,timeline_keys)
-        timeline_keys_temp = timeline_keys
-        timeline_keys_temp.insert(key_index,key)
-        function_map = {"start":{},"end":{}}
-
-        if key in self.temp_delete_parameter_map:
-            for k,v in self.temp_delete_parameter_map[key].items():
-                # 如果是含有多个预设的slider运行下面的代码
-                if k in self.morph_lable and bool(self.temp_delete_parameter_map[key][k]):
-                    if "left" in self.temp_delete_parameter_map[key][k] and bool(self.temp_delete_parameter_map[key][k]["left"]):
-                        lables = [k,"left"]
-                        type = 0
-                        start = (0,0)
-                        end = (0,0)
-                        start_control = (0,0)
-                        end_control = (0,0)
-
-                        point_map_back = self.find_back_key(key_parameter_map=self.temp_delete_parameter_map,
-                                                        parameter_map=self.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys_temp,
-                                                        lables=lables)
-                        point_map_front = self.find_front_key(key_parameter_map=self.temp_delete_parameter_map,
-                                                        parameter_map=self.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys_temp,
-                                                        lables=lables)
-                        if bool(point_map_back) and bool(point_map_front):
-                            type = point_map_front["type"]
-                            start = point_map_front["start"]
-                            start_control = point_map_front["start_control"]
-                            end = point_map_back["end"]
-                            end_control = point_map_back["end_control"]
-
-                            if point_map_back["end"][0] not in self.parameter_map:
-                                end = (self.frame_num,-1000)
-                                
-                            if point_map_front["start"][0] not in self.parameter_map:
-                                start = (0,-1000)
-
-                        elif bool(point_map_back):
-                            type = 0
-                            start = (0,-1000)
-                            end = point_map_back["end"]
-                            start_control = (0,0)
-                            end_control = point_map_back["end_control"]
-
-                            if point_map_back["end"][0] not in self.parameter_map:
-                                end = (self.frame_num,-1000)
-
-                        elif bool(point_map_front):
-                            type = point_map_front["type"]
-                            start = point_map_front["start"]
-                            end = (self.frame_num,-1000)
-                            start_control = point_map_front["start_control"]
-                            end_control = (0,0)
-                            
-                            if point_map_front["start"][0] not in self.parameter_map:
-                                start = (0,-1000)
-                        
-                        else:
-                            type=0
-                            start = (0,-1000)
-                            start_control = (0,0)
-                            end = (self.frame_num,-1000)
-                            end_control = (0,0)
-
-                        if k in function_map["start"] and bool(function_map["start"][k]):
-                            function_map["start"][k]["type"] = type
-                            function_map["start"][k]["left"] = {"start":start,
-                                                                "end":end,
-                                                                "start_control":start_control,
-                                                                "end_control":end_control
-                                                                }
-                        else:
-                            function_map["start"][k] = {"type":type,
-                                                    "left":{"start":start,
-                                                            "end":end,
-                                                            "start_control":start_control,
-                                                            "end_control":end_control}}
-                            
-                    if "right" in self.temp_delete_parameter_map[key][k] and bool(self.temp_delete_parameter_map[key][k]["right"]):
-                        lables = [k,"right"]
-                        type = 0
-                        start = (0,0)
-                        end = (0,0)
-                        start_control = (0,0)
-                        end_control = (0,0)
-
-                        point_map_back = self.find_back_key(key_parameter_map=self.temp_delete_parameter_map,
-                                                        parameter_map=self.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys_temp,
-                                                        lables=lables)
-                        point_map_front = self.find_front_key(key_parameter_map=self.temp_delete_parameter_map,
-                                                        parameter_map=self.parameter_map,
-                                                        key_index=key_index,
-                                                        timeline_keys=timeline_keys_temp,
-                                                        lables=lables)
-                        if bool(point_map_back) and bool(point_map_front):
-                            type = point_map_front["type"]
-                            start = point_map_front["start"]
-                            start_control = point_map_front["start_control"]
-                            end = point_map_back["end"]
-                            end_control = point_map_back["end_control"]
-
-                            if point_map_back["end"][0] not in self.parameter_map:
-                                end = (self.frame_num,-1000)
-                                
-                            if point_map_front["start"][0] not in self.parameter_map:
-                                start = (0,-1000)
-
-                        elif bool(point_map_back):
-                            type = 0
-                            start = (0,-1000)
-                            end = point_map_back["end"]
-                            start_control = (0,0)
-                            end_control = point_map_back["end_control"]
-
-                            if point_map_back["end"][0] not in self.parameter_map:
-                                end = (self.frame_num,-1000)
-
-                        elif bool(point_map_front):
-                            type = point_map_front["type"]
-                            start = point_map_front["start"]
-                            end = (self.frame_num,-1000)
-                            start_control = point_map_front["start_control"]
-                            end_control = (0,0)
-                            
-                            if point_map_front["start"][0] not in self.parameter_map:
-                                start = (0,-1000)
-                        
-                        else:
-                            type=0
-                            start = (0,-1000)
-                            start_control = (0,0)
-                            end = (self.frame_num,-1000)
-                            end_control = (0,0)
-
-                        if k in function_map["start"] and bool(function_map["start"][k]):
-                            function_map["start"][k]["type"] = type
-                            function_map["start"][k]["right"] = {"start":start,
-                                                                "end":end,
-                                                                "start_control":start_control,
-                                                                "end_control":end_control
-                                                                }
-                        else:
-                            function_map["start"][k] = {"type":type,
-                                                    "right":{"start":start,
-                                                            "end":end,
-                                                            "start_control":start_control,
-                                                            "end_control":end_control}}
-
-                # 如果是单一slider类则运行下面的代码
-                elif k in self.non_morph_lable and bool(self.temp_delete_parameter_map[key][k]):
-                    lables = [k]
-                    start = (0,0)
-                    end = (0,0)
-                    start_control = (0,0)
-                    end_control = (0,0)
-
-                    point_map_back = self.find_back_key(key_parameter_map=self.temp_delete_parameter_map,
-                                                    parameter_map=self.parameter_map,
-                                                    key_index=key_index,
-                                                    timeline_keys=timeline_keys_temp,
-                                                    lables=lables)
-                    point_map_front = self.find_front_key(key_parameter_map=self.temp_delete_parameter_map,
-                                                    parameter_map=self.parameter_map,
-                                                    key_index=key_index,
-                                                    timeline_keys=timeline_keys_temp,
-                                                    lables=lables)
-                    if bool(point_map_back) and bool(point_map_front):
-                        start = point_map_front["start"]
-                        start_control = point_map_front["start_control"]
-                        end = point_map_back["end"]
-                        end_control = point_map_back["end_control"]
-
-                        if point_map_back["end"][0] not in self.parameter_map:
-                            end = (self.frame_num,0)
-                            
-                        if point_map_front["start"][0] not in self.parameter_map:
-                            start = (0,0)
-
-                    elif bool(point_map_back):
-                        start = (0,0)
-                        end = point_map_back["end"]
-                        start_control = (0,0)
-                        end_control = point_map_back["end_control"]
-
-                        if point_map_back["end"][0] not in self.parameter_map:
-                            end = (self.frame_num,0)
-
-                    elif bool(point_map_front):
-                        start = point_map_front["start"]
-                        end = (self.frame_num,0)
-                        start_control = point_map_front["start_control"]
-                        end_control = (0,0)
-                        
-                        if point_map_front["start"][0] not in self.parameter_map:
-                            start = (0,0)
-                    
-                    else:
-                        start = (0,0)
-                        start_control = (0,0)
-                        end = (self.frame_num,0)
-                        end_control = (0,0)
-
-                    function_map["start"][k] = {"start":start,
-                                                    "end":end,
-                                                    "start_control":start_control,
-                                                    "end_control":end_control}
-
-        return function_map
-
-    # 判断是否是删除点
-    def is_delete_point(self):
-        if len(self.selected_pointes)>0 and self.selected_pointes[0][0] in self.parameter_map and self.selected_pointes[0][1] not in self.parameter_map[self.selected_pointes[0][0]]:
-            return True
-        else:
-            return False
-
-    #找到临近的前后符合条件的关键点
-    def find_keys(self,key):
-        timeline_list = self.parameter_map.keys()
-        timeline_list = list(timeline_list)
-        timeline_keys = sorted(timeline_list) # 获取所有的修改过的关键帧
-        function_map = {"start":{},"end":{}}
-
-        if self.is_delete_point():
-            function_map = self.find_nearest_point_key(key,timeline_keys)
-        else:
-            if key in self.parameter_map:
-                key_index = timeline_keys.index(key)
-
-                # 遍历当前帧中被修改过的参数，并获取对应的前后邻接点
-                for k,v in self.parameter_map[key].items():
-                    # 如果是含有多个预设的slider运行下面的代码
-                    if k in self.morph_lable and bool(self.parameter_map[key][k]):
-                        if "left" in self.parameter_map[key][k] and bool(self.parameter_map[key][k]["left"]):
-                            lables = [k,"left"]
-                            point_map = self.find_back_key(key_parameter_map=self.parameter_map,
-                                                            parameter_map=self.parameter_map,
-                                                            key_index=key_index,
-                                                            timeline_keys=timeline_keys,
-                                                            lables=lables)
-                            if bool(point_map):
-                                if k in function_map["start"] and bool(function_map["start"][k]):
-                                    function_map["start"][k]["type"] = point_map["type"]
-                                    function_map["start"][k]["left"] = {"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]
-                                                                        }
-                                else:
-                                    function_map["start"][k] = {"type":point_map["type"],
-                                                                "left":{"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]}}
-                            point_map = self.find_front_key(key_parameter_map=self.parameter_map,
-                                                            parameter_map=self.parameter_map,
-                                                            key_index=key_index,
-                                                            timeline_keys=timeline_keys,
-                                                            lables=lables)
-                            if bool(point_map):
-                                if k in function_map["end"] and bool(function_map["end"][k]):
-                                    function_map["end"][k]["type"] = point_map["type"]
-                                    function_map["end"][k]["left"] = {"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]
-                                                                        }
-                                else:
-                                    function_map["end"][k] = {"type":point_map["type"],
-                                                                "left":{"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]}}
-                        if "right" in self.parameter_map[key][k] and bool(self.parameter_map[key][k]["right"]):
-                            lables = [k,"right"]
-                            point_map = self.find_back_key(key_parameter_map=self.parameter_map,
-                                                            parameter_map=self.parameter_map,
-                                                            key_index=key_index,
-                                                            timeline_keys=timeline_keys,
-                                                            lables=lables)
-                            if bool(point_map):
-                                if k in function_map["start"] and bool(function_map["start"][k]):
-                                    function_map["start"][k]["type"] = point_map["type"]
-                                    function_map["start"][k]["right"] = {"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]
-                                                                        }
-                                else:
-                                    function_map["start"][k] = {"type":point_map["type"],
-                                                                "right":{"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]}}
-                            point_map = self.find_front_key(key_parameter_map=self.parameter_map,
-                                                            parameter_map=self.parameter_map,
-                                                            key_index=key_index,
-                                                            timeline_keys=timeline_keys,
-                                                            lables=lables)
-                            if bool(point_map):
-                                if k in function_map["end"] and bool(function_map["end"][k]):
-                                    function_map["end"][k]["type"] = point_map["type"]
-                                    function_map["end"][k]["right"] = {"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]
-                                                                        }
-                                else:
-                                    function_map["end"][k] = {"type":point_map["type"],
-                                                                "right":{"start":point_map["start"],
-                                                                        "end":point_map["end"],
-                                                                        "start_control":point_map["start_control"],
-                                                                        "end_control":point_map["end_control"]}}
-                    # 如果是单一slider类则运行下面的代码
-                    elif k in self.non_morph_lable and bool(self.parameter_map[key][k]):
-                        lables = [k]
-                        # 找到后面的关键点
-                        point_map = self.find_back_key(key_parameter_map=self.parameter_map,
-                                                            parameter_map=self.parameter_map,
-                                                            key_index=key_index,
-                                                            timeline_keys=timeline_keys,
-                                                            lables=lables)
-                        if bool(point_map):
-                            function_map["start"][k] = {"start":point_map["start"],
-                                                        "end":point_map["end"],
-                                                        "start_control":point_map["start_control"],
-                                                        "end_control":point_map["end_control"]
-                                                        }
-                        # 找到前面的关键点
-                        point_map = self.find_front_key(key_parameter_map=self.parameter_map,
-                                                            parameter_map=self.parameter_map,
-                                                            key_index=key_index,
-                                                            timeline_keys=timeline_keys,
-                                                            lables=lables)
-                        if bool(point_map):
-                            function_map["end"][k] = {"start":point_map["start"],
-                                                        "end":point_map["end"],
-                                                        "start_control":point_map["start_control"],
-                                                        "end_control":point_map["end_control"]}
-            
-            else: # 更新的时候当前点被删除了，需要接上两边的端点
-                
-                function_map = self.find_nearest_point_key(key,timeline_keys)
-                            
-        if not bool(function_map["start"]) and not bool(function_map["end"]):
-            function_map = {}
-        
-        return function_map
-
-    # 将有多个预设的slider的值存到data中
-    def set_morph_control_panel_parame(self, slider, choice):
-        key_num = self.get_now_key_value()
-        (classname,dirname) = slider.GetName().split("-")
-        v = slider.GetValue()
-        if key_num in self.parameter_map:
-            if classname in self.parameter_map[key_num]:
-                self.parameter_map[key_num][classname]["type"] = choice.GetSelection()
-                if dirname in self.parameter_map[key_num][classname]:
-                    self.parameter_map[key_num][classname][dirname]["value"] = v
-                else:
-                    self.parameter_map[key_num][classname][dirname] = {"value":v,"control":{"start":[0,0],"end":[0,0]}}
-            else:
-                self.parameter_map[key_num][classname] = {dirname:{"value":v,"control":{"start":[0,0],"end":[0,0]}}}
-        else:
-            self.parameter_map[key_num] = {classname: {dirname: {"value": v, "control": {"start": [0, 0], "end": [0, 0]}}}}
-
-    # 将只有一个预设的slider的值存到data中
-    def set_non_morph_control_panel_parame(self, slider):
-        key_num = self.get_now_key_value()
-        classname = slider.GetName()
-        v = slider.GetValue()
-        if key_num in self.parameter_map:
-            if classname in self.parameter_map[key_num]:
-                self.parameter_map[key_num][classname]["value"] = v
-            else:
-                self.parameter_map[key_num][classname] = {"value":v,"control":{"start":[0,0],"end":[0,0]}}
-        else:
-            self.parameter_map[key_num] = {classname:{"value":v,"control":{"start":[0,0],"end":[0,0]}}}
-
-    # 更新时间轴数据板的子函数，更新函数
-    def update_timeline_data_map_sub_func(self,function_map,stat):
-        for k,v in function_map[stat].items():
-            if k in self.morph_lable:
-                type = v["type"]
-                if "left" in v and bool(v["left"]):
-                    begin  = v["left"]["start"][0]
-                    end = v["left"]["end"][0]
-                    start_x = v["left"]["start"][0]
-                    start_y = v["left"]["start"][1]
-                    start_control_x = v["left"]["start_control"][0]
-                    start_control_y = v["left"]["start_control"][1]
-                    end_x = v["left"]["end"][0]
-                    end_y = v["left"]["end"][1]
-                    end_control_x = v["left"]["end_control"][0]
-                    end_control_y = v["left"]["end_control"][1]
-                    for i in range(begin,end):
-                        self.control_slider_morph_data_map[i][self.morph_lable.index(k)][0] = type
-                        self.control_slider_morph_data_map[i][self.morph_lable.index(k)][1] = self.cubic_bezier(in_x=i,
-                                                                                                          start_x=start_x,
-                                                                                                          start_y=start_y,
-                                                                                                          start_c_x=start_control_x,
-                                                                                                          start_c_y=start_control_y,
-                                                                                                          end_x=end_x,
-                                                                                                          end_y=end_y,
-                                                                                                          end_c_x=end_control_x,
-                                                                                                          end_c_y=end_control_y)
-                if "right" in v and bool(v["right"]):
-                    begin  = v["right"]["start"][0]
-                    end = v["right"]["end"][0]
-                    start_x = v["right"]["start"][0]
-                    start_y = v["right"]["start"][1]
-                    start_control_x = v["right"]["start_control"][0]
-                    start_control_y = v["right"]["start_control"][1]
-                    end_x = v["right"]["end"][0]
-                    end_y = v["right"]["end"][1]
-                    end_control_x = v["right"]["end_control"][0]
-                    end_control_y = v["right"]["end_control"][1]
-                    for i in range(begin,end):
-                        self.control_slider_morph_data_map[i][self.morph_lable.index(k)][0] = type
-                        self.control_slider_morph_data_map[i][self.morph_lable.index(k)][2] = self.cubic_bezier(in_x=i,
-                                                                                                          start_x=start_x,
-                                                                                                          start_y=start_y,
-                                                                                                          start_c_x=start_control_x,
-                                                                                                          start_c_y=start_control_y,
-                                                                                                          end_x=end_x,
-                                                                                                          end_y=end_y,
-                                                                                                          end_c_x=end_control_x,
-                                                                                                          end_c_y=end_control_y)
-            elif k in self.non_morph_lable:
-                begin  = v["start"][0]
-                end = v["end"][0]
-                start_x = v["start"][0]
-                start_y = v["start"][1]
-                start_control_x = v["start_control"][0]
-                start_control_y = v["start_control"][1]
-                end_x = v["end"][0]
-                end_y = v["end"][1]
-                end_control_x = v["end_control"][0]
-                end_control_y = v["end_control"][1]
-                for i in range(begin,end):
-
-                    self.control_slider_non_morph_data_map[i][self.non_morph_lable.index(k)] = self.cubic_bezier(in_x=i,
-                                                                                                        start_x=start_x,
-                                                                                                        start_y=start_y,
-                                                                                                        start_c_x=start_control_x,
-                                                                                                        start_c_y=start_control_y,
-                                                                                                        end_x=end_x,
-                                                                                                        end_y=end_y,
-                                                                                                        end_c_x=end_control_x,
-                                                                                                        end_c_y=end_control_y)
-
-    # 更新指定关键帧的相邻控制面板矩阵数据
-    def update_timeline_data_map_func(self,key):
-        function_map = self.find_keys(key=key)
-
-        if bool(function_map):
-            self.update_timeline_data_map_sub_func(function_map=function_map,stat="start")
-            self.update_timeline_data_map_sub_func(function_map=function_map,stat="end")
-
-    # 更新时间轴参数板
-    def update_timeline_data_map(self):
-        key = self.get_now_key_value()
-        # timeline_keys = list(self.parameter_map.keys()).sort()
-        self.update_timeline_data_map_func(key=key)
-
-    # 更新面板上所有的关键点的相关矩阵数据
-    def update_all_timeline_data_map(self):
-        for key in self.parameter_map.keys():
-            self.update_timeline_data_map_func(key=key)
-
 class MainFrame(wx.Frame):
-    def __init__(self, poser: Poser, device: torch.device):
+    def __init__(self, poser: Poser, device: torch.device, render_cache_bytes: int = 512 * 1024 * 1024):
         super().__init__(None, wx.ID_ANY, "Poser")
         self.poser = poser
         self.isplaying=False
@@ -1701,6 +975,25 @@ class MainFrame(wx.Frame):
         self.source_image_bitmap = wx.Bitmap(self.image_size, self.image_size)
         self.result_image_bitmap = wx.Bitmap(self.image_size, self.image_size)
         self.source_image_dirty = True
+        self.image_cache = PreprocessedImageCache() # 预处理好的角色图片缓存
+
+        # 时间轴每一帧的临时渲染缓存，按字节数限制大小，是否有效由data.render_flage_map标记
+        self.render_cache_bytes = render_cache_bytes
+        self.render_cache = FrameCache(render_cache_bytes, on_evict=self.on_render_cache_evict) # {frame:numpy_image}
+        self.render_cache_poses = {} # {frame:(pose,output_index)}
+        self.render_cache_evicted = [] # 被挤出缓存的帧，放回锁外清除渲染标记
+        self.render_cache_lock = threading.Lock()
+        self.poser_lock = threading.Lock() # poser不能同时被界面线程和预渲染线程调用
+        self.hidden_discrete_lables = frozenset() # 取消勾选Show的修改器，在界面线程中更新，预渲染线程不能读取wx控件
+        self.fill_ahead_frames = 60 # 预渲染游标之后的帧数
+        self.fill_ahead_event = threading.Event()
+        self.fill_ahead_thread = threading.Thread(target=self.fill_ahead_loop, daemon=True)
+        self.fill_ahead_thread.start()
+
+        # 界面上的渲染请求交给后台线程，只渲染最新的请求，拖动slider时界面不会卡住
+        self.render_worker = RenderWorker(self.render_frame_request, self.show_frame_result,
+                                          fail_func=self.on_frame_render_failed)
+        self.status_bar = self.CreateStatusBar()
 
     def init_botton_panel(self):
         item_list = ["eyebrow","eye","mouth","iris_morphs","iris_rotation_x","iris_rotation_y","head_x","head_y","neck_z","body_y","body_z","breathing"]
@@ -1973,14 +1266,10 @@ class MainFrame(wx.Frame):
     # 播放定时器
     def on_play_timer(self,event):
         key = self.data.get_now_key_value()
-        if key < self.data.frame_num:
-            self.botton_timeline_panel.timeline_slider.SetValue(key+1)
-            wx.PostEvent(self.botton_timeline_panel.timeline_slider, wx.CommandEvent(wx.EVT_SLIDER.typeId, self.botton_timeline_panel.timeline_slider.GetId()))
-        else:
-            self.botton_timeline_panel.timeline_slider.SetValue(0)
-            wx.PostEvent(self.botton_timeline_panel.timeline_slider, wx.CommandEvent(wx.EVT_SLIDER.typeId, self.botton_timeline_panel.timeline_slider.GetId()))
-        
-        self.update_images_func()
+        key = key+1 if key < self.data.frame_num else 0
+        # 直接移动游标而不是发送slider事件，每一帧只请求一次
+        self.botton_timeline_panel.MoveCursor(key)
+        self.show_frame(key)
 
     # 渲染定时器
     def on_render_timer(self,event):
@@ -2045,14 +1334,7 @@ class MainFrame(wx.Frame):
 
     # 读取预设文件数据
     def load_preset_data(self,path):
-        # 先清空
-        self.data.parameter_map = {}
-        self.data.init_data_map()
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                data = json.load(f)
-                for k,v in data.items():
-                    self.data.parameter_map[int(k)] = v
+        self.data.load_preset_data(path)
 
     # 导出关键帧数据为json文件
     def save_preset_data(self,path):
@@ -2126,8 +1408,7 @@ class MainFrame(wx.Frame):
             except:
                 pass
         else:
-            self.data.parameter_map = {}
-            self.data.init_data_map()
+            self.data.clear_data()
             
         self.Refresh()
         
@@ -2229,17 +1510,20 @@ class MainFrame(wx.Frame):
         if file_dialog.ShowModal() == wx.ID_OK:
             image_file_name = os.path.join(file_dialog.GetDirectory(), file_dialog.GetFilename())
             try:
-                pil_image = resize_PIL_image(extract_PIL_image_from_filelike(image_file_name),
-                                             (self.poser.get_image_size(), self.poser.get_image_size()))
-                w, h = pil_image.size
-                if pil_image.mode != 'RGBA':
+                try:
+                    rgba, image = load_character_image(image_file_name, self.poser.get_image_size(), self.image_cache)
+                except RuntimeError:
                     self.source_image_string = "Image must have alpha channel!"
                     self.wx_source_image = None
                     self.torch_source_image = None
                 else:
-                    self.wx_source_image = wx.Bitmap.FromBufferRGBA(w, h, pil_image.convert("RGBA").tobytes())
-                    self.torch_source_image = extract_pytorch_image_from_PIL_image(pil_image)\
+                    h, w = rgba.shape[0], rgba.shape[1]
+                    self.wx_source_image = wx.Bitmap.FromBufferRGBA(w, h, rgba.tobytes())
+                    self.torch_source_image = torch.from_numpy(image)\
                         .to(self.device).to(self.dtype)
+                with self.poser_lock:
+                    self.poser.register_image(self.torch_source_image)
+                self.clear_render_cache()
                 self.source_image_dirty = True
                 self.Refresh()
                 self.Update()
@@ -2275,8 +1559,20 @@ class MainFrame(wx.Frame):
             rotation_control_panel.set_param_value(current_pose)
         return current_pose
 
+    # 记录取消勾选Show的修改器，变化后时间轴上离散修改器的帧都要重新渲染
+    def update_hidden_discrete_lables(self):
+        hidden = frozenset(lable for lable, category in MORPH_LABLE_CATEGORIES.items()
+                           if category in self.morph_control_panels
+                           and not self.morph_control_panels[category].checkbox.GetValue())
+        if hidden == self.hidden_discrete_lables:
+            return
+        with self.data.lock:
+            self.hidden_discrete_lables = hidden
+            self.data.render_flage_map[:] = 0
+
     # 更新图像的函数
     def update_images_func(self):
+        self.update_hidden_discrete_lables()
         current_pose = self.get_current_pose()
         if not self.source_image_dirty \
                 and self.last_pose is not None \
@@ -2299,14 +1595,137 @@ class MainFrame(wx.Frame):
             dc.SelectObject(self.source_image_bitmap)
             dc.Clear()
             dc.DrawBitmap(self.wx_source_image, 0, 0)
+            del dc
             self.source_image_dirty = False
-
-        pose = torch.tensor(current_pose, device=self.device, dtype=self.dtype)
+            self.source_image_panel.Refresh()
+
+        self.request_frame_image(self.data.get_now_key_value(), current_pose, self.output_index_choice.GetSelection())
+
+    # 显示某一帧，缓存中没有时交给渲染线程，渲染输出文件时需要立即得到结果所以直接渲染
+    def request_frame_image(self, key, pose, output_index):
+        numpy_image = self.lookup_frame_image(key, pose, output_index)
+        if numpy_image is None:
+            if not self.isrendering:
+                self.render_worker.submit((key, pose, output_index))
+                return
+            numpy_image = self.get_frame_image(key, pose, output_index)
+        self.show_result_image(numpy_image)
+        self.fill_ahead_event.set()
+
+    # 渲染线程中执行的渲染请求
+    def render_frame_request(self, request):
+        key, pose, output_index = request
+        return self.get_frame_image(key, pose, output_index)
+
+    # 渲染线程完成后在界面线程中显示结果
+    def show_frame_result(self, request, numpy_image):
+        # 游标已经移动到别的帧或者姿势已经变化时丢弃过期的结果，不覆盖更新的画面
+        if request != (self.data.get_now_key_value(), self.last_pose, self.last_output_index):
+            return
+        self.show_result_image(numpy_image)
+        stats = self.render_worker.get_stats()
+        self.status_bar.SetStatusText("render %.0f ms  queue %d  dropped %d" % (stats['render_ms'], stats['depth'], stats['dropped']))
+        self.fill_ahead_event.set()
+
+    # 渲染失败时忘掉记录的姿势，下一次定时器更新会重新请求这个姿势
+    def on_frame_render_failed(self, request, error):
+        if request == (self.data.get_now_key_value(), self.last_pose, self.last_output_index):
+            self.last_pose = None
+
+    # 用poser渲染一个姿势
+    def render_numpy_image(self, pose, output_index):
+        pose = torch.tensor(pose, device=self.device, dtype=self.dtype)
+        with self.poser_lock:
+            with torch.no_grad():
+                output_image = self.poser.pose(self.torch_source_image, pose, output_index)[0].detach().cpu() # 运算输出变换后的图片
+        return convert_output_image_from_torch_to_numpy(output_image)
+
+    # 按时间轴数据计算某一帧的姿势，和控制面板根据slider计算的结果一致
+    def get_frame_pose(self, key):
+        with self.data.lock:
+            return evaluate_timeline_poses(self.data, self.poser, end_frame=key, start_frame=key, dtype=numpy.float64,
+                                           hidden_lables=self.hidden_discrete_lables)[0].tolist()
+
+    # 获取某一帧的渲染结果，缓存中姿势和输出都相同时直接复用
+    def get_frame_image(self, key, pose, output_index):
+        numpy_image = self.lookup_frame_image(key, pose, output_index)
+        if numpy_image is None:
+            numpy_image = self.render_numpy_image(pose, output_index)
+            with self.render_cache_lock:
+                self.render_cache_poses[key] = (pose, output_index)
+                self.render_cache.put(key, numpy_image)
+                evicted, self.render_cache_evicted = self.render_cache_evicted, []
+        # 重新计算时间轴后值没有变化的帧缓存仍然有效，命中时也要重新标记，否则预渲染线程会一直重复这一帧
+        # 拖动slider还没有记录成关键帧时姿势和时间轴数据不一致，这一帧仍然算作没有渲染
+        with self.data.lock:
+            for evicted_key in evicted:
+                if evicted_key <= self.data.frame_num:
+                    self.data.render_flage_map[evicted_key] = 0
+            if key <= self.data.frame_num and pose == self.get_frame_pose(key):
+                self.data.render_flage_map[key] = 1
+        return numpy_image
+
+    # 在缓存中查找某一帧，姿势和输出不同时返回None
+    def lookup_frame_image(self, key, pose, output_index):
+        with self.render_cache_lock:
+            if self.render_cache_poses.get(key) != (pose, output_index):
+                return None
+            return self.render_cache.get(key)
+
+    # 缓存满了挤出某一帧，在render_cache_lock内调用
+    def on_render_cache_evict(self, key):
+        del self.render_cache_poses[key]
+        self.render_cache_evicted.append(key)
+
+    # 清空临时渲染缓存
+    def clear_render_cache(self):
+        with self.data.lock:
+            with self.render_cache_lock:
+                self.render_cache = FrameCache(self.render_cache_bytes, on_evict=self.on_render_cache_evict)
+                self.render_cache_poses.clear()
+                self.render_cache_evicted.clear()
+            self.data.render_flage_map[:] = 0
+
+    # 播放时直接按时间轴数据显示某一帧，已经渲染过的帧从缓存中取出
+    def show_frame(self, key):
+        if self.torch_source_image is None or self.source_image_dirty:
+            self.update_images_func()
+            return
+        self.update_hidden_discrete_lables()
+        pose = self.get_frame_pose(key)
         output_index = self.output_index_choice.GetSelection()
-        with torch.no_grad():
-            output_image = self.poser.pose(self.torch_source_image, pose, output_index)[0].detach().cpu() # 运算输出变换后的图片
+        self.last_pose = pose
+        self.last_output_index = output_index
+        self.request_frame_image(key, pose, output_index)
+
+    # 预渲染线程，在游标之后找还没有渲染过的帧渲染到缓存中
+    def fill_ahead_loop(self):
+        while True:
+            self.fill_ahead_event.wait()
+            # 界面请求的帧优先渲染，等渲染线程空闲后再继续
+            self.render_worker.wait_idle()
+            key = None
+            # 在锁内选出下一帧并计算它的姿势，界面线程不能在中途修改时间轴数据
+            with self.data.lock:
+                if self.torch_source_image is not None and not self.isrendering:
+                    start = self.data.get_now_key_value()
+                    end = min(start+self.fill_ahead_frames, self.data.frame_num)
+                    pending = numpy.flatnonzero(self.data.render_flage_map[start:end+1] == 0)
+                    if len(pending) > 0:
+                        key = start+int(pending[0])
+                        pose = self.get_frame_pose(key)
+                if key is None:
+                    self.fill_ahead_event.clear()
+            if key is None:
+                continue
+            try:
+                self.get_frame_image(key, pose, self.last_output_index)
+            except Exception as e:
+                logging.warning("Could not prerender frame %d: %s" % (key, e))
+                self.fill_ahead_event.clear()
 
-        numpy_image = convert_output_image_from_torch_to_numpy(output_image)
+    # 将渲染结果绘制到结果图像面板
+    def show_result_image(self, numpy_image):
         self.last_output_numpy_image = numpy_image
         wx_image = wx.ImageFromBuffer(
             numpy_image.shape[0],
@@ -2324,8 +1743,9 @@ class MainFrame(wx.Frame):
                       True)
         del dc
 
-        self.Refresh()
-        self.Update()
+        # 只刷新结果图像面板，时间轴和曲线面板有自己的缓存背景，不需要跟着重绘
+        self.result_image_panel.Refresh()
+        self.result_image_panel.Update()
 
     # 定时更新图像的回调函数
     def update_images(self, event: wx.Event):
@@ -2373,6 +1793,8 @@ if __name__ == "__main__":
         default='standard_float',
         choices=['standard_float', 'separable_float', 'standard_half', 'separable_half'],
         help='The model to use.')
+    parser.add_argument('--render_cache_mb', type=int, required=False, default=512,
+                        help='Memory budget of the rendered timeline frames kept for scrubbing and playback.')
     args = parser.parse_args()
 
     device = torch.device('cuda')
@@ -2383,7 +1805,7 @@ if __name__ == "__main__":
         sys.exit()
 
     app = wx.App()
-    main_frame = MainFrame(poser, device)
+    main_frame = MainFrame(poser, device, render_cache_bytes=args.render_cache_mb * 1024 * 1024)
     main_frame.Show(True)
     main_frame.Maximize(True)
     main_frame.timer.Start(30)
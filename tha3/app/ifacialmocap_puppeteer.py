@@ -16,10 +16,11 @@ import torch
 import wx
 
 from tha3.poser.poser import Poser
+from tha3.app.render_worker import RenderWorker
+from tha3.image_cache import PreprocessedImageCache, load_character_image
 from tha3.mocap.ifacialmocap_constants import *
 from tha3.mocap.ifacialmocap_pose_converter import IFacialMocapPoseConverter
-from tha3.util import torch_linear_to_srgb, resize_PIL_image, extract_PIL_image_from_filelike, \
-    extract_pytorch_image_from_PIL_image
+from tha3.util import torch_linear_to_srgb
 
 
 def convert_linear_to_srgb(image: torch.Tensor) -> torch.Tensor:
@@ -57,9 +58,13 @@ class MainFrame(wx.Frame):
         self.result_image_bitmap = wx.Bitmap(self.poser.get_image_size(), self.poser.get_image_size())
         self.wx_source_image = None
         self.torch_source_image = None
+        self.image_cache = PreprocessedImageCache()
         self.last_pose = None
         self.fps_statistics = FpsStatistics()
         self.last_update_time = None
+        self.poser_lock = threading.Lock()
+        self.render_worker = RenderWorker(self.render_result_image, self.show_result_image,
+                                          fail_func=self.on_render_failed)
 
         self.create_receiving_socket()
         self.create_ui()
@@ -85,6 +90,9 @@ class MainFrame(wx.Frame):
         self.animation_timer.Stop()
         self.capture_timer.Stop()
 
+        # Stop the render worker
+        self.render_worker.stop()
+
         # Close receiving socket
         self.receiving_socket.close()
 
@@ -320,13 +328,18 @@ class MainFrame(wx.Frame):
             del dc
             return
 
+        self.render_worker.submit((current_pose, self.output_background_choice.GetSelection()))
+
+    def render_result_image(self, request):
+        current_pose, background_choice = request
         pose = torch.tensor(current_pose, device=self.device, dtype=self.poser.get_dtype())
 
-        with torch.no_grad():
+        with self.poser_lock, torch.no_grad():
+            if self.torch_source_image is None:
+                return None
             output_image = self.poser.pose(self.torch_source_image, pose)[0].float()
             output_image = convert_linear_to_srgb((output_image + 1.0) / 2.0)
 
-            background_choice = self.output_background_choice.GetSelection()
             if background_choice == 0:
                 pass
             else:
@@ -348,7 +361,14 @@ class MainFrame(wx.Frame):
             output_image = 255.0 * torch.transpose(output_image.reshape(c, h * w), 0, 1).reshape(h, w, c)
             output_image = output_image.byte()
 
-        numpy_image = output_image.detach().cpu().numpy()
+        return output_image.detach().cpu().numpy()
+
+    def on_render_failed(self, request, error):
+        # the pose is requested again by the next update
+        if request[0] == self.last_pose:
+            self.last_pose = None
+
+    def show_result_image(self, request, numpy_image):
         wx_image = wx.ImageFromBuffer(numpy_image.shape[0],
                                       numpy_image.shape[1],
                                       numpy_image[:, :, 0:3].tobytes(),
@@ -369,7 +389,9 @@ class MainFrame(wx.Frame):
             fps = 1.0 / (elapsed_time / 10**9)
             if self.torch_source_image is not None:
                 self.fps_statistics.add_fps(fps)
-            self.fps_text.SetLabelText("FPS = %0.2f" % self.fps_statistics.get_average_fps())
+            stats = self.render_worker.get_stats()
+            self.fps_text.SetLabelText("FPS = %0.2f  Queue = %d  Dropped = %d" % (
+                self.fps_statistics.get_average_fps(), stats['depth'], stats['dropped']))
         self.last_update_time = time_now
 
         self.Refresh()
@@ -386,18 +408,19 @@ class MainFrame(wx.Frame):
         if file_dialog.ShowModal() == wx.ID_OK:
             image_file_name = os.path.join(file_dialog.GetDirectory(), file_dialog.GetFilename())
             try:
-                pil_image = resize_PIL_image(
-                    extract_PIL_image_from_filelike(image_file_name),
-                    (self.poser.get_image_size(), self.poser.get_image_size()))
-                w, h = pil_image.size
-                if pil_image.mode != 'RGBA':
+                try:
+                    rgba, image = load_character_image(image_file_name, self.poser.get_image_size(), self.image_cache)
+                except RuntimeError:
                     self.source_image_string = "Image must have alpha channel!"
                     self.wx_source_image = None
                     self.torch_source_image = None
                 else:
-                    self.wx_source_image = wx.Bitmap.FromBufferRGBA(w, h, pil_image.convert("RGBA").tobytes())
-                    self.torch_source_image = extract_pytorch_image_from_PIL_image(pil_image) \
+                    h, w = rgba.shape[0], rgba.shape[1]
+                    self.wx_source_image = wx.Bitmap.FromBufferRGBA(w, h, rgba.tobytes())
+                    self.torch_source_image = torch.from_numpy(image)\
                         .to(self.device).to(self.poser.get_dtype())
+                with self.poser_lock:
+                    self.poser.register_image(self.torch_source_image)
                 self.update_source_image_bitmap()
             except:
                 message_dialog = wx.MessageDialog(self, "Could not load image " + image_file_name, "Poser", wx.OK)
@@ -0,0 +1,516 @@
+import json
+import math
+import os
+import threading
+
+import numpy
+
+
+# 一条轨道上的关键帧，按帧号排好序按列存放帧号、值、起点和终点控制柄，多预设的slider还有每个关键帧的预设类型
+class TimelineTrack:
+    def __init__(self, times, values, start_controls, end_controls, types=None):
+        self.times = numpy.asarray(times, dtype=numpy.int64)
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+        self.start_controls = numpy.asarray(start_controls, dtype=numpy.float64).reshape(-1, 2)
+        self.end_controls = numpy.asarray(end_controls, dtype=numpy.float64).reshape(-1, 2)
+        if types is None:
+            types = numpy.zeros(len(self.times))
+        self.types = numpy.asarray(types, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.times)
+
+    # 关键帧数据统一成(value,start_control_x,start_control_y,end_control_x,end_control_y,type)，整数值保持为int
+    @staticmethod
+    def make_row(value, start_control, end_control, type):
+        row = [float(v) for v in [value, start_control[0], start_control[1], end_control[0], end_control[1]]]
+        return tuple(int(v) if v.is_integer() else v for v in row) + (int(type),)
+
+    # 二分查找帧号，返回(插入位置,该帧是否已经是关键帧)
+    def find(self, time):
+        i = int(numpy.searchsorted(self.times, time))
+        return i, i < len(self.times) and int(self.times[i]) == time
+
+    def get_row(self, i):
+        return TimelineTrack.make_row(self.values[i], self.start_controls[i], self.end_controls[i], self.types[i])
+
+    def set_row(self, i, row):
+        self.values[i] = row[0]
+        self.start_controls[i] = row[1:3]
+        self.end_controls[i] = row[3:5]
+        self.types[i] = row[5]
+
+    def insert_row(self, i, time, row):
+        self.times = numpy.insert(self.times, i, time)
+        self.values = numpy.insert(self.values, i, row[0])
+        self.start_controls = numpy.insert(self.start_controls, i, row[1:3], axis=0)
+        self.end_controls = numpy.insert(self.end_controls, i, row[3:5], axis=0)
+        self.types = numpy.insert(self.types, i, row[5])
+
+    def delete_row(self, i):
+        self.times = numpy.delete(self.times, i)
+        self.values = numpy.delete(self.values, i)
+        self.start_controls = numpy.delete(self.start_controls, i, axis=0)
+        self.end_controls = numpy.delete(self.end_controls, i, axis=0)
+        self.types = numpy.delete(self.types, i)
+
+
+# 时间轴关键帧数据，不依赖wx，编辑器和无界面渲染共用
+class ParameterStore:
+    def __init__(self, frame_num=300):
+        self.now_key_value = 0
+        self.point_nomal_size = 2
+        self.frame_num = frame_num
+        self.morph_lable = ["eyebrow","eye","mouth","iris_morphs"]
+        self.non_morph_lable = ["iris_rotation_x","iris_rotation_y","head_x","head_y","neck_z","body_y","body_z","breathing"]
+        self.selected_pointes = [] # [(key_num,y_lable),(0,"eyebrow")]
+        self.temp_delete_parameter_map = {}
+        self.parameter_map = {}
+        self.timeline_lable_map = {}
+        self.track_keys = [(lable,dirname) for lable in self.morph_lable for dirname in ["left","right"]]+self.non_morph_lable
+        self.tracks = {} # {("eyebrow","left"):TimelineTrack,"head_x":TimelineTrack}
+        # 界面线程修改时间轴数据时持有，预渲染线程和渲染线程读取时间轴数据时持有，不会读到改了一半的数据
+        self.lock = threading.RLock()
+        self.init_data_map()
+
+    # 设置选中点
+    def set_selected_pointes(self,selected_point):
+        self.selected_pointes.clear()
+        self.selected_pointes = [selected_point]
+    
+    # 清空选中点列表
+    def clear_selected_pointes(self):
+        self.selected_pointes.clear()
+
+    # 获取选中的点的帧
+    def get_selected_point_frame(self):
+        return self.selected_pointes[0][0]
+    
+    # 获取选中的点的标签
+    def get_selected_point_lable(self):
+        return self.selected_pointes[0][1]
+
+    # 初始化时间轴的数据矩阵
+    def init_data_map(self):
+        with self.lock:
+            self.render_flage_map = numpy.zeros(self.frame_num+1, dtype=numpy.uint8) # 标记每一帧是否已经有临时渲染，曲线段被重新计算时清掉
+            # 每一帧上所有slider的值，前面是多预设slider的left和right，后面是单一slider
+            self.value_data_map = numpy.zeros((self.frame_num+1, len(self.morph_lable)*2+len(self.non_morph_lable)), dtype=numpy.float32)
+            self.value_data_map[:, :len(self.morph_lable)*2] = -1000
+            self.type_data_map = numpy.zeros((self.frame_num+1, len(self.morph_lable)), dtype=numpy.int32) # 每一帧上多预设slider的预设类型
+
+    # 数据被修改的帧的临时渲染失效
+    def invalidate_render_range(self,begin,end):
+        self.render_flage_map[max(begin,0):end] = 0
+
+    # 修改时间轴长度，数据矩阵会被清空
+    def set_frame_num(self,frame_num):
+        with self.lock:
+            self.frame_num = frame_num
+            self.init_data_map()
+
+    # 多预设slider的left或right在value_data_map中的列
+    def morph_column(self,lable,dirname):
+        return self.morph_lable.index(lable)*2+(0 if dirname == "left" else 1)
+
+    # 单一slider在value_data_map中的列
+    def non_morph_column(self,lable):
+        return len(self.morph_lable)*2+self.non_morph_lable.index(lable)
+
+    # 获取某一帧上多预设slider的预设类型和值，曲线上的值四舍五入到slider的整数值
+    def get_morph_data(self,key,lable,dirname):
+        return int(self.type_data_map[key][self.morph_lable.index(lable)]), int(round(float(self.value_data_map[key][self.morph_column(lable,dirname)])))
+
+    # 获取某一帧上单一slider的值
+    def get_non_morph_data(self,key,lable):
+        return int(round(float(self.value_data_map[key][self.non_morph_column(lable)])))
+
+    # 清空所有关键帧数据
+    def clear_data(self):
+        with self.lock:
+            self.parameter_map = {}
+            self.tracks = {}
+            self.init_data_map()
+
+    # 读取预设文件数据
+    def load_preset_data(self,path):
+        with self.lock:
+            # 先清空
+            self.clear_data()
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                    for k,v in data.items():
+                        self.parameter_map[int(k)] = v
+
+    def set(self,num,map):
+        with self.lock:
+            self.parameter_map[num] = map
+    
+    # 将标签转换为纵坐标的值
+    def find_lable_y(self, lable_name):
+        if lable_name in self.timeline_lable_map:
+            return self.timeline_lable_map[lable_name]
+        else:
+            return -1
+    
+    # 将坐标值转换为标签
+    def find_y_lable_str(self,lable_y):
+        if lable_y in self.timeline_lable_map:
+            return self.timeline_lable_map[lable_y]
+        else:
+            return None
+        
+    # 寻找被选中的标记点，传入的是鼠标点击事件获取的坐标值，时间轴slider长度，slider的前面的空隙
+    def find_selected_point(self,click_x,click_y,slider_width,slider_gap):
+        selected_point = None
+        x_key = None
+        y_lable = None
+
+        key_near = (click_x-slider_gap)*self.frame_num//slider_width
+        key_near_x = slider_gap+slider_width*(key_near/self.frame_num)
+        if abs(click_x-key_near_x)<=self.point_nomal_size:
+            x_key = key_near
+        else:
+            return selected_point
+
+        for i in [k for k in range(click_y-self.point_nomal_size,click_y+self.point_nomal_size+1)]:
+            lable_str = self.find_y_lable_str(i)
+            if lable_str is not None:
+                y_lable = lable_str
+                break
+
+        if x_key is not None and y_lable is not None:
+            selected_point = (x_key,y_lable)
+        
+        return selected_point
+        
+    def set_now_key_value(self,v):
+        self.now_key_value = v
+
+    def get_now_key_value(self):
+        return self.now_key_value
+    
+    # 清空时间轴游标指定的当前时间帧上的所有关键点数据
+    def clear_timeline_current_data(self):
+        with self.lock:
+            if self.now_key_value in self.parameter_map:
+                self.temp_delete_parameter_map.clear()
+                self.temp_delete_parameter_map[self.now_key_value] = self.parameter_map[self.now_key_value]
+                del self.parameter_map[self.now_key_value]
+    
+    # 删除选中的关键点的数据
+    def delete_selected_key_data(self):
+        with self.lock:
+            key = self.selected_pointes[0][0]
+            lable = self.selected_pointes[0][1]
+            if key in self.parameter_map and lable in self.parameter_map[key]:
+                self.temp_delete_parameter_map.clear()
+                self.temp_delete_parameter_map[key] = {lable:self.parameter_map[key][lable]}
+                self.get_selected_point_frame()
+                del self.parameter_map[key][lable]
+
+    # 三次贝塞尔缓动曲线函数求值
+    def cubic_bezier(self,in_x,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y):
+        x = in_x
+        if x < start_x:
+            x = 0
+        else:
+            x = x-start_x
+        x0 = 0
+        y0 = start_y
+        x1 = start_c_x + x0
+        y1 = start_c_y+ y0
+        x3 = end_x-start_x
+        y3 = end_y
+        x2 = end_c_x+x3
+        y2 = end_c_y+y3
+
+        P0 = (x0,y0)
+        P1 = (x1,y1)
+        P2 = (x2,y2)
+        P3 = (x3,y3)
+
+        # 定义三次方程的系数
+        a = P0[0] - 3 * P1[0] + 3 * P2[0] - P3[0]
+        b = 3 * P1[0] - 6 * P2[0] + 3 * P3[0]
+        c = 3 * P2[0] - 3 * P3[0]
+        d = P3[0] - x
+
+        roots = numpy.roots([a, b, c, d])
+        t = None
+        for root in roots:
+            if numpy.isreal(root) and 0 <= root <= 1:
+                t = root.real
+                break
+
+        y = None
+        # 如果找到了合适的t值，就代入y轴的方程，得到y值
+        if t is not None:
+            t = 1-t
+            y = (1 - t) ** 3 * P0[1] + 3 * (1 - t) ** 2 * t * P1[1] + 3 * (1 - t) * t ** 2 * P2[1] + t ** 3 * P3[1]
+            y = math.floor(y)
+        else:
+            # print("没有找到合适的t值")
+            if in_x == end_x:
+                y = self.cubic_bezier(in_x-1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
+            elif in_x == start_x:
+                y = self.cubic_bezier(in_x+1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
+            else:
+                y = self.cubic_bezier(in_x-1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)+self.cubic_bezier(in_x+1,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
+                y = y/2
+        return y
+
+    # 一次算出一段三次贝塞尔曲线在[begin,end)每一帧上的值，和逐帧调用cubic_bezier的结果完全一致
+    # 所有帧的三次方程的伴随矩阵一起交给eigvals求根，和numpy.roots逐帧求出的根相同，
+    # 根落在0或1附近、有多个候选根或者没有根的帧仍然交给cubic_bezier
+    def cubic_bezier_range(self,begin,end,start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y):
+        in_x = numpy.arange(begin,end)
+        if len(in_x) == 0:
+            return numpy.zeros(0, dtype=numpy.float64)
+        x = numpy.where(in_x < start_x, 0, in_x-start_x)
+        x0 = 0
+        y0 = start_y
+        x1 = start_c_x + x0
+        y1 = start_c_y+ y0
+        x3 = end_x-start_x
+        y3 = end_y
+        x2 = end_c_x+x3
+        y2 = end_c_y+y3
+
+        a = x0 - 3 * x1 + 3 * x2 - x3
+        b = 3 * x1 - 6 * x2 + 3 * x3
+        c = 3 * x2 - 3 * x3
+        d = (x3 - x).astype(numpy.float64)
+
+        safe = numpy.zeros(len(in_x), dtype=bool)
+        y = numpy.zeros(len(in_x), dtype=numpy.float64)
+        # numpy.roots会去掉开头和末尾为0的系数，d为0的帧末尾的0也会被去掉，这种帧交给cubic_bezier
+        leading = [float(v) for v in (a, b, c)]
+        while len(leading) > 0 and leading[0] == 0:
+            leading.pop(0)
+        solve = numpy.flatnonzero(d != 0)
+        if len(leading) > 0 and len(solve) > 0:
+            n = len(leading)
+            p = numpy.empty((len(solve), n+1), dtype=numpy.float64)
+            p[:, :n] = leading
+            p[:, n] = d[solve]
+            A = numpy.zeros((len(solve), n, n), dtype=numpy.float64)
+            A[:, 1:, :-1] = numpy.eye(n-1)
+            A[:, 0, :] = -p[:, 1:] / p[:, :1]
+            roots = numpy.linalg.eigvals(A)
+            real = numpy.real(roots)
+            imag = numpy.imag(roots)
+
+            # 和cubic_bezier一样取第一个落在[0,1]的实根
+            candidate = (imag == 0) & (real >= 0) & (real <= 1)
+            t = real[numpy.arange(len(solve)), numpy.argmax(candidate, axis=1)]
+            eps = 1e-9
+            near = (numpy.abs(imag) <= eps) & (real >= -eps) & (real <= 1+eps)
+            unique = candidate.any(axis=1) & (near.sum(axis=1) == 1) & (t > eps) & (t < 1-eps)
+
+            t = 1-t
+            value = (1 - t) ** 3 * y0 + 3 * (1 - t) ** 2 * t * y1 + 3 * (1 - t) * t ** 2 * y2 + t ** 3 * y3
+            # 贴近整数的值用和cubic_bezier相同的标量运算重算，向量化的幂运算差一位舍入就可能改变向下取整的结果
+            for i in numpy.flatnonzero(unique & (numpy.abs(value-numpy.rint(value)) <= 1e-6)):
+                ti = t[i]
+                value[i] = (1 - ti) ** 3 * y0 + 3 * (1 - ti) ** 2 * ti * y1 + 3 * (1 - ti) * ti ** 2 * y2 + ti ** 3 * y3
+            safe[solve[unique]] = True
+            y[solve[unique]] = numpy.floor(value[unique])
+
+        for i in numpy.flatnonzero(~safe):
+            y[i] = self.cubic_bezier(int(in_x[i]),start_x,start_y,start_c_x,start_c_y,end_c_x,end_c_y,end_x,end_y)
+        return y
+
+    # 将有多个预设的slider的值存到data中
+    def set_morph_control_panel_parame(self, slider, choice):
+        with self.lock:
+            key_num = self.get_now_key_value()
+            (classname,dirname) = slider.GetName().split("-")
+            v = slider.GetValue()
+            if key_num in self.parameter_map:
+                if classname in self.parameter_map[key_num]:
+                    self.parameter_map[key_num][classname]["type"] = choice.GetSelection()
+                    if dirname in self.parameter_map[key_num][classname]:
+                        self.parameter_map[key_num][classname][dirname]["value"] = v
+                    else:
+                        self.parameter_map[key_num][classname][dirname] = {"value":v,"control":{"start":[0,0],"end":[0,0]}}
+                else:
+                    self.parameter_map[key_num][classname] = {dirname:{"value":v,"control":{"start":[0,0],"end":[0,0]}}}
+            else:
+                self.parameter_map[key_num] = {classname: {dirname: {"value": v, "control": {"start": [0, 0], "end": [0, 0]}}}}
+
+    # 将只有一个预设的slider的值存到data中
+    def set_non_morph_control_panel_parame(self, slider):
+        with self.lock:
+            key_num = self.get_now_key_value()
+            classname = slider.GetName()
+            v = slider.GetValue()
+            if key_num in self.parameter_map:
+                if classname in self.parameter_map[key_num]:
+                    self.parameter_map[key_num][classname]["value"] = v
+                else:
+                    self.parameter_map[key_num][classname] = {"value":v,"control":{"start":[0,0],"end":[0,0]}}
+            else:
+                self.parameter_map[key_num] = {classname:{"value":v,"control":{"start":[0,0],"end":[0,0]}}}
+
+    # 从parameter_map中取出某一帧在某条轨道上的关键帧数据，没有则返回None
+    def get_track_row(self,track_key,key):
+        if key not in self.parameter_map:
+            return None
+        frame = self.parameter_map[key]
+        if isinstance(track_key,tuple):
+            (lable,dirname) = track_key
+            if lable in frame and dirname in frame[lable] and bool(frame[lable][dirname]):
+                v = frame[lable][dirname]
+                return TimelineTrack.make_row(v["value"],v["control"]["start"],v["control"]["end"],frame[lable].get("type",0))
+        elif track_key in frame and bool(frame[track_key]):
+            v = frame[track_key]
+            return TimelineTrack.make_row(v["value"],v["control"]["start"],v["control"]["end"],0)
+        return None
+
+    # 获取某条轨道上从key开始到下一个关键帧的曲线段，没有下一个关键帧时保持当前值到时间轴末尾
+    def find_back_segment(self,key,lables):
+        track_key = (lables[0],lables[1]) if len(lables) == 2 else lables[0]
+        if track_key not in self.tracks:
+            return {}
+        track = self.tracks[track_key]
+        i, found = track.find(key)
+        if not found:
+            return {}
+        value, start_control_x, start_control_y, end_control_x, end_control_y, type = track.get_row(i)
+        if i+1 < len(track):
+            end_key = int(track.times[i+1])
+            end_value, _, _, end_control_x, end_control_y, _ = track.get_row(i+1)
+            ret_map = {"start":(key,value),
+                       "start_control":(start_control_x,start_control_y),
+                       "end":(end_key,end_value),
+                       "end_control":(end_control_x,end_control_y),
+                       "frame_index":end_key}
+        else:
+            ret_map = {"start":(key,value),
+                       "start_control":(0,0),
+                       "end":(self.frame_num,value),
+                       "end_control":(0,0),
+                       "frame_index":self.frame_num}
+        if isinstance(track_key,tuple):
+            ret_map["type"] = type
+        return ret_map
+
+    # 把parameter_map中指定关键帧的数据同步到各条轨道，二分查找关键帧所在的行，只重新计算这一帧前后受影响的曲线段
+    def update_timeline_data_map_func(self,key):
+        with self.lock:
+            for track_key in self.track_keys:
+                row = self.get_track_row(track_key,key)
+                if track_key not in self.tracks:
+                    if row is None:
+                        continue
+                    self.tracks[track_key] = TimelineTrack(times=[],values=[],start_controls=[],end_controls=[],types=[])
+                track = self.tracks[track_key]
+                i, found = track.find(key)
+                if row is None:
+                    if not found:
+                        continue
+                    # 删除关键帧后前后两个关键帧之间连成一段
+                    track.delete_row(i)
+                    self.evaluate_track(track_key,i,i)
+                elif found:
+                    if track.get_row(i) == row:
+                        continue
+                    track.set_row(i,row)
+                    self.evaluate_track(track_key,i,i+1)
+                else:
+                    track.insert_row(i,key,row)
+                    self.evaluate_track(track_key,i,i+1)
+
+    # 更新时间轴参数板
+    def update_timeline_data_map(self):
+        with self.lock:
+            key = self.get_now_key_value()
+            self.update_timeline_data_map_func(key=key)
+            # 删除的关键帧不一定在游标所在的帧上，同步到轨道之后就不用再同步了
+            for key in list(self.temp_delete_parameter_map.keys()):
+                self.update_timeline_data_map_func(key=key)
+            self.temp_delete_parameter_map.clear()
+
+    # 从parameter_map按轨道整理出每条轨道的关键帧列
+    def build_tracks(self):
+        self.tracks = {}
+        keys = sorted(self.parameter_map.keys())
+        for track_key in self.track_keys:
+            rows = [(key,self.get_track_row(track_key,key)) for key in keys]
+            rows = [(key,row) for key,row in rows if row is not None]
+            if len(rows) > 0:
+                self.tracks[track_key] = TimelineTrack(times=[key for key,row in rows],
+                                                       values=[row[0] for key,row in rows],
+                                                       start_controls=[row[1:3] for key,row in rows],
+                                                       end_controls=[row[3:5] for key,row in rows],
+                                                       types=[row[5] for key,row in rows])
+
+    # 计算一条轨道上第first到第last段曲线，第0段是第一个关键帧之前，第i段是第i-1个到第i个关键帧之间，最后一段是最后一个关键帧之后
+    # 第一个关键帧之前和最后一个关键帧之后保持关键帧的值
+    def evaluate_track(self,track_key,first=0,last=None):
+        if isinstance(track_key,tuple):
+            column = self.morph_column(track_key[0],track_key[1])
+            type_column = self.morph_lable.index(track_key[0])
+        else:
+            column = self.non_morph_column(track_key)
+            type_column = None
+
+        track = self.tracks.get(track_key)
+        if track is None or len(track) == 0:
+            # 轨道上没有关键帧了，恢复默认值
+            self.tracks.pop(track_key,None)
+            if type_column is not None:
+                self.value_data_map[:, column] = -1000
+                self.invalidate_render_range(0,self.frame_num+1)
+                if (track_key[0],"left") not in self.tracks and (track_key[0],"right") not in self.tracks:
+                    self.type_data_map[:, type_column] = 0
+            else:
+                self.value_data_map[:, column] = 0
+                self.invalidate_render_range(0,self.frame_num+1)
+            return
+
+        n = len(track)
+        if last is None:
+            last = n
+        for i in range(max(first,0),min(last,n)+1):
+            if i == 0:
+                value, _, _, _, _, type = track.get_row(0)
+                segment = (0,value,(0,0),int(track.times[0]),value,(0,0),type)
+            elif i == n:
+                value, _, _, _, _, type = track.get_row(n-1)
+                segment = (int(track.times[n-1]),value,(0,0),self.frame_num,value,(0,0),type)
+            else:
+                start_value, start_control_x, start_control_y, _, _, type = track.get_row(i-1)
+                end_value, _, _, end_control_x, end_control_y, _ = track.get_row(i)
+                segment = (int(track.times[i-1]),start_value,(start_control_x,start_control_y),
+                           int(track.times[i]),end_value,(end_control_x,end_control_y),type)
+            start_x,start_y,start_control,end_x,end_y,end_control,type = segment
+            self.invalidate_render_range(start_x,end_x)
+            self.value_data_map[start_x:end_x, column] = self.cubic_bezier_range(begin=start_x,
+                                                                                 end=end_x,
+                                                                                 start_x=start_x,
+                                                                                 start_y=start_y,
+                                                                                 start_c_x=start_control[0],
+                                                                                 start_c_y=start_control[1],
+                                                                                 end_x=end_x,
+                                                                                 end_y=end_y,
+                                                                                 end_c_x=end_control[0],
+                                                                                 end_c_y=end_control[1])
+            if type_column is not None:
+                self.type_data_map[start_x:end_x, type_column] = type
+            if i == n:
+                # 每一段都不包含结束帧，最后一帧frame_num要单独写入，最后一个关键帧正好在frame_num上时也保持它的值
+                self.invalidate_render_range(self.frame_num,self.frame_num+1)
+                self.value_data_map[self.frame_num, column] = value
+                if type_column is not None:
+                    self.type_data_map[self.frame_num, type_column] = type
+
+    # 更新面板上所有的关键点的相关矩阵数据，每条轨道的每一段只计算一次
+    def update_all_timeline_data_map(self):
+        with self.lock:
+            self.build_tracks()
+            self.init_data_map()
+            for track_key in list(self.tracks.keys()):
+                self.evaluate_track(track_key)
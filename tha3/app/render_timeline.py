@@ -0,0 +1,262 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+sys.path.append(os.getcwd())
+
+import PIL.Image
+import numpy
+import torch
+
+from tha3.app.parameter_store import ParameterStore
+from tha3.image_cache import PreprocessedImageCache, load_character_image
+from tha3.poser.modes.load_poser import load_poser
+from tha3.poser.poser import Poser, PoseParameterCategory
+from tha3.util import convert_output_image_from_torch_to_numpy, rgb_to_numpy_image
+
+PRESET_DEFAULT_PATH = "./preset"
+
+# 时间轴标签对应的修改器类别，和编辑器里的控制面板一一对应
+MORPH_LABLE_CATEGORIES = {
+    "eyebrow": PoseParameterCategory.EYEBROW,
+    "eye": PoseParameterCategory.EYE,
+    "mouth": PoseParameterCategory.MOUTH,
+    "iris_morphs": PoseParameterCategory.IRIS_MORPH,
+}
+
+
+def find_preset_file(preset):
+    """
+    Args:
+        preset: path of a preset json, or the name of a preset in ./preset with or without the .json suffix
+    Returns:
+        path of the preset file
+    """
+    if os.path.isfile(preset):
+        return preset
+    if not preset.endswith(".json"):
+        preset = preset + ".json"
+    return os.path.join(PRESET_DEFAULT_PATH, preset)
+
+
+def load_timeline(preset_file_name) -> ParameterStore:
+    data = ParameterStore()
+    if not os.path.isfile(preset_file_name):
+        raise RuntimeError("Could not find preset " + preset_file_name)
+    data.load_preset_data(preset_file_name)
+    # 编辑器的时间轴只有300帧，无界面渲染时按预设的最后一个关键帧加长
+    if len(data.parameter_map) > 0 and max(data.parameter_map.keys()) > data.frame_num:
+        data.set_frame_num(max(data.parameter_map.keys()))
+    data.update_all_timeline_data_map()
+    # 最后一个关键帧所在的帧必须是关键帧的值，否则最后一帧会渲染成默认姿势
+    for track_key, track in data.tracks.items():
+        if isinstance(track_key, tuple):
+            column = data.morph_column(track_key[0], track_key[1])
+        else:
+            column = data.non_morph_column(track_key)
+        last_key = int(track.times[-1])
+        if not numpy.isclose(data.value_data_map[last_key, column], track.get_row(len(track) - 1)[0], atol=1e-3):
+            raise RuntimeError("Timeline of %s does not hold its last key frame %d" % (str(track_key), last_key))
+    return data
+
+
+def evaluate_timeline_poses(data: ParameterStore,
+                            poser: Poser,
+                            end_frame: Optional[int] = None,
+                            start_frame: int = 0,
+                            dtype=numpy.float32,
+                            hidden_lables: Iterable[str] = ()):
+    """
+    evaluate the interpolated slider values of every frame into pose vectors, the same way the control panels of
+    the editor do when the timeline slider is moved
+    Args:
+        data: timeline with its data maps already updated
+        poser: poser the poses are made for
+        end_frame: last frame to evaluate, the last key frame of the timeline if None
+        start_frame: first frame to evaluate
+        dtype: dtype of the poses, numpy.float64 gives the exact values the control panels compute
+        hidden_lables: morph lables whose Show checkbox is unchecked in the editor, their discrete groups stay 0
+    Returns:
+        poses of shape (end_frame-start_frame+1, num_parameters) (numpy array)
+    """
+    if end_frame is None:
+        end_frame = max(data.parameter_map.keys()) if len(data.parameter_map) > 0 else -1
+    end_frame = min(end_frame, data.frame_num)
+    param_groups = poser.get_pose_parameter_groups()
+    poses = numpy.zeros((max(end_frame + 1 - start_frame, 0), poser.get_num_parameters()), dtype=dtype)
+    # slider只接受整数值，和ParameterStore.get_morph_data一样四舍五入
+    values = numpy.rint(data.value_data_map[start_frame:end_frame + 1].astype(numpy.float64))
+
+    for lable_index, lable in enumerate(data.morph_lable):
+        groups = [group for group in param_groups if group.get_category() == MORPH_LABLE_CATEGORIES[lable]]
+        if len(groups) == 0:
+            continue
+        types = data.type_data_map[start_frame:end_frame + 1, lable_index]
+        left = numpy.clip(values[:, data.morph_column(lable, "left")], -1000, 1000)
+        right = numpy.clip(values[:, data.morph_column(lable, "right")], -1000, 1000)
+        for type in numpy.unique(types).tolist():
+            rows = types == type
+            group = groups[type]
+            param_index = group.get_parameter_index()
+            if group.is_discrete():
+                # 编辑器里离散的修改器默认勾选Show，取消勾选时保持0
+                if lable not in hidden_lables:
+                    poses[rows, param_index:param_index + group.get_arity()] = 1.0
+                continue
+            param_range = group.get_range()
+            alpha = (left[rows] + 1000) / 2000.0
+            poses[rows, param_index] = param_range[0] + (param_range[1] - param_range[0]) * alpha
+            if group.get_arity() == 2:
+                alpha = (right[rows] + 1000) / 2000.0
+                poses[rows, param_index + 1] = param_range[0] + (param_range[1] - param_range[0]) * alpha
+
+    for lable in data.non_morph_lable:
+        groups = [group for group in param_groups if group.get_group_name() == lable]
+        if len(groups) == 0:
+            continue
+        param_range = groups[0].get_range()
+        param_index = groups[0].get_parameter_index()
+        # 和编辑器的slider一样把值限制在slider的范围内
+        min_value = int(param_range[0] * 1000)
+        max_value = int(param_range[1] * 1000)
+        value = numpy.clip(values[:, data.non_morph_column(lable)], min_value, max_value)
+        alpha = (value - min_value) * 1.0 / (max_value - min_value)
+        poses[:, param_index] = param_range[0] + (param_range[1] - param_range[0]) * alpha
+
+    return poses
+
+
+def load_source_image(poser: Poser, image_file_name, device: torch.device,
+                      cache: Optional[PreprocessedImageCache] = None):
+    _, image = load_character_image(image_file_name, poser.get_image_size(), cache)
+    return torch.from_numpy(image).to(device).to(poser.get_dtype())
+
+
+def save_output_image(output_image, image_file_name):
+    # 和编辑器一样按输出的通道数转换，不是rgba的输出也能保存
+    if output_image.shape[0] == 3:
+        numpy_image, mode = rgb_to_numpy_image(output_image), 'RGB'
+    else:
+        numpy_image, mode = convert_output_image_from_torch_to_numpy(output_image), 'RGBA'
+    PIL.Image.fromarray(numpy.uint8(numpy.rint(numpy_image * 255.0)), mode=mode).save(image_file_name)
+
+
+def render_timeline(poser: Poser,
+                    device: torch.device,
+                    image_file_name,
+                    preset_file_name,
+                    output_dir,
+                    file_name=None,
+                    output_index: int = 0,
+                    batch_size: int = 32,
+                    num_writers: int = 4,
+                    max_batch_bytes: Optional[int] = None):
+    """
+    render every frame of a preset timeline to png files without any ui
+
+    the poses are rendered in batches on a worker thread while the pngs of the finished batches are encoded and
+    written by a thread pool. the files are named like the ones of the render button of the editor,
+    <file_name>_<frame>.png for the frames from 0 to the last key frame.
+    Args:
+        poser: poser to render with
+        device: device of the poser
+        image_file_name: rgba character image
+        preset_file_name: preset json of the timeline
+        output_dir: directory the pngs are written to
+        file_name: head of the png file names, the name of the preset if None
+        output_index: output of the poser to save
+        batch_size: poses per batch, pose_batch further splits a batch that does not fit the device memory
+        num_writers: threads encoding and writing pngs
+        max_batch_bytes: memory budget of one pose_batch chunk, see GeneralPoser02.pose_batch
+    Returns:
+        (number of frames written, seconds, frames per second)
+    """
+    if file_name is None:
+        file_name = os.path.splitext(os.path.basename(preset_file_name))[0]
+    tic = time.perf_counter()
+    poses = evaluate_timeline_poses(load_timeline(preset_file_name), poser)
+    source_image = load_source_image(poser, image_file_name, device, PreprocessedImageCache())
+    poser.register_image(source_image)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # 渲染好的批次，容量限制住还没写出的图片占用的内存
+    batches = queue.Queue(maxsize=2)
+
+    def render():
+        try:
+            with torch.no_grad():
+                for start in range(0, poses.shape[0], batch_size):
+                    pose = torch.from_numpy(poses[start:start + batch_size]).to(device).to(poser.get_dtype())
+                    output_images = poser.pose_batch(source_image, pose, output_index, max_batch_bytes)
+                    batches.put((start, output_images.detach().cpu()))
+            batches.put(None)
+        except BaseException as e:
+            batches.put(e)
+
+    worker = threading.Thread(target=render, daemon=True)
+    worker.start()
+    with ThreadPoolExecutor(max_workers=num_writers) as writers:
+        futures = []
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            start, output_images = batch
+            for i in range(output_images.shape[0]):
+                image_file_name = os.path.join(output_dir, file_name + "_" + str(start + i).zfill(4) + '.png')
+                futures.append(writers.submit(save_output_image, output_images[i], image_file_name))
+        for future in futures:
+            future.result()
+    worker.join()
+
+    seconds = time.perf_counter() - tic
+    frame_count = poses.shape[0]
+    return frame_count, seconds, frame_count / seconds if seconds > 0 else 0.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render a preset timeline of the editor to png files without ui.')
+    parser.add_argument(
+        '--model',
+        type=str,
+        required=False,
+        default='standard_float',
+        choices=['standard_float', 'separable_float', 'standard_half', 'separable_half'],
+        help='The model to use.')
+    parser.add_argument('--image', type=str, required=True, help='The character image (png with alpha channel).')
+    parser.add_argument('--preset', type=str, required=True,
+                        help='The preset json, or the name of a preset in ./preset.')
+    parser.add_argument('--output_dir', type=str, required=False, default='data/render',
+                        help='The directory the png files are written to.')
+    parser.add_argument('--filename', type=str, required=False, default=None,
+                        help='The head of the png file names, the preset name by default.')
+    parser.add_argument('--output_index', type=int, required=False, default=0, help='The output of the poser to save.')
+    parser.add_argument('--batch_size', type=int, required=False, default=32, help='The poses rendered per batch.')
+    parser.add_argument('--writers', type=int, required=False, default=4,
+                        help='The threads encoding and writing png files.')
+    parser.add_argument('--device', type=str, required=False, default='cuda', help='The device to render on.')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    try:
+        poser = load_poser(args.model, device)
+        frame_count, seconds, fps = render_timeline(poser,
+                                                    device,
+                                                    args.image,
+                                                    find_preset_file(args.preset),
+                                                    args.output_dir,
+                                                    file_name=args.filename,
+                                                    output_index=args.output_index,
+                                                    batch_size=args.batch_size,
+                                                    num_writers=args.writers)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    print("Rendered %d frames in %.2fs (%.1f fps)" % (frame_count, seconds, fps))
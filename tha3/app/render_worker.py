@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import wx
+
+
+class RenderWorker:
+    """
+    renders requests of a wx app on a background thread
+
+    the worker holds a single pending request. submitting while a request is still pending replaces it, the
+    replaced request is counted as dropped, so the worker always renders the latest request and never falls
+    behind the ui. the result of every finished render is handed to the deliver function on the ui thread with
+    wx.CallAfter, a render that raised is handed to the fail function the same way.
+    """
+
+    def __init__(self,
+                 render_func: Callable[[Any], Any],
+                 deliver_func: Callable[[Any, Any], None],
+                 name: str = "render-worker",
+                 fail_func: Optional[Callable[[Any, Exception], None]] = None):
+        """
+        Args:
+            render_func: called on the worker thread with a request, returns the result to deliver
+            deliver_func: called on the ui thread with the request and its result
+            name: name of the worker thread
+            fail_func: called on the ui thread with the request and the exception when render_func raised
+        """
+        self.render_func = render_func
+        self.deliver_func = deliver_func
+        self.fail_func = fail_func
+        self.condition = threading.Condition()
+        self.pending = None
+        self.has_pending = False
+        self.busy = False
+        self.stopped = False
+        self.submitted = 0
+        self.rendered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_render_seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: Any):
+        with self.condition:
+            if self.has_pending:
+                self.dropped += 1
+            self.pending = request
+            self.has_pending = True
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def is_idle(self) -> bool:
+        with self.condition:
+            return not self.has_pending and not self.busy
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        block until no request is waiting or being rendered
+        Args:
+            timeout: seconds to wait at most, wait forever if None
+        Returns:
+            whether the worker is idle, also True once it is stopped
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.stopped or (not self.has_pending and not self.busy), timeout)
+
+    def get_queue_depth(self) -> int:
+        """
+        Returns:
+            requests waiting or being rendered, at most 2
+        """
+        with self.condition:
+            return int(self.has_pending) + int(self.busy)
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            return {
+                'depth': int(self.has_pending) + int(self.busy),
+                'submitted': self.submitted,
+                'rendered': self.rendered,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'render_ms': self.last_render_seconds * 1000.0,
+            }
+
+    def stop(self, timeout: Optional[float] = 1.0):
+        with self.condition:
+            self.stopped = True
+            self.pending = None
+            self.has_pending = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.has_pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                request = self.pending
+                self.pending = None
+                self.has_pending = False
+                self.busy = True
+            tic = time.perf_counter()
+            try:
+                result = self.render_func(request)
+            except Exception as e:
+                result = None
+                with self.condition:
+                    self.failed += 1
+                logging.warning("Render failed: %s" % e)
+                if self.fail_func is not None:
+                    wx.CallAfter(self.fail, request, e)
+            seconds = time.perf_counter() - tic
+            with self.condition:
+                self.busy = False
+                self.last_render_seconds = seconds
+                self.condition.notify_all()
+                if result is None or self.stopped:
+                    continue
+                self.rendered += 1
+            wx.CallAfter(self.deliver, request, result)
+
+    def deliver(self, request: Any, result: Any):
+        if self.stopped:
+            return
+        self.deliver_func(request, result)
+
+    def fail(self, request: Any, error: Exception):
+        if self.stopped:
+            return
+        self.fail_func(request, error)
@@ -0,0 +1,88 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+import PIL.Image
+import numpy
+
+from tha3.util import numpy_srgb_to_linear, clear_transparent_pixels, \
+    extract_numpy_image_from_PIL_image_with_pytorch_layout
+from utils import preprocessing_image
+
+
+# 原来main.py中逐像素的预处理，用于对比结果和耗时
+def legacy_main_preprocessing(img, image_width):
+    img = img.copy()
+    for i, px in enumerate(img.getdata()):
+        if px[3] <= 0:
+            y = i // image_width
+            x = i % image_width
+            img.putpixel((x, y), (0, 0, 0, 0))
+    np_image = numpy.array(img.crop((0, 0, image_width, image_width))) / 255
+    clipped_image = numpy.clip(np_image, 0, 1)
+    srgb_image = numpy.where(clipped_image <= 0.04045, clipped_image / 12.92, ((clipped_image + 0.055) / 1.055) ** 2.4)
+    h, w, c = srgb_image.shape
+    linear_image = srgb_image.reshape(h * w, c)
+    for pixel in linear_image:
+        if pixel[3] == 0.0:
+            pixel[0:3] = 0.0
+    return img, linear_image.transpose().reshape(c, h, w)
+
+
+def new_main_preprocessing(img, image_width):
+    img = PIL.Image.fromarray(clear_transparent_pixels(numpy.asarray(img)), 'RGBA')
+    return img, preprocessing_image(img.crop((0, 0, image_width, image_width)))
+
+
+# 原来tha3.util中逐像素的预处理
+def legacy_tha3_preprocessing(pil_image):
+    pil_image = pil_image.copy()
+    image_size = pil_image.width
+    for i, px in enumerate(pil_image.getdata()):
+        if px[3] <= 0:
+            y = i // image_size
+            x = i % image_size
+            pil_image.putpixel((x, y), (0, 0, 0, 0))
+    image = (numpy.asarray(pil_image) / 255.0).reshape(image_size, image_size, 4)
+    image[:, :, 0:3] = numpy_srgb_to_linear(image[:, :, 0:3])
+    return image.reshape(image_size * image_size, 4).transpose().reshape(4, image_size, image_size) * 2.0 - 1.0
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - tic
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the per-pixel and the vectorized image preprocessing.')
+    parser.add_argument('--image', type=str, required=True, help='The character image (png with alpha channel).')
+    parser.add_argument('--repeat', type=int, required=False, default=3, help='Runs of each version, the best is kept.')
+    args = parser.parse_args()
+
+    IMG_WIDTH = 512
+    img = PIL.Image.open(args.image).convert('RGBA')
+    img = img.resize((IMG_WIDTH, int(img.size[1] / (img.size[0] / IMG_WIDTH))))
+    square = img.crop((0, 0, IMG_WIDTH, IMG_WIDTH))
+
+    legacy_img, legacy = legacy_main_preprocessing(img, IMG_WIDTH)
+    new_img, new = new_main_preprocessing(img, IMG_WIDTH)
+    print("main.py      same result: %s, same masked image: %s" % (
+        numpy.array_equal(legacy, new), numpy.array_equal(numpy.asarray(legacy_img), numpy.asarray(new_img))))
+    print("  per-pixel %.3fs, vectorized %.4fs" % (
+        timeit(lambda: legacy_main_preprocessing(img, IMG_WIDTH), args.repeat),
+        timeit(lambda: new_main_preprocessing(img, IMG_WIDTH), args.repeat)))
+
+    legacy = legacy_tha3_preprocessing(square)
+    new = extract_numpy_image_from_PIL_image_with_pytorch_layout(square)
+    print("tha3.util    same result: %s" % numpy.array_equal(legacy, new))
+    print("  per-pixel %.3fs, vectorized %.4fs" % (
+        timeit(lambda: legacy_tha3_preprocessing(square), args.repeat),
+        timeit(lambda: extract_numpy_image_from_PIL_image_with_pytorch_layout(square), args.repeat)))
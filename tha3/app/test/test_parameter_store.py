@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import numpy
+
+from tha3.app.parameter_store import ParameterStore
+
+
+def make_key(value):
+    return {"value": value, "control": {"start": [0, 0], "end": [0, 0]}}
+
+
+# 曲线段中间的帧是小数时，slider上的值要四舍五入而不是向0截断
+def test_fractional_midpoints_are_rounded():
+    data = ParameterStore(frame_num=20)
+    data.set(0, {"head_x": make_key(0), "eyebrow": {"type": 1, "left": make_key(0)}})
+    data.set(10, {"head_x": make_key(-5), "eyebrow": {"type": 1, "left": make_key(13)}})
+    data.update_all_timeline_data_map()
+
+    head_x = data.non_morph_column("head_x")
+    eyebrow = data.morph_column("eyebrow", "left")
+    # 整数值的帧读回来不变
+    for key in range(data.frame_num + 1):
+        assert data.get_non_morph_data(key, "head_x") == int(data.value_data_map[key, head_x])
+        assert data.get_morph_data(key, "eyebrow", "left") == (1, int(data.value_data_map[key, eyebrow]))
+
+    # 两帧之间取平均得到的小数中点
+    midpoints = numpy.array([-0.6, -0.4, 12.9, 12.4, -4.5, 2.5], dtype=numpy.float32)
+    keys = range(1, 1 + len(midpoints))
+    data.value_data_map[keys, head_x] = midpoints
+    data.value_data_map[keys, eyebrow] = midpoints
+    expected = [-1, 0, 13, 12, -4, 2]
+    assert [data.get_non_morph_data(key, "head_x") for key in keys] == expected
+    assert [data.get_morph_data(key, "eyebrow", "left")[1] for key in keys] == expected
+    assert data.get_non_morph_data(20, "head_x") == -5
+    assert data.get_morph_data(20, "eyebrow", "left") == (1, 13)
+
+
+if __name__ == "__main__":
+    test_fractional_midpoints_are_rounded()
+    print("ok")
@@ -0,0 +1,68 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+
+from tha3.compute.cached_computation_protocol import CachedComputationProtocol
+
+
+class MemoizedComputationProtocol(CachedComputationProtocol, ABC):
+    """
+    CachedComputationProtocol that also reuses outputs across calls
+
+    every key may declare the slice of the pose (batch[1]) it depends on. the outputs of such a key are kept
+    from the last call and returned again as long as that slice of the pose is unchanged. the declared slice
+    has to cover the dependencies of all the inputs of the key as well. a key with an empty slice depends on the
+    source image only, its outputs are reused for pose batches of any size. the source image is not compared,
+    clear_memo() has to be called when it changes.
+    """
+
+    def __init__(self):
+        self.memo = {}
+        self.memo_hits = {}
+        self.memo_misses = {}
+
+    @abstractmethod
+    def get_pose_dependency(self, key: str) -> Optional[Tuple[int, int]]:
+        """
+        Args:
+            key: outputs key
+        Returns:
+            (start, end) of the pose parameters the outputs of the key depend on, or None to never reuse them
+        """
+        pass
+
+    def get_output(self,
+                   key: str,
+                   modules: Dict[str, Module],
+                   batch: List[Tensor],
+                   outputs: Dict[str, List[Tensor]]):
+        if key in outputs:
+            return outputs[key]
+        dependency = self.get_pose_dependency(key)
+        if dependency is None:
+            return super().get_output(key, modules, batch, outputs)
+        pose = batch[1][:, dependency[0]:dependency[1]]
+        memo = self.memo.get(key)
+        if memo is not None and (dependency[0] == dependency[1]
+                                 or memo[0].shape == pose.shape and torch.equal(memo[0], pose)):
+            self.memo_hits[key] = self.memo_hits.get(key, 0) + 1
+            outputs[key] = memo[1]
+            return outputs[key]
+        self.memo_misses[key] = self.memo_misses.get(key, 0) + 1
+        output = super().get_output(key, modules, batch, outputs)
+        self.memo[key] = (pose.clone(), output)
+        return output
+
+    def clear_memo(self):
+        self.memo.clear()
+
+    def get_memo_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns:
+            hit and miss count of every memoized key since the protocol was created
+        """
+        keys = set(self.memo_hits) | set(self.memo_misses)
+        return {key: {'hits': self.memo_hits.get(key, 0), 'misses': self.memo_misses.get(key, 0)} for key in keys}
@@ -0,0 +1,107 @@
+import hashlib
+import os
+from typing import Dict, Optional
+
+import numpy
+
+from tha3.util import resize_PIL_image, extract_PIL_image_from_filelike, \
+    extract_numpy_image_from_PIL_image_with_pytorch_layout
+
+IMAGE_CACHE_DEFAULT_DIR = "data/image_cache"
+
+
+def hash_file(file_name) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class PreprocessedImageCache:
+    """
+    content addressed cache of preprocessed character images
+
+    the arrays made from a character image are saved as .npy files named by the hash of the image file, the
+    target size, the dtype and the preprocessing variant, and are memory mapped back on a hit, so a restart or
+    a character switch skips decoding, resizing and preprocessing. an edited image hashes to a new key, the old
+    files are simply never read again.
+    """
+    VERSION = 1
+
+    def __init__(self, directory=IMAGE_CACHE_DEFAULT_DIR):
+        self.directory = directory
+
+    def key(self, file_name, size, dtype, variant) -> str:
+        """
+        Args:
+            file_name: source image
+            size: target size the image is resized to, (w, h) or an int
+            dtype: dtype of the stored tensor
+            variant: name of the preprocessing, arrays of different preprocessings never share a key
+        Returns:
+            cache key of the preprocessed arrays
+        """
+        if isinstance(size, int):
+            size = (size, size)
+        return '%s_%dx%d_%s_%s_v%d' % (hash_file(file_name)[:20], size[0], size[1], numpy.dtype(dtype).name, variant,
+                                      self.VERSION)
+
+    def path(self, key, name):
+        return os.path.join(self.directory, key + '.' + name + '.npy')
+
+    def get(self, key, names) -> Optional[Dict[str, numpy.ndarray]]:
+        """
+        Args:
+            key: cache key
+            names: names of the arrays stored under the key
+        Returns:
+            copy-on-write memory maps of the arrays by name, or None if any of them is missing or unreadable
+        """
+        arrays = {}
+        for name in names:
+            try:
+                arrays[name] = numpy.load(self.path(key, name), mmap_mode='c', allow_pickle=False)
+            except (OSError, ValueError):
+                return None
+        return arrays
+
+    def put(self, key, arrays: Dict[str, numpy.ndarray]):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for name, array in arrays.items():
+                path = self.path(key, name)
+                # write next to the target first so that a reader never maps a half written file
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    numpy.save(f, numpy.ascontiguousarray(array))
+                os.replace(tmp_path, path)
+        except OSError as e:
+            print("Could not write image cache:", e)
+
+
+def load_character_image(file_name, image_size, cache: Optional[PreprocessedImageCache] = None):
+    """
+    load a character image for the tha3 posers, from the cache when it has been preprocessed before
+    Args:
+        file_name: rgba character image
+        image_size: size of the poser input
+        cache: cache of preprocessed images, nothing is cached if None
+    Returns:
+        (resized rgba image of shape (h, w, 4), uint8, image in pytorch layout of shape (4, h, w), float32)
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(file_name, image_size, numpy.float32, 'tha3')
+        arrays = cache.get(key, ['rgba', 'image'])
+        if arrays is not None:
+            return arrays['rgba'], arrays['image']
+
+    pil_image = resize_PIL_image(extract_PIL_image_from_filelike(file_name), (image_size, image_size))
+    if pil_image.mode != 'RGBA':
+        raise RuntimeError("Image must have alpha channel: " + file_name)
+    rgba = numpy.asarray(pil_image)
+    image = extract_numpy_image_from_PIL_image_with_pytorch_layout(pil_image).astype(numpy.float32)
+    if cache is not None:
+        cache.put(key, {'rgba': rgba, 'image': image})
+    return rgba, image
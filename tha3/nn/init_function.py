@@ -1,3 +1,6 @@
+import sys
+import threading
+from contextlib import contextmanager
 from typing import Callable
 
 import torch
@@ -73,4 +76,58 @@ class ZeroInitialization:
 
 class NoInitialization:
     def __call__(self, module: Module) -> Module:
-        return module
\ No newline at end of file
+        return module
+
+
+# names of the in-place init functions that module constructors call, in torch.nn.init and imported above
+SKIPPED_INIT_FUNCTIONS = [
+    'uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_', 'orthogonal_',
+    'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'sparse_',
+]
+skip_weight_init_lock = threading.Lock()
+skip_weight_init_depth = 0
+skip_weight_init_saved = []
+skip_weight_init_thread = threading.local()
+
+
+def create_skippable_init_function(function):
+    def init_function(tensor, *args, **kwargs):
+        if getattr(skip_weight_init_thread, 'depth', 0) > 0:
+            return tensor
+        return function(tensor, *args, **kwargs)
+
+    return init_function
+
+
+@contextmanager
+def skip_weight_init():
+    """
+    make every weight initialization of the calling thread a no-op while modules are built
+
+    only for modules whose state dict is loaded right after they are built, their parameters are left
+    uninitialized. the init functions are wrapped process wide while any thread is inside the block, but the
+    wrappers only skip the initialization for threads inside it, a module built by another thread at the same
+    time is initialized as usual.
+    """
+    global skip_weight_init_depth
+    with skip_weight_init_lock:
+        if skip_weight_init_depth == 0:
+            this_module = sys.modules[__name__]
+            for owner in (torch.nn.init, this_module):
+                for name in SKIPPED_INIT_FUNCTIONS:
+                    if hasattr(owner, name):
+                        function = getattr(owner, name)
+                        skip_weight_init_saved.append((owner, name, function))
+                        setattr(owner, name, create_skippable_init_function(function))
+        skip_weight_init_depth += 1
+    skip_weight_init_thread.depth = getattr(skip_weight_init_thread, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        skip_weight_init_thread.depth -= 1
+        with skip_weight_init_lock:
+            skip_weight_init_depth -= 1
+            if skip_weight_init_depth == 0:
+                for owner, name, function in skip_weight_init_saved:
+                    setattr(owner, name, function)
+                skip_weight_init_saved.clear()
@@ -4,8 +4,29 @@ import torch
 from torch import Tensor
 from torch.nn import Module
 
+from tha3.poser.module_loader import LazyModuleDict
 from tha3.poser.poser import PoseParameterGroup, Poser
-from tha3.compute.cached_computation_func import TensorListCachedComputationFunc
+from tha3.compute.cached_computation_func import TensorListCachedComputationFunc, TensorCachedComputationFunc
+
+DEFAULT_CPU_BATCH_BYTES = 1 << 30
+
+
+def get_outputs_nbytes(outputs: Dict[str, List[Tensor]]) -> int:
+    """
+    Args:
+        outputs: outputs of a computation by key
+    Returns:
+        bytes of all the tensors in the outputs, a tensor listed under several keys is counted once
+    """
+    seen = set()
+    nbytes = 0
+    for output in outputs.values():
+        for tensor in output:
+            if not isinstance(tensor, Tensor) or (tensor.data_ptr(), tensor.nelement()) in seen:
+                continue
+            seen.add((tensor.data_ptr(), tensor.nelement()))
+            nbytes += tensor.element_size() * tensor.nelement()
+    return nbytes
 
 
 class GeneralPoser02(Poser):
@@ -18,17 +39,24 @@ class GeneralPoser02(Poser):
                  subrect: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None,
                  default_output_index: int = 0,
                  image_size: int = 256,
-                 dtype: torch.dtype = torch.float):
+                 dtype: torch.dtype = torch.float,
+                 output_index_func: Optional[Callable[[int], TensorCachedComputationFunc]] = None,
+                 memo_stats_func: Optional[Callable[[], Dict[str, Dict[str, int]]]] = None):
         self.dtype = dtype
         self.image_size = image_size
         self.default_output_index = default_output_index
         self.output_list_func = output_list_func
+        self.output_index_func = output_index_func
+        self.memo_stats_func = memo_stats_func
         self.subrect = subrect
         self.pose_parameters = pose_parameters
         self.device = device
         self.module_loaders = module_loaders
 
-        self.modules = None
+        self.modules = LazyModuleDict(self.module_loaders, self.device)
+        self.registered_image = None
+        self.registered_batch_image = None
+        self.bytes_per_pose = None
 
         self.num_parameters = 0
         for pose_parameter in self.pose_parameters:
@@ -39,16 +67,21 @@ class GeneralPoser02(Poser):
     def get_image_size(self) -> int:
         return self.image_size
 
-    def get_modules(self):
-        if self.modules is None:
-            self.modules = {}
-            for key in self.module_loaders:
-                module = self.module_loaders[key]()
-                self.modules[key] = module
-                module.to(self.device)
-                module.train(False)
+    def get_modules(self) -> LazyModuleDict:
+        # every network is loaded by the first lookup of the computation protocol, see LazyModuleDict
         return self.modules
 
+    def preload_modules(self, keys: Optional[List[str]] = None):
+        """
+        load networks concurrently ahead of the first pose
+        Args:
+            keys: names of the networks, every network if None
+        """
+        self.modules.preload(keys)
+
+    def get_module_load_times(self) -> Dict[str, float]:
+        return self.modules.load_times
+
     def get_pose_parameter_groups(self) -> List[PoseParameterGroup]:
         return self.pose_parameters
 
@@ -56,30 +89,133 @@ class GeneralPoser02(Poser):
         return self.num_parameters
 
     def pose(self, image: Tensor, pose: Tensor, output_index: Optional[int] = None) -> Tensor:
+        return self.get_pose_output(image, pose, output_index)[0]
+
+    def get_pose_output(self,
+                        image: Tensor,
+                        pose: Tensor,
+                        output_index: Optional[int] = None) -> Tuple[Tensor, Dict[str, List[Tensor]]]:
+        """
+        Returns:
+            (the requested output, the outputs of every network the computation ran or reused, by key)
+        """
         if output_index is None:
             output_index = self.default_output_index
-        output_list = self.get_posing_outputs(image, pose)
-        return output_list[output_index]
+        modules = self.get_modules()
+        batch = self.get_batch(image, pose)
+        outputs = {}
+        if self.output_index_func is None:
+            return self.output_list_func(modules, batch, outputs)[output_index], outputs
+        # only evaluate the networks the requested output depends on
+        return self.output_index_func(output_index)(modules, batch, outputs), outputs
+
+    def pose_batch(self,
+                   image: Tensor,
+                   poses: Tensor,
+                   output_index: Optional[int] = None,
+                   max_batch_bytes: Optional[int] = None) -> Tensor:
+        """
+        pose one source image with many poses, every network runs once per chunk of poses
+        Args:
+            image: source image of shape (C, H, W) or (1, C, H, W), shared by all poses
+            poses: poses of shape (N, num_parameters)
+            output_index: output to return, the default output if None
+            max_batch_bytes: memory budget of one chunk, half the free device memory on cuda and 1GB on the cpu
+                if None
+        Returns:
+            the output of every pose, of shape (N, ...)
+        """
+        if output_index is None:
+            output_index = self.default_output_index
+        results = []
+        start = 0
+        # the first chunk is a single pose, its memory use decides the size of the others
+        chunk_size = 1 if self.bytes_per_pose is None else self.get_chunk_size(max_batch_bytes)
+        while start < poses.shape[0]:
+            chunk = poses[start:start + chunk_size]
+            measure = self.bytes_per_pose is None
+            if measure and self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+                torch.cuda.reset_peak_memory_stats(self.device)
+                allocated = torch.cuda.memory_allocated(self.device)
+            load_count = self.modules.load_count
+            result, outputs = self.get_pose_output(image, chunk, output_index)
+            # weights loaded by this chunk would count as activations, measure again with the next one
+            if measure and self.modules.load_count != load_count:
+                measure = False
+            if measure:
+                # the outputs of every network stay alive until the chunk is done, and a memoizing protocol keeps
+                # them for the next chunk until that chunk has replaced them, so they are counted a second time
+                retained = get_outputs_nbytes(outputs)
+                if self.device.type == 'cuda':
+                    # outputs reused from the memo allocate nothing, the peak is never taken below the outputs
+                    measured = torch.cuda.max_memory_allocated(self.device) - allocated
+                    self.bytes_per_pose = max(measured, retained) + retained
+                else:
+                    self.bytes_per_pose = max(1, 2 * retained)
+                chunk_size = self.get_chunk_size(max_batch_bytes)
+            del outputs
+            # outputs that depend on the source image only are computed once for the whole chunk
+            results.append(result.expand(chunk.shape[0], *result.shape[1:]))
+            start += chunk.shape[0]
+        return torch.cat(results)
+
+    def get_chunk_size(self, max_batch_bytes: Optional[int] = None) -> int:
+        if max_batch_bytes is None:
+            if self.device.type == 'cuda':
+                free_bytes, _ = torch.cuda.mem_get_info(self.device)
+                max_batch_bytes = free_bytes // 2
+            else:
+                max_batch_bytes = DEFAULT_CPU_BATCH_BYTES
+        return max(1, max_batch_bytes // self.bytes_per_pose)
 
     def get_posing_outputs(self, image: Tensor, pose: Tensor) -> List[Tensor]:
         modules = self.get_modules()
+        batch = self.get_batch(image, pose)
+
+        outputs = {}
+        return self.output_list_func(modules, batch, outputs)
+
+    def register_image(self, image: Tensor):
+        """
+        register the source image of the following pose() calls, it must not be modified in place afterwards
+        the batched view of the image is prepared once, and the caches tied to the source image only have to
+        check the identity of that view
+        """
+        self.registered_image = image
+        self.registered_batch_image = None if image is None else self.get_batch_image(image)
 
+    def get_batch_image(self, image: Tensor) -> Tensor:
         if len(image.shape) == 3:
             image = image.unsqueeze(0)
-        if len(pose.shape) == 1:
-            pose = pose.unsqueeze(0)
         if self.subrect is not None:
             image = image[:, :, self.subrect[0][0]:self.subrect[0][1], self.subrect[1][0]:self.subrect[1][1]]
-        batch = [image, pose]
+        return image
 
-        outputs = {}
-        return self.output_list_func(modules, batch, outputs)
+    def get_batch(self, image: Tensor, pose: Tensor) -> List[Tensor]:
+        if image is self.registered_image:
+            image = self.registered_batch_image
+        else:
+            image = self.get_batch_image(image)
+        if len(pose.shape) == 1:
+            pose = pose.unsqueeze(0)
+        return [image, pose]
+
+    def get_memo_stats(self) -> Dict[str, Dict[str, int]]:
+        if self.memo_stats_func is None:
+            return {}
+        return self.memo_stats_func()
 
     def get_output_length(self) -> int:
         return self.output_length
 
-    def free(self):
-        self.modules = None
+    def free(self, key: Optional[str] = None):
+        """
+        release the networks to save memory, they are loaded again when a pose needs them
+        Args:
+            key: name of the network to release, every network if None
+        """
+        self.modules.free(key)
 
     def get_dtype(self) -> torch.dtype:
         return self.dtype
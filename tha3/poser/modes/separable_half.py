@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 import torch
 from torch import Tensor
@@ -16,9 +16,9 @@ from tha3.poser.poser import PoseParameterCategory, PoseParameters
 from tha3.nn.editor.editor_07 import Editor07, Editor07Args
 from tha3.nn.two_algo_body_rotator.two_algo_face_body_rotator_05 import TwoAlgoFaceBodyRotator05, \
     TwoAlgoFaceBodyRotator05Args
-from tha3.util import torch_load
-from tha3.compute.cached_computation_func import TensorListCachedComputationFunc
-from tha3.compute.cached_computation_protocol import CachedComputationProtocol
+from tha3.util import torch_load, get_tensor_version_token
+from tha3.compute.cached_computation_func import TensorListCachedComputationFunc, TensorCachedComputationFunc
+from tha3.compute.memoized_computation_protocol import MemoizedComputationProtocol
 from tha3.nn.nonlinearity_factory import ReLUFactory, LeakyReLUFactory
 from tha3.nn.normalization import InstanceNorm2dFactory
 from tha3.nn.util import BlockArgs
@@ -47,33 +47,65 @@ NUM_FACE_PARAMS = 27
 NUM_ROTATION_PARAMS = 6
 
 
-class FiveStepPoserComputationProtocol(CachedComputationProtocol):
+class FiveStepPoserComputationProtocol(MemoizedComputationProtocol):
+    # output count of every network, in the order Branch.all_outputs concatenates them
+    OUTPUT_LAYOUT = [
+        (Network.editor, 5),
+        (Network.two_algo_face_body_rotator, 3),
+        (Network.face_morpher, 7),
+        (Network.eyebrow_morphing_combiner, 8),
+        (Network.eyebrow_decomposer, 6),
+    ]
+    # pose parameters every outputs key depends on, including the dependencies of its inputs
+    POSE_DEPENDENCIES = {
+        Network.eyebrow_decomposer.outputs_key: (0, 0),
+        Network.eyebrow_morphing_combiner.outputs_key: (0, NUM_EYEBROW_PARAMS),
+        Network.face_morpher.outputs_key: (0, NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS),
+        Branch.face_morphed_full.name: (0, NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS),
+        Branch.face_morphed_half.name: (0, NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS),
+        Network.two_algo_face_body_rotator.outputs_key:
+            (0, NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS + NUM_ROTATION_PARAMS),
+        Network.editor.outputs_key: (0, NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS + NUM_ROTATION_PARAMS),
+    }
+
     def __init__(self, eyebrow_morphed_image_index: int):
         super().__init__()
         self.eyebrow_morphed_image_index = eyebrow_morphed_image_index
         self.cached_batch_0 = None
-        self.cached_eyebrow_decomposer_output = None
+        self.cached_batch_0_token = None
+        # (outputs key, index into it) of every entry of Branch.all_outputs
+        self.output_keys = []
+        for network, length in self.OUTPUT_LAYOUT:
+            self.output_keys.extend((network.outputs_key, i) for i in range(length))
 
     def compute_func(self) -> TensorListCachedComputationFunc:
+        return self.invalidate_on_new_image(self.get_output_tensor_list_func(Branch.all_outputs.name))
+
+    def compute_output_index_func(self, output_index: int) -> TensorCachedComputationFunc:
+        key, index = self.output_keys[output_index]
+        return self.invalidate_on_new_image(self.get_output_tensor_func(key, index))
+
+    def invalidate_on_new_image(self, output_func):
         def func(modules: Dict[str, Module],
                  batch: List[Tensor],
                  outputs: Dict[str, List[Tensor]]):
-            if self.cached_batch_0 is None:
-                new_batch_0 = True
-            elif batch[0].shape[0] != self.cached_batch_0.shape[0]:
-                new_batch_0 = True
-            else:
-                new_batch_0 = torch.max((batch[0] - self.cached_batch_0).abs()).item() > 0
-            if not new_batch_0:
-                outputs[Network.eyebrow_decomposer.outputs_key] = self.cached_eyebrow_decomposer_output
-            output = self.get_output(Branch.all_outputs.name, modules, batch, outputs)
-            if new_batch_0:
+            # the cached image is kept alive so its memory cannot be reused by a different image with the same token
+            token = get_tensor_version_token(batch[0])
+            if token != self.cached_batch_0_token:
+                self.clear_memo()
                 self.cached_batch_0 = batch[0]
-                self.cached_eyebrow_decomposer_output = outputs[Network.eyebrow_decomposer.outputs_key]
-            return output
+                self.cached_batch_0_token = token
+            return output_func(modules, batch, outputs)
 
         return func
 
+    def get_pose_dependency(self, key: str) -> Optional[Tuple[int, int]]:
+        return self.POSE_DEPENDENCIES.get(key)
+
+    def expand_to_pose_batch(self, tensor: Tensor, batch: List[Tensor]) -> Tensor:
+        # batch[0] may be a single source image shared by a batch of poses, it is broadcast where it meets the pose
+        return tensor.expand(batch[1].shape[0], -1, -1, -1)
+
     def compute_output(self, key: str, modules: Dict[str, Module], batch: List[Tensor],
                        outputs: Dict[str, List[Tensor]]) -> List[Tensor]:
         if key == Network.eyebrow_decomposer.outputs_key:
@@ -81,8 +113,10 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
             return modules[Network.eyebrow_decomposer.name].forward(input_image)
         elif key == Network.eyebrow_morphing_combiner.outputs_key:
             eyebrow_decomposer_output = self.get_output(Network.eyebrow_decomposer.outputs_key, modules, batch, outputs)
-            background_layer = eyebrow_decomposer_output[EyebrowDecomposer03.BACKGROUND_LAYER_INDEX]
-            eyebrow_layer = eyebrow_decomposer_output[EyebrowDecomposer03.EYEBROW_LAYER_INDEX]
+            background_layer = self.expand_to_pose_batch(
+                eyebrow_decomposer_output[EyebrowDecomposer03.BACKGROUND_LAYER_INDEX], batch)
+            eyebrow_layer = self.expand_to_pose_batch(
+                eyebrow_decomposer_output[EyebrowDecomposer03.EYEBROW_LAYER_INDEX], batch)
             eyebrow_pose = batch[1][:, :NUM_EYEBROW_PARAMS]
             return modules[Network.eyebrow_morphing_combiner.name].forward(
                 background_layer,
@@ -92,14 +126,15 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
             eyebrow_morphing_combiner_output = self.get_output(
                 Network.eyebrow_morphing_combiner.outputs_key, modules, batch, outputs)
             eyebrow_morphed_image = eyebrow_morphing_combiner_output[self.eyebrow_morphed_image_index]
-            input_image = batch[0][:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+            input_image = self.expand_to_pose_batch(
+                batch[0][:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)], batch).clone()
             input_image[:, :, 32:32 + 128, 32:32 + 128] = eyebrow_morphed_image
             face_pose = batch[1][:, NUM_EYEBROW_PARAMS:NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS]
             return modules[Network.face_morpher.name].forward(input_image, face_pose)
         elif key == Branch.face_morphed_full.name:
             face_morpher_output = self.get_output(Network.face_morpher.outputs_key, modules, batch, outputs)
             face_morphed_image = face_morpher_output[0]
-            input_image = batch[0].clone()
+            input_image = self.expand_to_pose_batch(batch[0], batch).clone()
             input_image[:, :, 32:32 + 192, 32 + 128:32 + 192 + 128] = face_morphed_image
             return [input_image]
         elif key == Branch.face_morphed_half.name:
@@ -328,11 +363,14 @@ def create_poser(
         Network.editor.name:
             lambda: load_editor(module_file_names[Network.editor.name]),
     }
+    protocol = FiveStepPoserComputationProtocol(eyebrow_morphed_image_index)
     return GeneralPoser02(
         image_size=512,
         module_loaders=loaders,
         pose_parameters=get_pose_parameters().get_pose_parameter_groups(),
-        output_list_func=FiveStepPoserComputationProtocol(eyebrow_morphed_image_index).compute_func(),
+        output_list_func=protocol.compute_func(),
+        output_index_func=protocol.compute_output_index_func,
+        memo_stats_func=protocol.get_memo_stats,
         subrect=None,
         device=device,
         output_length=29,
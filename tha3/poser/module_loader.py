@@ -0,0 +1,121 @@
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import torch
+from torch.nn import Module
+
+from tha3.nn.init_function import skip_weight_init
+
+
+def load_modules(module_loaders: Dict[str, Callable[[], Module]],
+                 device: Optional[torch.device] = None,
+                 max_workers: Optional[int] = None,
+                 verbose: bool = True) -> Tuple[Dict[str, Module], Dict[str, float]]:
+    """
+    load several networks at the same time
+
+    every loader runs on its own thread of a pool with weight initialization skipped on that thread, the loaders
+    overwrite all the weights with their checkpoint anyway. reading the checkpoints and copying the weights
+    release the gil, so the networks load in about the time of the largest one.
+    Args:
+        module_loaders: loaders that build a network and load its checkpoint, by name
+        device: device the networks are moved to, they are left where the loaders put them if None
+        max_workers: threads of the pool, one per loader if None
+        verbose: print the load time of every network
+    Returns:
+        (networks in eval mode by name, seconds each network took to load by name)
+    """
+    if len(module_loaders) == 0:
+        return {}, {}
+
+    def load(loader):
+        tic = time.perf_counter()
+        with skip_weight_init():
+            module = loader()
+        if device is not None:
+            module.to(device)
+        module.train(False)
+        return module, time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers or len(module_loaders)) as pool:
+        futures = {key: pool.submit(load, loader) for key, loader in module_loaders.items()}
+        results = {key: future.result() for key, future in futures.items()}
+    seconds = time.perf_counter() - tic
+
+    modules = {key: result[0] for key, result in results.items()}
+    load_times = {key: result[1] for key, result in results.items()}
+    if verbose:
+        for key, load_time in load_times.items():
+            print("  %-28s %8.1f ms" % (key, load_time * 1000))
+        print("Loaded %d networks in %.1f ms" % (len(modules), seconds * 1000))
+    return modules, load_times
+
+
+class LazyModuleDict(Mapping):
+    """
+    networks by name that are loaded the first time they are looked up
+
+    the computation protocols only look up the networks the requested outputs need, so a network no output
+    depends on is never loaded. a loaded network can be freed again and is reloaded by the next lookup.
+    """
+
+    def __init__(self,
+                 module_loaders: Dict[str, Callable[[], Module]],
+                 device: Optional[torch.device] = None,
+                 verbose: bool = True):
+        self.module_loaders = module_loaders
+        self.device = device
+        self.verbose = verbose
+        self.modules = {}
+        self.load_times = {}
+        self.load_count = 0
+        self.lock = threading.RLock()
+
+    def __getitem__(self, key: str) -> Module:
+        module = self.modules.get(key)
+        if module is not None:
+            return module
+        if key not in self.module_loaders:
+            raise KeyError(key)
+        self.preload([key])
+        return self.modules[key]
+
+    def __iter__(self):
+        return iter(self.module_loaders)
+
+    def __len__(self) -> int:
+        return len(self.module_loaders)
+
+    def preload(self, keys: Optional[Iterable[str]] = None):
+        """
+        load networks ahead of their first lookup, concurrently with load_modules
+        Args:
+            keys: names of the networks, all of them if None
+        """
+        with self.lock:
+            if keys is None:
+                keys = self.module_loaders.keys()
+            loaders = {key: self.module_loaders[key] for key in keys if key not in self.modules}
+            modules, load_times = load_modules(loaders, self.device, verbose=self.verbose)
+            self.modules.update(modules)
+            self.load_times.update(load_times)
+            self.load_count += len(modules)
+
+    def get_loaded_keys(self) -> List[str]:
+        return list(self.modules.keys())
+
+    def free(self, key: Optional[str] = None):
+        """
+        release a loaded network, the next lookup loads it again
+        Args:
+            key: name of the network, every network if None
+        """
+        with self.lock:
+            if key is None:
+                self.modules.clear()
+            else:
+                self.modules.pop(key, None)
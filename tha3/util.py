@@ -1,3 +1,4 @@
+import inspect
 import math
 import os
 from typing import List
@@ -137,28 +138,53 @@ def extract_numpy_image_from_filelike_with_pytorch_layout(file, has_alpha=True,
     return extract_numpy_image_from_PIL_image_with_pytorch_layout(pil_image, has_alpha, scale, offset)
 
 
-def extract_numpy_image_from_PIL_image_with_pytorch_layout(pil_image, has_alpha=True, scale=2.0, offset=-1.0):
+def clear_transparent_pixels(raw_image):
+    """
+    set every channel of the fully transparent pixels to 0 so that their color does not influence the model
+    Args:
+        raw_image (numpy array): rgba image of shape (h, w, 4)
+    Returns:
+        a copy of the image with the transparent pixels set to [0 0 0 0]
+    """
+    image = numpy.array(raw_image)
+    image[image[:, :, 3] <= 0] = 0
+    return image
+
+
+def numpy_image_to_pytorch_layout(raw_image, has_alpha=True, scale=2.0, offset=-1.0, linear_alpha=False):
+    """
+    convert an 8 bit srgb image to a linear image in the (c, h, w) layout of the posers
+    Args:
+        raw_image (numpy array): image of shape (h, w, c), uint8
+        has_alpha: the last channel is alpha, fully transparent pixels are cleared to [0 0 0 0]
+        scale: scale applied to the [0, 1] values
+        offset: offset added after scaling
+        linear_alpha: also pass alpha through the srgb to linear conversion, the way utils.preprocessing_image
+            always did
+    Returns:
+        image of shape (c, h, w), float64 (numpy array)
+    """
+    num_channel = 4 if has_alpha else 3
+    image = numpy.asarray(raw_image)[:, :, 0:num_channel] / 255.0
     if has_alpha:
-        num_channel = 4
+        image[image[:, :, 3] <= 0] = 0.0
+    if linear_alpha:
+        image = numpy_srgb_to_linear(image)
     else:
-        num_channel = 3
-    image_size = pil_image.width
+        image[:, :, 0:3] = numpy_srgb_to_linear(image[:, :, 0:3])
+    image = numpy.ascontiguousarray(image.transpose(2, 0, 1))
+    if scale != 1.0:
+        image *= scale
+    if offset != 0.0:
+        image += offset
+    return image
 
-    # search for transparent pixels(alpha==0) and change them to [0 0 0 0] to avoid the color influence to the model
-    for i, px in enumerate(pil_image.getdata()):
-        if px[3] <= 0:
-            y = i // image_size
-            x = i % image_size
-            pil_image.putpixel((x, y), (0, 0, 0, 0))
 
-    raw_image = numpy.asarray(pil_image)
-    image = (raw_image / 255.0).reshape(image_size, image_size, num_channel)
-    image[:, :, 0:3] = numpy_srgb_to_linear(image[:, :, 0:3])
-    image = image \
-                .reshape(image_size * image_size, num_channel) \
-                .transpose() \
-                .reshape(num_channel, image_size, image_size) * scale + offset
-    return image
+def extract_numpy_image_from_PIL_image_with_pytorch_layout(pil_image, has_alpha=True, scale=2.0, offset=-1.0):
+    image_size = pil_image.width
+    num_channel = 4 if has_alpha else 3
+    raw_image = numpy.asarray(pil_image).reshape(image_size, image_size, num_channel)
+    return numpy_image_to_pytorch_layout(raw_image, has_alpha, scale, offset)
 
 
 def extract_pytorch_image_from_filelike(file, has_alpha=True, scale=2.0, offset=-1.0):
@@ -175,6 +201,13 @@ def extract_pytorch_image_from_PIL_image(pil_image, has_alpha=True, scale=2.0, o
     return torch.from_numpy(image).float()
 
 
+def get_tensor_version_token(tensor: Tensor):
+    # identifies the content of a tensor without reading it, by the memory it views, the way it views it and
+    # the version counter every in-place write bumps. only reliable while the tensor is kept alive, a freed
+    # tensor's memory may be reused by a new one
+    return tensor.device, tensor.data_ptr(), tuple(tensor.shape), tensor.stride(), tensor._version
+
+
 def extract_numpy_image_from_filelike(file):
     pil_image = PIL.Image.open(file)
     image_width = pil_image.width
@@ -243,8 +276,15 @@ def save_pytorch_image(image, file_name):
 
 
 def torch_load(file_name):
-    with open(file_name, 'rb') as f:
-        return torch.load(f)
+    # torch versions with mmap support keep the tensors backed by the file, older ones such as the pinned 1.13
+    # have no such option and read every tensor of the checkpoint into memory
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(file_name, mmap=True)
+        except RuntimeError:
+            # checkpoints in the legacy format cannot be mapped by torch.load
+            pass
+    return torch.load(file_name)
 
 
 def torch_save(content, file_name):
@@ -1,6 +1,8 @@
 import torch
 import numpy as np
 
+from tha3.util import numpy_image_to_pytorch_layout
+
 
 def linear_rgb2srgb(image):
     """
@@ -34,16 +36,7 @@ def preprocessing_image(image):
     Returns:
         tensor
     """
-    np_image = np.array(image) / 255
-    clipped_image = np.clip(np_image, 0, 1)
-    srgb_image = linear_rgb2srgb(clipped_image)
-    h, w, c = srgb_image.shape
-    linear_image = srgb_image.reshape(h * w, c)
-    for pixel in linear_image:
-        if pixel[3] == 0.0:
-            pixel[0:3] = 0.0
-    reshaped_image = linear_image.transpose().reshape(c, h, w)
-    return reshaped_image
+    return numpy_image_to_pytorch_layout(np.asarray(image), scale=1.0, offset=0.0, linear_alpha=True)
 
 
 def postprocessing_image(tensor):